@@ -14,7 +14,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
 
-from flexi_auth.exceptions import WrongPermissionCheck
+from django.db.models import Q
+from django.db.models.query import QuerySet
+
+import functools
+import operator
+
+from flexi_auth.exceptions import WrongPermissionCheck, TooManyAllowedInstances
+from flexi_auth.instrumentation import instrumented
+from flexi_auth.perm_cache import cached_decision
+from flexi_auth.query import max_query_params
+from flexi_auth.registry import PERMISSION_REGISTRY
 
 class ParamRoleBackend(object):
     """
@@ -84,6 +94,7 @@ class ParamRoleBackend(object):
         return None
     
     
+    @instrumented('has_perm', check=True)
     def has_perm(self, user_obj, perm, obj=None):
         """
         Checks whether a user has a table-level/row-level permission on a model class/instance.
@@ -115,7 +126,8 @@ class ParamRoleBackend(object):
             
         # If this permission check is not envisaged by the current application domain,
         # raise an exception before even attempting to perform the check
-        perm_check = getattr(obj.model_or_instance, 'can_' + perm.lower(), None)  
+        # (dispatch goes through the registry of supported permissions, so it doesn't involve reflection)
+        perm_check = PERMISSION_REGISTRY.get_check(obj.model_or_instance, perm)  
       
         if perm_check:
             # ``perm_check`` now contains the function implementing the permission check for the given model:
@@ -131,7 +143,147 @@ class ParamRoleBackend(object):
                 return False   
             
             # in case of a "regular" user, simply perform the check
-            return perm_check(user_obj, obj.context)
+            # (or reuse a previous decision, if decision caching is enabled) 
+            return cached_decision(user_obj, perm, obj, lambda: perm_check(user_obj, obj.context))
         
         else: 
             raise WrongPermissionCheck(perm, obj.model_or_instance, obj.context)
+
+
+def _defining_class(cls, attr):
+    """
+    Return the class (among ``cls`` and its ancestors) where attribute ``attr`` is defined, 
+    or ``None`` if it's not defined at all.
+    """
+    
+    for klass in cls.__mro__:
+        if attr in klass.__dict__:
+            return klass
+    return None
+
+@instrumented('filter_by_perm')
+def filter_by_perm(user, perm, queryset, context=None):
+    """
+    Restrict ``queryset`` to the model instances on which ``user`` is granted the row-level 
+    permission ``perm``, with respect to the given ``context`` (a dictionary); 
+    this is the bulk counterpart of checking ``user.has_perm(perm, ObjectWithContext(instance, context))``
+    for each instance in ``queryset``.  Return a ``QuerySet``.
+    
+    Models can declare a queryset-level counterpart of the ``can_<perm>`` method: a classmethod named 
+    ``can_<perm>_filter``, taking ``(user, context)`` as arguments and returning either a ``Q`` object 
+    or a ``QuerySet`` selecting the instances on which the permission is granted.  
+    It's only used if it's defined by the same class defining ``can_<perm>`` or by one of its subclasses, 
+    so that a filter is never paired with a check overriding the one it was written for.  
+    When it's used, no instance is loaded and the result compiles to a single SQL query.
+    
+    Otherwise, instances are streamed in chunks (ordered by primary key) and ``can_<perm>`` 
+    is called on each of them; the result is then restricted to the primary keys of the allowed instances, 
+    split among ``__in`` lookups of ``CHUNK_SIZE`` items.  Since they're all embedded in a single statement, 
+    if they exceed the limits of the DB backend in use (see ``flexi_auth.query.max_query_params()``), 
+    ``TooManyAllowedInstances`` is raised: models with many instances should implement ``can_<perm>_filter``.
+    
+    Permission checks inherited from ``PermissionBase`` grant everything, so the ``QuerySet`` is returned 
+    unfiltered; the same holds for superusers, while anonymous and inactive users are granted nothing. 
+    
+    If the model doesn't define a ``can_<perm>`` method, raise ``WrongPermissionCheck``.
+    """
+    
+    # local import, to avoid circular dependencies
+    from flexi_auth.models import PermissionBase
+    from flexi_auth.utils import CHUNK_SIZE, _chunks
+    
+    context = context or {}
+    model = queryset.model
+    check_name = 'can_' + perm.lower()
+    check_class = _defining_class(model, check_name)
+    if check_class is None:
+        raise WrongPermissionCheck(perm, model, context)
+    
+    if user.is_superuser or check_class is PermissionBase:
+        return queryset.all()
+    if user.is_anonymous() or not user.is_active:
+        return queryset.none()
+    
+    if isinstance(check_class.__dict__[check_name], classmethod):
+        # a table-level permission applies to every instance
+        if getattr(model, check_name)(user, context):
+            return queryset.all()
+        return queryset.none()
+    
+    filter_class = _defining_class(model, check_name + '_filter')
+    if filter_class is not None and issubclass(filter_class, check_class):
+        restriction = getattr(model, check_name + '_filter')(user, context)
+        if isinstance(restriction, QuerySet):
+            return queryset.filter(pk__in=restriction.values('pk'))
+        return queryset.filter(restriction)
+    
+    # fall back to checking instances one by one, streaming them in chunks 
+    allowed = []
+    ordered = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = ordered
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:CHUNK_SIZE])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+        allowed.extend([obj.pk for obj in chunk if getattr(obj, check_name)(user, context)])
+    
+    if not allowed:
+        return queryset.none()
+    # leave room for the variables of the rest of the query
+    limit = max_query_params(queryset.db)
+    if limit is not None and len(allowed) > limit - CHUNK_SIZE:
+        raise TooManyAllowedInstances(model, perm, limit - CHUNK_SIZE)
+    return queryset.filter(functools.reduce(operator.or_, [Q(pk__in=pks) for pks in _chunks(allowed)]))
+
+@instrumented('has_perm_many')
+def has_perm_many(user, perm, objs, context=None):
+    """
+    Check whether ``user`` is granted the row-level permission ``perm`` on each of the model instances 
+    in ``objs`` (possibly of different models), with respect to the given ``context`` (a dictionary);
+    this is the batched counterpart of checking ``user.has_perm(perm, ObjectWithContext(obj, context))``
+    for each of them.  Return a dictionary mapping every instance to ``True`` or ``False``.
+    
+    Instances are grouped by model class.  Models can declare a batched counterpart of the ``can_<perm>`` method:
+    a classmethod named ``can_<perm>_many``, taking ``(instances, user, context)`` as arguments and returning 
+    either the set of instances on which the permission is granted, or a dictionary mapping instances to ``True`` 
+    or ``False``; this way, work needed by every check (e.g. retrieving roles of the user) can be shared.
+    It's only used if it's defined by the same class defining ``can_<perm>`` or by one of its subclasses;
+    otherwise, ``can_<perm>`` is called on each instance.
+    
+    Superusers are granted everything, while anonymous and inactive users are granted nothing. 
+    
+    If a model doesn't define a ``can_<perm>`` method, raise ``WrongPermissionCheck``.
+    """
+    
+    context = context or {}
+    check_name = 'can_' + perm.lower()
+    by_model = {}
+    for obj in objs:
+        by_model.setdefault(obj.__class__, []).append(obj)
+    
+    decisions = {}
+    for (model, instances) in by_model.items():
+        check_class = _defining_class(model, check_name)
+        if check_class is None:
+            raise WrongPermissionCheck(perm, model, context)
+        
+        if user.is_superuser:
+            granted = set(instances)
+        elif user.is_anonymous() or not user.is_active:
+            granted = set()
+        else:
+            batch_class = _defining_class(model, check_name + '_many')
+            if batch_class is not None and issubclass(batch_class, check_class):
+                granted = getattr(model, check_name + '_many')(instances, user, context)
+                if isinstance(granted, dict):
+                    granted = set([obj for (obj, allowed) in granted.items() if allowed])
+            else:
+                granted = set([obj for obj in instances if getattr(obj, check_name)(user, context)])
+        
+        for obj in instances:
+            decisions[obj] = obj in granted
+    return decisions
@@ -0,0 +1,29 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A performance suite for ``django-flexi-auth``.
+
+``flexi_auth.benchmarks.dataset`` generates deterministic synthetic datasets (parametric roles, 
+users, groups, group memberships and role assignments) on top of the test models 
+(see ``flexi_auth.tests.models``), while ``flexi_auth.benchmarks.runner`` times the main entry points 
+of the API against them, writing machine-readable results which can be compared against a stored baseline.
+
+Both are driven by the ``benchmark_permissions`` management command, which runs on a throw-away 
+test database; since the test models and role constraints are needed, run it with the test settings:
+
+    django-admin.py benchmark_permissions --settings=flexi_auth.tests.settings --param-roles=100000
+"""
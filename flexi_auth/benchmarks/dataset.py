@@ -0,0 +1,185 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Generation of synthetic datasets, built from the test models (``Article``, ``Book``, ``Magazine``, ``Author``)
+and the role constraints declared by the test settings (see ``flexi_auth.tests.settings``).
+
+Datasets are deterministic: the same sizes and seed always produce the same rows 
+(as long as they are generated on an empty database).  Rows are inserted via bulk inserts, 
+so generating datasets of millions of rows is practical (on SQLite, too).
+"""
+
+from django.contrib.auth.models import User, Group
+from django.db import transaction
+
+import random
+
+from flexi_auth.models import ParamRole, PrincipalParamRoleRelation
+from flexi_auth.utils import register_parametric_roles, rebuild_effective_param_roles, invalidate_parametric_roles_cache,\
+    _bulk_create
+from flexi_auth.query import effective_roles_stored
+from flexi_auth.tests.models import Article, Book, Magazine, Author
+
+# number of parametric roles registered by a single call to ``register_parametric_roles()``
+REGISTRATION_BATCH = 10000
+
+# share of magazines/books which are archived (i.e. make parametric roles bound to them archived, too)
+ARCHIVED_RATIO = 0.2
+
+class Dataset(object):
+    """
+    The IDs of the rows making up a generated dataset, along with the sizes it was generated with.
+    """
+    
+    def __init__(self, sizes, seed):
+        self.sizes = sizes
+        self.seed = seed
+        self.ids = {}
+    
+    def sample(self, kind, count, rng):
+        """
+        Return a list of ``count`` IDs of rows of the given ``kind`` (e.g. ``'user'`` or ``'magazine'``), 
+        chosen (with replacement) by the random number generator ``rng``.
+        """
+        
+        ids = self.ids[kind]
+        return [rng.choice(ids) for i in range(count)]
+    
+
+def _ids(model):
+    return list(model.objects.order_by('pk').values_list('pk', flat=True))
+
+def _role_specs(n, article_ids, book_ids, magazine_ids, rng):
+    """
+    Yield ``n`` (distinct) parametric role specifications, suitable for ``register_parametric_roles()``, 
+    cycling among the kinds of roles allowed by the test settings.
+    """
+    
+    sponsorships = set()
+    for i in range(n):
+        j = i // 4
+        kind = i % 4
+        if kind == 0:
+            yield ('EDITOR', {'article': Article(pk=article_ids[j])})
+        elif kind == 1:
+            yield ('PUBLISHER', {'book': Book(pk=book_ids[j])})
+        else:
+            # sponsorships are bound to an (article, magazine) pair: 
+            # half of them pair objects by position, the others at random (avoiding duplicates)
+            if kind == 2:
+                pair = (article_ids[j], magazine_ids[j])
+            else:
+                pair = (article_ids[j], rng.choice(magazine_ids))
+            while pair in sponsorships:
+                pair = (rng.choice(article_ids), rng.choice(magazine_ids))
+            sponsorships.add(pair)
+            yield ('SPONSOR', {'article': Article(pk=pair[0]), 'magazine': Magazine(pk=pair[1])})
+
+def _distinct_pairs(count, left_ids, right_ids, rng):
+    """
+    Return ``count`` distinct ``(left, right)`` pairs of IDs, chosen at random
+    (at most ``len(left_ids) * len(right_ids)`` of them). 
+    """
+    
+    count = min(count, len(left_ids) * len(right_ids))
+    pairs = set()
+    while len(pairs) < count:
+        pairs.add((rng.choice(left_ids), rng.choice(right_ids)))
+    return sorted(pairs)
+
+@transaction.commit_on_success
+def generate_dataset(param_roles=1000, users=None, groups=None, memberships=None, 
+                     roles_per_user=2, roles_per_group=5, seed=0):
+    """
+    Populate the (empty) database with a synthetic dataset made of:
+    
+    * ``param_roles`` parametric roles: a quarter of them are ``EDITOR`` ones (bound to an article), 
+      a quarter ``PUBLISHER`` ones (bound to a book) and the others ``SPONSOR`` ones (bound to an article 
+      and a magazine), along with the articles, books, magazines and authors they're bound to; 
+      ``ARCHIVED_RATIO`` of the magazines and books are archived;
+    * ``users`` users (defaults to ``param_roles``), each of them directly holding ``roles_per_user`` 
+      parametric roles chosen at random; 
+    * ``groups`` groups (defaults to a tenth of the users), each of them holding ``roles_per_group`` 
+      parametric roles chosen at random;
+    * ``memberships`` distinct group memberships of users (defaults to twice the number of users), chosen at random.
+    
+    Choices are made by a random number generator initialized with ``seed``, so the same arguments
+    always produce the same dataset.  If stored archive states or effective roles are enabled 
+    (see ``settings.FLEXI_AUTH_STORE_ARCHIVE_STATE`` and ``settings.FLEXI_AUTH_EFFECTIVE_ROLES``), 
+    they're computed for the whole dataset.
+    
+    Return a ``Dataset`` instance. 
+    """
+    
+    if users is None:
+        users = param_roles
+    if groups is None:
+        groups = max(1, users // 10)
+    if memberships is None:
+        memberships = users * 2
+    rng = random.Random(seed)
+    dataset = Dataset({'param_roles': param_roles, 'users': users, 'groups': groups, 'memberships': memberships, 
+                       'roles_per_user': roles_per_user, 'roles_per_group': roles_per_group}, seed)
+    
+    # objects parametric roles are bound to
+    n = max(1, (param_roles + 3) // 4)
+    _bulk_create(Author, [Author(name="Name %d" % i, surname="Surname %d" % i) for i in range(max(1, n // 10))])
+    author_ids = _ids(Author)
+    _bulk_create(Magazine, [Magazine(name="Magazine %d" % i, printing=rng.randint(1000, 100000), 
+                                     archived=rng.random() < ARCHIVED_RATIO) for i in range(n)])
+    _bulk_create(Article, [Article(title="Article %d" % i, body="...", author_id=rng.choice(author_ids)) for i in range(n)])
+    _bulk_create(Book, [Book(title="Book %d" % i, content="...", out_of_print=rng.random() < ARCHIVED_RATIO) for i in range(n)])
+    dataset.ids['author'] = author_ids
+    dataset.ids['magazine'] = _ids(Magazine)
+    dataset.ids['article'] = _ids(Article)
+    dataset.ids['book'] = _ids(Book)
+    
+    # parametric roles
+    batch = []
+    for spec in _role_specs(param_roles, dataset.ids['article'], dataset.ids['book'], dataset.ids['magazine'], rng):
+        batch.append(spec)
+        if len(batch) == REGISTRATION_BATCH:
+            register_parametric_roles(batch)
+            batch = []
+    if batch:
+        register_parametric_roles(batch)
+    dataset.ids['param_role'] = _ids(ParamRole)
+    
+    # principals and group memberships
+    _bulk_create(User, [User(username="user%d" % i, password="!") for i in range(users)])
+    _bulk_create(Group, [Group(name="group%d" % i) for i in range(groups)])
+    dataset.ids['user'] = _ids(User)
+    dataset.ids['group'] = _ids(Group)
+    through = User.groups.through
+    _bulk_create(through, [through(user_id=user_id, group_id=group_id) 
+                           for (user_id, group_id) in _distinct_pairs(memberships, dataset.ids['user'], dataset.ids['group'], rng)])
+    
+    # role assignments
+    role_ids = dataset.ids['param_role']
+    relations = [PrincipalParamRoleRelation(user_id=user_id, role_id=role_id) 
+                 for (user_id, role_id) in _distinct_pairs(users * roles_per_user, dataset.ids['user'], role_ids, rng)]
+    relations.extend([PrincipalParamRoleRelation(group_id=group_id, role_id=role_id) 
+                      for (group_id, role_id) in _distinct_pairs(groups * roles_per_group, dataset.ids['group'], role_ids, rng)])
+    _bulk_create(PrincipalParamRoleRelation, relations)
+    
+    # bulk inserts don't send signals, so update derived data here
+    # (stored archive states have already been computed by ``register_parametric_roles()``)
+    if effective_roles_stored():
+        rebuild_effective_param_roles()
+    invalidate_parametric_roles_cache()
+    
+    return dataset
@@ -0,0 +1,239 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Timing of the main entry points of the API against a generated dataset (see ``flexi_auth.benchmarks.dataset``).
+
+Every benchmark is a function taking ``(dataset, rng, number)`` arguments, preparing the inputs 
+of ``number`` operations (chosen by the random number generator ``rng``) and returning 
+a ``(run, ops)`` pair, where ``run`` is a callable performing ``ops`` operations.  
+Benchmarks are run ``repeat`` times; the best and median time per operation are reported, 
+along with the number of SQL queries per operation.
+
+Results are plain dictionaries, which can be written to (and read from) JSON files 
+and compared against a baseline by ``compare_results()``.  
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+
+import django
+import json
+import random
+import sys
+import time
+
+from flexi_auth.backends import ParamRoleBackend, has_perm_many
+from flexi_auth.decorators import object_permission_required
+from flexi_auth.models import ObjectWithContext, ParamRole
+from flexi_auth.utils import register_parametric_role, get_all_parametric_roles
+from flexi_auth.tests.models import Article, Magazine
+
+# size of the batches of objects checked by batched benchmarks
+BATCH_SIZE = 1000
+
+# by default, a benchmark is flagged as a regression if it got slower by more than this fraction  
+DEFAULT_TOLERANCE = 0.25
+
+def _user(pk):
+    # a fresh instance for every operation, so that nothing is memoized across operations
+    return User(pk=pk, is_active=True)
+
+def bench_register_parametric_role(dataset, rng, number):
+    # registering an already existing parametric role: the common case   
+    articles = [Article(pk=pk) for pk in dataset.sample('article', number, rng)]
+    def run():
+        for article in articles:
+            register_parametric_role('EDITOR', article=article)
+    return (run, number)
+
+def bench_get_param_roles(dataset, rng, number):
+    magazines = [Magazine(pk=pk) for pk in dataset.sample('magazine', number, rng)]
+    def run():
+        for magazine in magazines:
+            list(ParamRole.objects.get_param_roles('SPONSOR', magazine=magazine))
+    return (run, number)
+
+def bench_get_all_parametric_roles(dataset, rng, number):
+    user_ids = dataset.sample('user', number, rng)
+    def run():
+        for pk in user_ids:
+            get_all_parametric_roles(_user(pk))
+    return (run, number)
+
+def bench_has_perm(dataset, rng, number):
+    checks = list(zip(dataset.sample('user', number, rng), dataset.sample('magazine', number, rng)))
+    def run():
+        for (user_id, magazine_id) in checks:
+            _user(user_id).has_perm('VIEW', ObjectWithContext(Magazine(pk=magazine_id)))
+    return (run, number)
+
+def bench_has_perm_loop(dataset, rng, number):
+    # the baseline for ``bench_has_perm_many``: checking a batch of objects one at a time 
+    backend = ParamRoleBackend()
+    user_id = dataset.sample('user', 1, rng)[0]
+    magazines = [Magazine(pk=pk) for pk in dataset.sample('magazine', min(BATCH_SIZE, number * 10), rng)]
+    def run():
+        user = _user(user_id)
+        for magazine in magazines:
+            backend.has_perm(user, 'VIEW', ObjectWithContext(magazine))
+    return (run, len(magazines))
+
+def bench_has_perm_many(dataset, rng, number):
+    user_id = dataset.sample('user', 1, rng)[0]
+    magazines = [Magazine(pk=pk) for pk in dataset.sample('magazine', min(BATCH_SIZE, number * 10), rng)]
+    def run():
+        has_perm_many(_user(user_id), 'VIEW', magazines)
+    return (run, len(magazines))
+
+def bench_active(dataset, rng, number):
+    magazines = [Magazine(pk=pk) for pk in dataset.sample('magazine', number, rng)]
+    def run():
+        for magazine in magazines:
+            list(ParamRole.objects.active('SPONSOR', magazine=magazine))
+    return (run, number)
+
+def bench_active_count(dataset, rng, number):
+    # archive state of a whole kind of parametric roles: this one scales with the dataset
+    def run():
+        ParamRole.objects.filter(role__name='SPONSOR').active().count()
+    return (run, 1)
+
+def bench_decorator(dataset, rng, number):
+    view = lambda request: HttpResponse()
+    checks = list(zip(dataset.sample('user', number, rng), dataset.sample('magazine', number, rng)))
+    factory = RequestFactory()
+    def run():
+        for (user_id, magazine_id) in checks:
+            request = factory.get('/')
+            request.user = _user(user_id)
+            object_permission_required('VIEW', Magazine(pk=magazine_id))(view)(request)
+    return (run, number)
+
+# benchmarks, in the order they're run
+BENCHMARKS = (
+    ('register_parametric_role', bench_register_parametric_role),
+    ('get_param_roles', bench_get_param_roles),
+    ('get_all_parametric_roles', bench_get_all_parametric_roles),
+    ('has_perm', bench_has_perm),
+    ('has_perm_loop', bench_has_perm_loop),
+    ('has_perm_many', bench_has_perm_many),
+    ('active', bench_active),
+    ('active_count', bench_active_count),
+    ('object_permission_required', bench_decorator),
+)
+
+def _count_queries(func):
+    """
+    Call ``func`` and return the number of SQL queries it performed. 
+    """
+    
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        start = len(connection.queries)
+        func()
+        return len(connection.queries) - start
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+
+def run_benchmarks(dataset, names=None, repeat=3, number=100, seed=0):
+    """
+    Run the benchmarks named ``names`` (by default, all of them) against ``dataset``. 
+    
+    Each benchmark is prepared with inputs for ``number`` operations (chosen by a random number generator
+    initialized with ``seed``) and run ``repeat`` times, plus once more to count the SQL queries it performs.
+    
+    Return a dictionary holding metadata about the run (under the ``'meta'`` key) 
+    and, for each benchmark, the best and median time per operation (in seconds) and the number of queries 
+    per operation (under the ``'results'`` key).
+    
+    Raise ``KeyError`` if a benchmark name is unknown.
+    """
+    
+    available = dict(BENCHMARKS)
+    if names is None:
+        names = [name for (name, bench) in BENCHMARKS]
+    benchmarks = [(name, available[name]) for name in names]
+    
+    results = {}
+    for (name, bench) in benchmarks:
+        (run, ops) = bench(dataset, random.Random(seed), number)
+        # warm up (and count queries)
+        queries = _count_queries(run)
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            run()
+            timings.append((time.time() - start) / ops)
+        timings.sort()
+        results[name] = {
+            'best' : timings[0],
+            'median' : timings[len(timings) // 2],
+            'queries' : float(queries) / ops,
+        }
+    
+    return {
+        'meta' : {
+            'sizes' : dataset.sizes,
+            'seed' : dataset.seed,
+            'repeat' : repeat,
+            'number' : number,
+            'engine' : settings.DATABASES['default']['ENGINE'],
+            'django' : django.get_version(),
+            'python' : sys.version.split()[0],
+        },
+        'results' : results,
+    }
+
+def write_results(results, path):
+    f = open(path, 'w')
+    try:
+        json.dump(results, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+def read_results(path):
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare ``results`` against ``baseline`` (both as returned by ``run_benchmarks()``), 
+    for the benchmarks found in both of them.
+    
+    A benchmark is a regression if its best time per operation grew by more than ``tolerance`` 
+    (a fraction of the baseline value), or if it performs more queries per operation.   
+    Return a list of ``(name, metric, baseline value, current value)`` tuples, one for each regression. 
+    """
+    
+    regressions = []
+    for (name, current) in sorted(results['results'].items()):
+        try:
+            previous = baseline['results'][name]
+        except KeyError:
+            continue
+        if current['best'] > previous['best'] * (1 + tolerance):
+            regressions.append((name, 'best', previous['best'], current['best']))
+        if current['queries'] > previous['queries']:
+            regressions.append((name, 'queries', previous['queries'], current['queries']))
+    return regressions
@@ -0,0 +1,185 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+An optional cache tier shared among processes, built on top of Django's cache framework.
+
+It's enabled by setting ``FLEXI_AUTH_CACHE`` to the alias of one of the caches declared 
+in ``settings.CACHES``; cached values expire after ``FLEXI_AUTH_CACHE_TIMEOUT`` seconds 
+(if unset, the default timeout of the chosen cache is used).
+
+Cache keys embed *generation counters* (themselves stored in the cache): one for each 
+principal (user or group) and one for each kind of role (i.e. basic role name).
+When role assignments or parametric roles change, the relevant counters are bumped, 
+so that entries computed before the change are never read again (they are left to expire),
+without flushing the whole cache.
+"""
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+import hashlib
+import time
+
+from flexi_auth.instrumentation import record_cache_lookup
+
+KEY_PREFIX = 'flexi_auth'
+
+_caches = {}
+
+def get_shared_cache():
+    """
+    Return the cache backend used by ``flexi_auth``, or ``None`` if the shared cache tier is disabled.
+    """
+    
+    alias = getattr(settings, 'FLEXI_AUTH_CACHE', None)
+    if not alias:
+        return None
+    try:
+        return _caches[alias]
+    except KeyError:
+        _caches[alias] = get_cache(alias)
+        return _caches[alias]
+    
+def _timeout():
+    return getattr(settings, 'FLEXI_AUTH_CACHE_TIMEOUT', None)
+
+def _generation_key(kind, ident):
+    return "%s:gen:%s:%s" % (KEY_PREFIX, kind, ident)
+
+def _new_generation():
+    # a missing counter (never set, or evicted) restarts from a time-based value,
+    # so it can't collide with a generation embedded in keys still living in the cache  
+    return int(time.time() * 1000)
+
+def _digest(values):
+    return hashlib.md5(u"|".join([u"%s" % v for v in values]).encode('utf-8')).hexdigest()
+
+def get_generations(cache, idents):
+    """
+    Return a dictionary mapping ``(kind, ident)`` pairs to the current value of their generation counters, 
+    initializing missing ones.
+    """
+    
+    keys = dict((_generation_key(kind, ident), (kind, ident)) for (kind, ident) in idents)
+    found = cache.get_many(keys.keys())
+    generations = {}
+    for (key, ident) in keys.items():
+        if key not in found:
+            cache.add(key, _new_generation(), None)
+            found[key] = cache.get(key)
+        generations[ident] = found[key]
+    return generations
+
+def bump_generations(idents):
+    """
+    Bump the generation counters identified by the given ``(kind, ident)`` pairs, 
+    where ``kind`` is one of ``'user'``, ``'group'`` or ``'role'``, and ``ident`` is 
+    the primary key of a principal or the name of a basic role, respectively.
+    
+    Do nothing if the shared cache tier is disabled.
+    """
+    
+    cache = get_shared_cache()
+    if cache is None:
+        return 
+    for (kind, ident) in idents:
+        key = _generation_key(kind, ident)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_generation(), None)
+
+def _groups_digest(cache, user, generation):
+    """
+    Return a digest of the generation counters of the groups ``user`` belongs to, 
+    given the current value of his/her own counter.
+    """
+    
+    # the group list of a user only changes along with his/her own generation counter 
+    groups_key = "%s:groups:%s:%s" % (KEY_PREFIX, user.pk, generation)
+    group_ids = cache.get(groups_key)
+    if group_ids is None:
+        group_ids = sorted(user.groups.values_list('pk', flat=True))
+        cache.set(groups_key, group_ids, _timeout())
+    group_generations = get_generations(cache, [('group', pk) for pk in group_ids])
+    return _digest(["%s:%s" % (pk, group_generations[('group', pk)]) for pk in group_ids])
+
+def get_user_generation(user):
+    """
+    Return a string identifying the current state of the role assignments of ``user`` 
+    (both direct ones and those inherited from his/her groups), as tracked by the generation counters 
+    of the shared cache; it changes whenever any process grants roles to/revokes roles from 
+    the user or his/her groups, or changes his/her group memberships.
+    
+    Return ``None`` if the shared cache tier is disabled.
+    """
+    
+    cache = get_shared_cache()
+    if cache is None:
+        return None
+    generation = get_generations(cache, [('user', user.pk)])[('user', user.pk)]
+    return "%s:%s" % (generation, _groups_digest(cache, user, generation))
+
+def get_principal_roles(principal, scope, compute):
+    """
+    Return a list of parametric roles for ``principal`` (a ``User`` or ``Group`` instance) 
+    from the shared cache, computing it by calling ``compute`` on a miss.
+    
+    ``scope`` is a string distinguishing kinds of role lists (e.g. direct vs. inherited roles); 
+    if it starts with ``'all'`` and ``principal`` is a user, the cached value is considered to depend 
+    also on the groups the user belongs to.
+    """
+    
+    cache = get_shared_cache()
+    if cache is None:
+        return compute()
+    
+    kind = principal._meta.object_name.lower()
+    generation = get_generations(cache, [(kind, principal.pk)])[(kind, principal.pk)]
+    key_parts = [scope, kind, principal.pk, generation]
+    
+    if kind == 'user' and scope.startswith('all'):
+        key_parts.append(_groups_digest(cache, principal, generation))
+    
+    key = "%s:roles:%s" % (KEY_PREFIX, ":".join([str(p) for p in key_parts]))
+    roles = cache.get(key)
+    record_cache_lookup(roles is not None)
+    if roles is None:
+        roles = compute()
+        cache.set(key, roles, _timeout())
+    return roles
+
+def get_param_role_ids(role_name, param_specs, compute):
+    """
+    Return the list of IDs of the parametric roles of kind ``role_name`` matching ``param_specs``
+    (an iterable of ``(name, content_type_id, object_id)`` triples) from the shared cache, 
+    computing it by calling ``compute`` on a miss.
+    """
+    
+    cache = get_shared_cache()
+    if cache is None:
+        return compute()
+    
+    generation = get_generations(cache, [('role', role_name)])[('role', role_name)]
+    key = "%s:param_roles:%s:%s:%s" % (KEY_PREFIX, role_name, generation, _digest(sorted(param_specs)))
+    ids = cache.get(key)
+    record_cache_lookup(ids is not None)
+    if ids is None:
+        ids = compute()
+        cache.set(key, ids, _timeout())
+    return ids
@@ -0,0 +1,157 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import get_model
+from django.utils.translation import ugettext as _
+
+from flexi_auth.exceptions import RoleNotAllowed, RoleParameterNotAllowed
+
+def get_model_key(model_or_instance):
+    """
+    Return a ``(app_label, model_name)`` pair identifying the model of the given model class/instance, 
+    with the same semantic of the ``ContentType`` framework (i.e. proxy models are identified 
+    with their concrete model, model names are lower-cased), but without hitting the DB.  
+    """
+    
+    opts = model_or_instance._meta.concrete_model._meta
+    return (opts.app_label, opts.object_name.lower())
+
+
+class RoleConstraints(object):
+    """
+    An index of the domain-specific constraints on parametric roles,  
+    compiled from a dictionary having the structure of the ``VALID_PARAMS_FOR_ROLES`` setting.
+    
+    For every allowed role, the index maps the names of allowed parameters to the 
+    ``(app_label, model_name)`` key of their expected type, so validating a parametric role 
+    amounts to a few dictionary lookups (no DB query is needed).
+    
+    Instances are meant to be immutable: they are built once, at startup time (see ``ROLE_CONSTRAINTS``).
+    
+    If the constraints are malformed (a parameter not declared in ``PARAM_CHOICES``, or a badly formatted 
+    model label), raise ``ImproperlyConfigured``.
+    """
+    
+    def __init__(self, valid_params_for_roles, param_choices=None):
+        allowed_param_names = None
+        if param_choices is not None:
+            allowed_param_names = set([name for (name, desc) in param_choices])
+        
+        index = {}
+        for (role_name, params) in valid_params_for_roles.items():
+            index[role_name] = {}
+            for (param_name, label) in params.items():
+                if allowed_param_names is not None and param_name not in allowed_param_names:
+                    raise ImproperlyConfigured(_(u"Parameter `%(param)s' of role %(role)s is not listed in PARAM_CHOICES") % {'param': param_name, 'role': role_name})
+                try:
+                    (app_label, model_name) = label.split('.')
+                except (ValueError, AttributeError):
+                    raise ImproperlyConfigured(_(u"`%(label)s' (type of parameter `%(param)s' of role %(role)s) is not a valid model label") % {'label': label, 'param': param_name, 'role': role_name})
+                index[role_name][param_name] = (app_label, model_name.lower())
+        self._index = index
+        self._models_checked = False
+    
+    def __len__(self):
+        return len(self._index)
+    
+    def __contains__(self, role_name):
+        return role_name in self._index
+    
+    def roles(self):
+        """
+        Return the names of allowed roles.
+        """
+        return self._index.keys()
+    
+    def allowed_params(self, role_name):
+        """
+        Return the names of parameters allowed for roles of kind ``role_name``.
+        
+        If ``role_name`` is not a valid role name, raise ``RoleNotAllowed``.
+        """
+        try:
+            return self._index[role_name].keys()
+        except KeyError:
+            raise RoleNotAllowed(role_name)
+    
+    def params_for_model(self, role_name, model):
+        """
+        Return the names of parameters allowed for roles of kind ``role_name`` 
+        which are instances of ``model`` (a model class).
+        
+        If ``role_name`` is not a valid role name, raise ``RoleNotAllowed``.
+        """
+        key = get_model_key(model)
+        return [name for name in self.allowed_params(role_name) if self._index[role_name][name] == key]
+    
+    def param_models(self):
+        """
+        Return the set of ``(app_label, model_name)`` keys of the models any parameter may be an instance of.
+        """
+        return set([key for params in self._index.values() for key in params.values()])
+    
+    def check_models(self):
+        """
+        Verify that every model referenced by the constraints is actually installed;
+        if not, raise ``ImproperlyConfigured``.
+        
+        Models can't be looked up while the app cache is being populated, so this check 
+        is performed (only once) the first time the index is used for validation.  
+        """
+        
+        if self._models_checked:
+            return
+        for (role_name, params) in self._index.items():
+            for (param_name, (app_label, model_name)) in params.items():
+                if get_model(app_label, model_name) is None:
+                    raise ImproperlyConfigured(_(u"`%(label)s' (type of parameter `%(param)s' of role %(role)s) is not an installed model") % {'label': "%s.%s" % (app_label, model_name), 'param': param_name, 'role': role_name})
+        self._models_checked = True
+    
+    def check_params(self, role_name, params, exact=True):
+        """
+        Check names and types of parameters (a dictionary of the form ``{<name>: <model instance>, ..}``) 
+        with respect to roles of kind ``role_name``.
+        
+        If ``exact`` is ``True``, every allowed parameter must be given; otherwise, any subset of 
+        allowed parameters is fine.    
+        
+        Return ``True`` if names, types (and, if ``exact`` is ``True``, number) of parameters are fine, 
+        ``False`` otherwise.  
+        
+        If ``role_name`` is not a valid role name, raise ``RoleNotAllowed``; if the name of a parameter is invalid, 
+        raise ``RoleParameterNotAllowed``.
+        """
+        
+        self.check_models()
+        try:
+            expected = self._index[role_name]
+        except KeyError:
+            raise RoleNotAllowed(role_name)
+        for (k, v) in params.items():
+            if k not in expected:
+                raise RoleParameterNotAllowed(role_name, expected.keys(), k)
+            if get_model_key(v) != expected[k]:
+                return False
+        if exact and len(params) != len(expected):
+            return False
+        return True
+    
+
+# domain-specific constraints for the current project, compiled once at startup
+ROLE_CONSTRAINTS = RoleConstraints(settings.VALID_PARAMS_FOR_ROLES, settings.PARAM_CHOICES)
@@ -57,3 +57,21 @@ class WrongPermissionCheck(Exception):
     
     
     
+class TooManyArchivedParams(Exception):
+    def __init__(self, model, limit):
+        self.model = model
+        self.limit = limit
+
+    def __str__(self):
+        return _(u"More than %(limit)s archived instances of model %(model)s are parameters of parametric roles, exceeding the limits of the DB backend: implement an `active_filter()` classmethod on the model, or enable FLEXI_AUTH_STORE_ARCHIVE_STATE") % \
+                    { 'limit' : self.limit, 'model' : self.model.__name__ }
+
+class TooManyAllowedInstances(Exception):
+    def __init__(self, model, perm, limit):
+        self.model = model
+        self.perm = perm
+        self.limit = limit
+
+    def __str__(self):
+        return _(u"Permission %(perm)s is granted on more than %(limit)s instances of model %(model)s, exceeding the limits of the DB backend: implement a `can_%(perm)s_filter()` classmethod on the model") % \
+                    { 'perm' : self.perm.lower(), 'limit' : self.limit, 'model' : self.model.__name__ }
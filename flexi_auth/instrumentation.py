@@ -0,0 +1,184 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Instrumentation of the permission-checking API, telling how much of the work done 
+(e.g. to serve a request) is spent by ``django-flexi-auth``.
+
+While a recording is active on the current thread (see ``start_recording()`` and ``stop_recording()``, 
+or ``flexi_auth.middleware.PermissionStatsMiddleware``), calls to instrumented functions 
+(``ParamRoleBackend.has_perm()``, the role-lookup helpers in ``flexi_auth.utils`` and 
+``RoleManager.get_param_roles()``) are counted, along with the SQL queries they trigger, 
+the hits and misses of the caches they look up and the (wall) time they take.  
+Nested calls are counted, but queries and time are only accounted to the outermost one, 
+so that they aren't counted twice.
+
+SQL queries can only be counted when the DB connections log them, i.e. when ``settings.DEBUG`` is ``True``
+or query logging is forced by passing ``count_queries=True`` to ``start_recording()``; 
+otherwise, the ``queries`` counter is ``None``.  When no recording is active, the overhead 
+of instrumented functions is a single attribute lookup.  
+"""
+
+from django.conf import settings
+from django.db import connections
+
+import functools
+import threading
+import time
+
+from flexi_auth.signals import permission_stats_recorded
+
+_local = threading.local()
+
+class PermissionStats(object):
+    """
+    Totals recorded on a thread, while a recording is active.
+    """
+    
+    def __init__(self, count_queries=False):
+        # number of permission checks (calls to ``ParamRoleBackend.has_perm()``)
+        self.checks = 0
+        # number of calls, by name of the instrumented function
+        self.calls = {}
+        self.queries = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # seconds
+        self.time = 0.0
+        self._depth = 0
+        self._forced = []
+        self._start_queries = None
+        # query logging is forced *before* reading the baseline, 
+        # so that connections whose log starts now are counted from zero   
+        if count_queries:
+            for conn in connections.all():
+                if not _logs_queries(conn):
+                    self._forced.append((conn, conn.use_debug_cursor))
+                    conn.use_debug_cursor = True
+        if all([_logs_queries(conn) for conn in connections.all()]):
+            self.queries = 0
+    
+    def as_dict(self):
+        return {
+            'checks' : self.checks,
+            'calls' : dict(self.calls),
+            'queries' : self.queries,
+            'cache_hits' : self.cache_hits,
+            'cache_misses' : self.cache_misses,
+            'time' : self.time,
+        }
+    
+    def __str__(self):
+        queries = self.queries is None and '?' or self.queries
+        return "checks=%s queries=%s cache_hits=%s cache_misses=%s time=%.2fms" % \
+            (self.checks, queries, self.cache_hits, self.cache_misses, self.time * 1000)
+    
+    def _restore(self):
+        for (conn, use_debug_cursor) in self._forced:
+            conn.use_debug_cursor = use_debug_cursor
+        self._forced = []
+
+
+def _logs_queries(conn):
+    # mimic the check made by ``BaseDatabaseWrapper.cursor()``
+    return conn.use_debug_cursor or (conn.use_debug_cursor is None and settings.DEBUG)
+
+def _logged_queries():
+    return sum([len(conn.queries) for conn in connections.all()])
+
+
+def start_recording(count_queries=False):
+    """
+    Start recording statistics on the current thread, discarding those of a recording 
+    still active (if any); return the ``PermissionStats`` instance they're recorded into.
+    
+    If ``count_queries`` is ``True``, DB connections are forced to log queries until the recording ends, 
+    so that they can be counted even if ``settings.DEBUG`` is ``False``. 
+    """
+    
+    previous = getattr(_local, 'stats', None)
+    if previous is not None:
+        previous._restore()
+    stats = _local.stats = PermissionStats(count_queries)
+    return stats
+
+def stop_recording(request=None):
+    """
+    Stop the recording active on the current thread and return its statistics 
+    (``None``, if no recording is active), sending the ``permission_stats_recorded`` signal; 
+    ``request`` is passed along with it.
+    """
+    
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return None
+    _local.stats = None
+    stats._restore()
+    permission_stats_recorded.send(sender=PermissionStats, stats=stats, request=request)
+    return stats
+
+def get_current_stats():
+    """
+    Return the statistics being recorded on the current thread, or ``None`` if no recording is active.
+    """
+    return getattr(_local, 'stats', None)
+
+def record_cache_lookup(hit):
+    """
+    Record a hit (if ``hit`` is ``True``) or a miss of a cache looked up by an instrumented function.
+    """
+    
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+def instrumented(name, check=False):
+    """
+    Decorator instrumenting a function (or method) under ``name``; 
+    if ``check`` is ``True``, every call is counted as a permission check.
+    """
+    
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = getattr(_local, 'stats', None)
+            if stats is None:
+                return func(*args, **kwargs)
+            
+            stats.calls[name] = stats.calls.get(name, 0) + 1
+            if check:
+                stats.checks += 1
+            if stats._depth:
+                # queries and time are accounted to the outermost call
+                return func(*args, **kwargs)
+            
+            count_queries = stats.queries is not None
+            if count_queries:
+                queries = _logged_queries()
+            stats._depth += 1
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.time += time.time() - start
+                stats._depth -= 1
+                if count_queries:
+                    stats.queries += _logged_queries() - queries
+        return wrapper
+    return decorator
@@ -0,0 +1,81 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from flexi_auth.models import ParamRole, param_role_signature
+from flexi_auth.utils import CHUNK_SIZE
+
+class Command(NoArgsCommand):
+    """
+    Compute and store the ``signature`` field for parametric roles lacking it
+    (e.g. those created before the field was introduced, or bypassing ``register_parametric_role()``).
+    
+    Parametric roles are processed in chunks (ordered by primary key), fetching 
+    their parameters with one query per chunk.  If more than one parametric role 
+    maps to the same signature, only the first of them gets it; the others 
+    are duplicates and are reported, so that they can be merged by hand.  
+    """
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', action='store', type='int', dest='chunk_size', default=CHUNK_SIZE,
+            help='Number of parametric roles processed per chunk. Defaults to %d.' % CHUNK_SIZE),
+    )
+    help = "Compute and store the canonical signature of parametric roles lacking it."
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options.get('chunk_size') or CHUNK_SIZE
+        through = ParamRole.param_set.through
+        
+        seen = set(ParamRole.objects.exclude(signature=None).values_list('signature', flat=True))
+        updated = 0
+        duplicates = []
+        
+        last_pk = 0
+        while True:
+            chunk = list(ParamRole.objects.filter(signature=None, pk__gt=last_pk)
+                         .order_by('pk').values_list('pk', 'role__name')[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1][0]
+            
+            # retrieve parameters of every parametric role in this chunk with a single query 
+            param_specs = dict((pk, []) for (pk, role_name) in chunk)
+            rows = through.objects.filter(paramrole__in=param_specs.keys()).values_list(
+                'paramrole', 'param__name', 'param__content_type', 'param__object_id')
+            for (pk, name, ct_id, obj_id) in rows:
+                param_specs[pk].append((name, ct_id, obj_id))
+            
+            for (pk, role_name) in chunk:
+                signature = param_role_signature(role_name, param_specs[pk])
+                if signature in seen:
+                    duplicates.append(pk)
+                    continue
+                seen.add(signature)
+                ParamRole.objects.filter(pk=pk).update(signature=signature)
+                updated += 1
+        
+        if verbosity >= 1:
+            self.stdout.write("Signature set for %d parametric role(s).\n" % updated)
+            if duplicates:
+                self.stdout.write("Duplicated parametric roles left without a signature (IDs): %s\n" % 
+                                  ", ".join([str(pk) for pk in duplicates]))
@@ -0,0 +1,111 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+
+class Command(NoArgsCommand):
+    """
+    Generate a synthetic dataset on a throw-away test database and time the main entry points 
+    of the API against it (see ``flexi_auth.benchmarks``).
+    
+    Results can be written to a JSON file (``--output``) and compared against a baseline 
+    written by a previous run (``--baseline``): if a benchmark got slower by more than ``--tolerance``, 
+    or performs more queries, the command fails.  Since the test models are needed, 
+    ``flexi_auth.tests`` must be installed (e.g. run with ``--settings=flexi_auth.tests.settings``).
+    """
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--param-roles', action='store', type='int', dest='param_roles', default=1000,
+            help='Number of parametric roles to generate. Defaults to 1000.'),
+        make_option('--users', action='store', type='int', dest='users', default=None,
+            help='Number of users to generate. Defaults to the number of parametric roles.'),
+        make_option('--groups', action='store', type='int', dest='groups', default=None,
+            help='Number of groups to generate. Defaults to a tenth of the users.'),
+        make_option('--memberships', action='store', type='int', dest='memberships', default=None,
+            help='Number of group memberships to generate. Defaults to twice the number of users.'),
+        make_option('--seed', action='store', type='int', dest='seed', default=0,
+            help='Seed of the random number generator. Defaults to 0.'),
+        make_option('--repeat', action='store', type='int', dest='repeat', default=3,
+            help='Number of times each benchmark is run. Defaults to 3.'),
+        make_option('--number', action='store', type='int', dest='number', default=100,
+            help='Number of operations performed by each run of a benchmark. Defaults to 100.'),
+        make_option('--benchmark', action='append', dest='benchmarks', default=None,
+            help='Run only the given benchmark (can be used multiple times).'),
+        make_option('--output', action='store', dest='output', default=None,
+            help='Write results to this (JSON) file.'),
+        make_option('--baseline', action='store', dest='baseline', default=None,
+            help='Compare results against those stored in this (JSON) file.'),
+        make_option('--tolerance', action='store', type='float', dest='tolerance', default=None,
+            help='Slowdown (as a fraction of the baseline) tolerated before flagging a regression. Defaults to 0.25.'),
+    )
+    help = "Time the permission-checking API against a synthetic dataset."
+
+    def handle_noargs(self, **options):
+        if 'flexi_auth.tests' not in settings.INSTALLED_APPS:
+            raise CommandError("Benchmarks need the test models: add 'flexi_auth.tests' to INSTALLED_APPS "
+                               "(or run with --settings=flexi_auth.tests.settings).")
+        
+        # local imports, since they need the test models to be installed
+        from flexi_auth.benchmarks.dataset import generate_dataset
+        from flexi_auth.benchmarks.runner import BENCHMARKS, DEFAULT_TOLERANCE, run_benchmarks, write_results,\
+            read_results, compare_results
+        
+        verbosity = int(options.get('verbosity', 1))
+        names = options.get('benchmarks')
+        if names:
+            unknown = set(names).difference([name for (name, bench) in BENCHMARKS])
+            if unknown:
+                raise CommandError("Unknown benchmark(s): %s" % ", ".join(sorted(unknown)))
+        tolerance = options.get('tolerance')
+        if tolerance is None:
+            tolerance = DEFAULT_TOLERANCE
+        baseline = options.get('baseline') and read_results(options['baseline'])
+        
+        # just like the test runner, use a throw-away DB and don't log queries
+        debug = settings.DEBUG
+        settings.DEBUG = False
+        old_name = settings.DATABASES['default']['NAME']
+        connection.creation.create_test_db(verbosity=max(verbosity - 1, 0), autoclobber=True)
+        try:
+            if verbosity >= 1:
+                self.stdout.write("Generating dataset...\n")
+            dataset = generate_dataset(param_roles=options['param_roles'], users=options.get('users'), 
+                                       groups=options.get('groups'), memberships=options.get('memberships'), 
+                                       seed=options['seed'])
+            results = run_benchmarks(dataset, names=names, repeat=options['repeat'], 
+                                     number=options['number'], seed=options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=max(verbosity - 1, 0))
+            settings.DEBUG = debug
+        
+        if verbosity >= 1:
+            for (name, result) in sorted(results['results'].items()):
+                self.stdout.write("%-28s best %10.3fms  median %10.3fms  %6.2f queries\n" % 
+                                  (name, result['best'] * 1000, result['median'] * 1000, result['queries']))
+        if options.get('output'):
+            write_results(results, options['output'])
+        
+        if baseline:
+            if baseline['meta']['sizes'] != results['meta']['sizes'] and verbosity >= 1:
+                self.stdout.write("Warning: the baseline was measured on a dataset of different sizes.\n")
+            regressions = compare_results(results, baseline, tolerance)
+            if regressions:
+                raise CommandError("Performance regression(s): %s" % 
+                                   ", ".join(["%s (%s: %.6g -> %.6g)" % r for r in regressions]))
@@ -0,0 +1,55 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db.models import get_models
+
+from flexi_auth.registry import PERMISSION_REGISTRY
+
+class Command(NoArgsCommand):
+    """
+    List the permissions supported by each installed model (i.e. its ``can_<perm>`` methods), 
+    as found in the registry used by ``ParamRoleBackend`` to dispatch permission checks.
+    
+    With ``--check``, batched/queryset-level hooks (``can_<perm>_many``, ``can_<perm>_filter``) 
+    lacking the corresponding ``can_<perm>`` method are reported as errors, 
+    so that typos can be caught at deploy time.   
+    """
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--check', action='store_true', dest='check', default=False,
+            help='Fail if a model defines permission hooks without the corresponding check.'),
+    )
+    help = "List the permissions supported by each installed model."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        
+        if verbosity >= 1:
+            for (model, perms) in sorted(PERMISSION_REGISTRY.items(), key=lambda item: item[0]._meta.db_table):
+                self.stdout.write("%s.%s: %s\n" % (model._meta.app_label, model._meta.object_name, 
+                                  ", ".join(["%s (%s)" % (perm, kind) for (perm, kind) in sorted(perms.items())])))
+        
+        errors = []
+        if options.get('check'):
+            for model in get_models():
+                errors.extend(["%s.%s.%s" % (model._meta.app_label, model._meta.object_name, name) 
+                               for name in PERMISSION_REGISTRY.orphaned_hooks(model)])
+        
+        if errors:
+            raise CommandError("Permission hooks without a corresponding check: %s" % ", ".join(errors))
@@ -0,0 +1,49 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from flexi_auth.models import ParamRole
+from flexi_auth.utils import CHUNK_SIZE
+
+class Command(NoArgsCommand):
+    """
+    Recompute the stored archive state (the ``active`` field) of every parametric role 
+    (see ``ParamRole.update_archive_state()``).
+    
+    This is needed when ``settings.FLEXI_AUTH_STORE_ARCHIVE_STATE`` is first enabled, 
+    and whenever parameter objects are modified bypassing their ``.save()`` method 
+    (e.g. via ``QuerySet.update()``), since no signal is sent in that case.  
+    """
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', action='store', type='int', dest='chunk_size', default=CHUNK_SIZE,
+            help='Number of parametric roles processed per chunk. Defaults to %d.' % CHUNK_SIZE),
+    )
+    help = "Recompute the stored archive state of parametric roles."
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options.get('chunk_size') or CHUNK_SIZE
+        
+        updated = ParamRole.update_archive_state(chunk_size=chunk_size)
+        
+        if verbosity >= 1:
+            self.stdout.write("Archive state updated for %d parametric role(s).\n" % updated)
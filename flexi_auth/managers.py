@@ -15,12 +15,17 @@
 # along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
 
 from django.db import models
-from django.db.models import ObjectDoesNotExist
 from django.contrib.contenttypes.models import ContentType
-from django.conf import settings
 
-from flexi_auth.exceptions import RoleNotAllowed, RoleParameterNotAllowed, RoleParameterWrongSpecsProvided
+from flexi_auth.exceptions import RoleParameterWrongSpecsProvided
+from flexi_auth.constraints import ROLE_CONSTRAINTS
 from flexi_auth.query import RoleQuerySet 
+from flexi_auth.cache import get_shared_cache, get_param_role_ids
+from flexi_auth.instrumentation import instrumented
+
+# maximum number of IDs of parametric roles matching a ``.get_param_roles()`` lookup kept in the shared cache; 
+# just as ``flexi_auth.utils.CHUNK_SIZE``, it's safely below the limits on SQL variables imposed by some DB backends    
+MAX_CACHED_IDS = 100
 
 class RoleManager(models.Manager):
     """ 
@@ -38,6 +43,21 @@ class RoleManager(models.Manager):
         """
         return RoleQuerySet(self.model)
     
+    def with_params(self):
+        """
+        Return all parametric roles, along with their parameters 
+        (see ``RoleQuerySet.with_params()``).
+        """
+        return self.get_query_set().with_params()
+    
+    def for_object(self, obj):
+        """
+        Return all parametric roles having the model instance ``obj`` as a parameter 
+        (see ``RoleQuerySet.for_object()``).
+        """
+        return self.get_query_set().for_object(obj)
+    
+    @instrumented('get_param_roles')
     def get_param_roles(self, role_name, **params):
         """
         This method retrieves the parametric roles satisfying the criteria provided as input.
@@ -62,44 +82,33 @@ class RoleManager(models.Manager):
         
         If provided parameter names are valid, but one of them is assigned to a wrong type,
         (based on domain constraints), raises  ``RoleParameterWrongSpecsProvided`` exception.
+        
+        The returned ``QuerySet`` is lazy, unless the shared cache tier is enabled (see ``settings.FLEXI_AUTH_CACHE``): 
+        in that case, IDs of matching parametric roles are looked up when this method is called 
+        (from the cache or, on a miss, by a query), and the returned ``QuerySet`` selects them by primary key.
+        If there are more than ``MAX_CACHED_IDS`` of them, the lazy ``QuerySet`` is returned instead, 
+        so that no unbounded list of IDs is passed to an ``__in`` lookup.
                   
         """
         
-        from flexi_auth.utils import get_ctype_from_model_label
+        # sanity checks (performed against the constraint index, so they don't hit the DB)
+        if not ROLE_CONSTRAINTS.check_params(role_name, params, exact=False):
+            raise RoleParameterWrongSpecsProvided(role_name, params)
+        param_ctypes = dict([(k, ContentType.objects.get_for_model(v)) for (k, v) in params.items()])
         
-        # sanity checks
-        try: 
-            allowed_param_names = settings.VALID_PARAMS_FOR_ROLES[role_name].keys()
-        except KeyError:
-            raise RoleNotAllowed(role_name)
-        for k in params.keys():
-            if k not in allowed_param_names: 
-                raise RoleParameterNotAllowed(role_name, allowed_param_names, k)
-            expected_ctype = get_ctype_from_model_label(settings.VALID_PARAMS_FOR_ROLES[role_name][k])
-            actual_ctype = ContentType.objects.get_for_model(params[k])
-            if expected_ctype != actual_ctype:
-                raise RoleParameterWrongSpecsProvided(role_name, params)                 
-        
-        pr_list = []
         # filter out parametric roles of the right type
-        p_roles = self.get_query_set().filter(role__name__exact=role_name)
-        # select only parametric roles whose parameters are compatible with those specified as input
-        for pr in p_roles:
-            # a flag used to exclude roles with a mis-matching parameter set 
-            match = True
-            for (k, v) in params.items():
-                try:
-                    #parameter name match, but value don't 
-                    if not pr.param_set.get(name=k).value == v:
-                        match = False
-                # in case a parameter has a globally valid name, but not in this role's context
-                except ObjectDoesNotExist:  
-                    raise RoleParameterWrongSpecsProvided(role_name, params)
-            # all tests were passed, so this parametric role matches with the query
-            if match:
-                pr_list.append(pr)
-                
-        qs = self.filter(pk__in=[obj.pk for obj in pr_list])
+        qs = self.get_query_set().filter(role__name__exact=role_name)
+        # select only parametric roles whose parameters are compatible with those specified as input;
+        # the whole lookup compiles to a single (lazy) SQL query.
+        qs = qs.with_param_values(**params)
+        
+        if get_shared_cache() is not None:
+            # IDs of matching parametric roles are cached, so only retrieving them costs a query 
+            param_specs = [(k, param_ctypes[k].pk, v.pk) for (k, v) in params.items()]
+            # at most ``MAX_CACHED_IDS + 1`` IDs are retrieved (and cached): one more tells there are too many of them
+            ids = get_param_role_ids(role_name, param_specs, lambda: list(qs.values_list('pk', flat=True)[:MAX_CACHED_IDS + 1]))
+            if len(ids) <= MAX_CACHED_IDS:
+                qs = self.get_query_set().filter(pk__in=ids)
         return qs
    
    ##--------------- Archive API --------------##      
@@ -110,7 +119,7 @@ class RoleManager(models.Manager):
         Signature and behaviour are the same as those of the ``.get_param_roles()`` method above.      
         
         """
-        return self.get_param_roles(self, role_name, **params).active()
+        return self.get_param_roles(role_name, **params).active()
     
     def archived(self, role_name, **params):
         """
@@ -119,7 +128,7 @@ class RoleManager(models.Manager):
         Signature and behaviour are the same as those of the ``.get_param_roles()`` method above.      
         
         """
-        return self.get_param_roles(self, role_name, **params).archived()
+        return self.get_param_roles(role_name, **params).archived()
     
     ##---------------------------------------##
 
@@ -0,0 +1,49 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf import settings
+
+import logging
+
+from flexi_auth.instrumentation import start_recording, stop_recording
+
+logger = logging.getLogger('flexi_auth')
+
+class PermissionStatsMiddleware(object):
+    """
+    Record statistics about permission checks made while serving each request 
+    (see ``flexi_auth.instrumentation``), and attach them to the request as ``request.flexi_auth_stats``.
+    
+    When the response is ready, the ``permission_stats_recorded`` signal is sent and the totals are logged 
+    (at the ``DEBUG`` level) by the ``flexi_auth`` logger; if ``settings.FLEXI_AUTH_STATS_HEADER`` is set, 
+    they're also added to the response as a header with that name. 
+    If ``settings.FLEXI_AUTH_STATS_QUERIES`` is ``True``, SQL queries are counted even if ``settings.DEBUG`` is ``False``.
+    
+    Put it as close to the top of ``MIDDLEWARE_CLASSES`` as possible, so that checks made 
+    by other middleware are recorded too.
+    """
+    
+    def process_request(self, request):
+        request.flexi_auth_stats = start_recording(getattr(settings, 'FLEXI_AUTH_STATS_QUERIES', False))
+    
+    def process_response(self, request, response):
+        stats = stop_recording(request)
+        if stats is not None:
+            logger.debug("%s %s: %s", request.method, request.path, stats)
+            header = getattr(settings, 'FLEXI_AUTH_STATS_HEADER', None)
+            if header:
+                response[header] = str(stats)
+        return response
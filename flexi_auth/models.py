@@ -27,8 +27,12 @@ from django.contrib.contenttypes import generic
 from permissions.models import Role
 
 from flexi_auth.managers import RoleManager
+from flexi_auth.cache import get_shared_cache, bump_generations
+from flexi_auth.constraints import ROLE_CONSTRAINTS, get_model_key
+from flexi_auth.query import archive_state_stored, effective_roles_stored
 
 import functools 
+import hashlib
 
 ROLES_DICT = dict(settings.ROLES_LIST)
 
@@ -56,6 +60,11 @@ class PermissionBase(object):
     so if a permission-enabled model class (one inheriting from
     ``PermissionBase``) doesn't override any of them, every user 
     is automatically granted the corresponding permissions.
+    
+    Row-level permissions also come with a batched counterpart, ``can_<perm>_many()``,
+    checking many instances at once (see ``flexi_auth.backends.has_perm_many()``);   
+    a batched check is only used along with the ``can_<perm>`` method it was written for,
+    so overriding the latter without the former is safe. 
     """
     # TODO: improve docstring
     
@@ -80,6 +89,24 @@ class PermissionBase(object):
     def can_delete(self, user, context):
         return True
     
+    # Batched row-level permissions: they return the set of instances (among ``instances``)
+    # on which the permission is granted  
+    @classmethod
+    def can_list_many(cls, instances, user, context):
+        return set(instances)
+    
+    @classmethod
+    def can_view_many(cls, instances, user, context):
+        return set(instances)
+    
+    @classmethod
+    def can_edit_many(cls, instances, user, context):
+        return set(instances)
+    
+    @classmethod
+    def can_delete_many(cls, instances, user, context):
+        return set(instances)
+    
        
 class Param(models.Model):
     """
@@ -100,10 +127,46 @@ class Param(models.Model):
         return "<%s %s: %s>" % (self.__class__.__name__, self.name, self.value)
     
     class Meta:
-        # forbid duplicated ``Param`` entries in the DB
-        unique_together = ('name', 'content_type', 'object_id')
+        # forbid duplicated ``Param`` entries in the DB; 
+        # the underlying (composite) index leads with ``(content_type, object_id)``, 
+        # so it also serves lookups of the parameters bound to a given object
+        unique_together = ('content_type', 'object_id', 'name')
         verbose_name = _('Parameter')
         verbose_name_plural = _('Parameters')
+
+def resolve_param_values(params):
+    """
+    Resolve the values of the given parameters (an iterable of ``Param`` instances) in batches. 
+    
+    Parameters are grouped by content type, and values of each group are retrieved 
+    via a single ``.in_bulk()`` query; then, each value is stored into the cache of the 
+    ``Param.value`` generic foreign key, so that subsequent accesses to it don't hit the DB.
+    This way, the number of queries depends on the number of *distinct* types of parameters, 
+    not on the number of parameters.  
+    
+    Parameters whose value is already cached are skipped. 
+    
+    Return the list of passed parameters.  
+    """
+    
+    params = list(params)
+    cache_attr = Param.value.cache_attr
+    ids_by_ctype = {}
+    for p in params:
+        if not hasattr(p, cache_attr):
+            ids_by_ctype.setdefault(p.content_type_id, set()).add(p.object_id)
+    
+    values = {}
+    for (ct_id, ids) in ids_by_ctype.items():
+        # ``ContentType`` instances are cached, so this doesn't usually hit the DB
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        for (pk, obj) in model._default_manager.in_bulk(list(ids)).items():
+            values[(ct_id, pk)] = obj
+    
+    for p in params:
+        if not hasattr(p, cache_attr):
+            setattr(p, cache_attr, values.get((p.content_type_id, p.object_id)))
+    return params 
         
 def param_by_name(cls):
     """
@@ -137,11 +200,12 @@ def param_by_name(cls):
         else, raise an ``AttributeError`` exception.
         """
 
-        try: 
-            return p_role.param_set.get(name=name).value
-        except Param.DoesNotExist:
-            role_name = p_role.role.name
-            raise AttributeError(_(u"The parametric role %(p_role)s doesn't have a `%(name)s' parameter") % {'p_role': p_role, 'name': name})    
+        # scan the whole parameter set, instead of filtering it by name, 
+        # so that parameters prefetched via ``RoleQuerySet.with_params()`` are used
+        for param in p_role.params:
+            if param.name == name:
+                return param.value
+        raise AttributeError(_(u"The parametric role %(p_role)s doesn't have a `%(name)s' parameter") % {'p_role': p_role, 'name': name})    
    
     for name in allowed_params:
         # prevent overriding of existing class attributes
@@ -163,6 +227,32 @@ def param_by_name(cls):
         setattr(cls, name, p)
     return cls
 
+def param_role_signature(role_name, param_specs):
+    """
+    Return the canonical signature of a parametric role.
+    
+    ``role_name`` is the name of the basic ``Role``; ``param_specs`` is an iterable of 
+    ``(name, content_type_id, object_id)`` triples, one for each parameter bound to the role.
+    
+    The signature is a SHA-1 digest of the role name followed by the sorted triples, 
+    so two parametric roles have the same signature iff they are of the same kind and 
+    have the same set of parameters (regardless of the order they were given in).
+    Since it only depends on DB IDs, computing it doesn't require generic relations 
+    to be resolved.     
+    """
+    
+    triples = sorted((name, int(ct_id), int(obj_id)) for (name, ct_id, obj_id) in param_specs)
+    canonical = u"|".join([role_name] + [u"%s:%s:%s" % t for t in triples])
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+    
+def _param_specs_from_dict(params):
+    """
+    Convert a dictionary of parameters (of the form ``{<name>: <model instance>, ..}``) 
+    to the list of ``(name, content_type_id, object_id)`` triples expected by ``param_role_signature()``.
+    """
+    
+    return [(k, ContentType.objects.get_for_model(v).pk, v.pk) for (k, v) in params.items()]
+
 @param_by_name
 class ParamRole(models.Model):
     """
@@ -177,15 +267,23 @@ class ParamRole(models.Model):
     role = models.ForeignKey(Role)
     # parameters describing the context attached to this role 
     param_set = models.ManyToManyField(Param)    
+    # canonical representation of role kind and parameters (see ``param_role_signature()``);
+    # it allows duplicate detection and exact-match lookups via a single indexed query 
+    signature = models.CharField(max_length=40, unique=True, null=True, blank=True, editable=False)
+    # stored archive state (see ``.update_archive_state()``); 
+    # it's kept up-to-date only if ``settings.FLEXI_AUTH_STORE_ARCHIVE_STATE`` is enabled 
+    active = models.BooleanField(default=True, db_index=True, editable=False)
 
     objects = RoleManager()
 
     def __unicode__(self):
-        param_str_list = ["%s" % s for s in self.params]
+        param_str_list = ["%s" % s for s in resolve_param_values(self.params)]
         return _(u"%(role)s for %(params)s") % { 'role' : ROLES_DICT[self.role.name], 'params':  ", ".join(param_str_list)}
     
     @property
     def params(self):
+        # if parameters were prefetched (see ``RoleQuerySet.with_params()``),  
+        # this returns them without hitting the DB
         return self.param_set.all()
     
     @property
@@ -202,11 +300,28 @@ class ParamRole(models.Model):
             raise Param.MultipleObjectsReturned(_("This parametric role has more than one parameter: %s") % params)
         return params[0]   
     
+    def compute_signature(self):
+        """
+        Compute the signature of this parametric role from its current set of parameters
+        (see ``param_role_signature()``).
+        
+        Note that this method doesn't update the ``signature`` field.  
+        """
+        
+        param_specs = self.param_set.values_list('name', 'content_type', 'object_id')
+        return param_role_signature(self.role.name, param_specs)
+    
     @classmethod
     def get_role(cls, role_name, **params):
         """
         Return the (unique) parametric role matching criteria provided as input arguments.
         
+        If ``params`` specify *all* the parameters allowed for roles of kind ``role_name``,  
+        the lookup is an exact match performed through the ``signature`` field; signatures are kept 
+        up-to-date when parameters are added to/removed from a parametric role, but parametric roles 
+        whose parameters were bound bypassing signals (e.g. via raw SQL) need their signature 
+        to be set (see the ``backfill_param_role_signatures`` management command).
+        
         Exceptions 
         ==========
         * If no parametric role matches these criteria, raise ``ObjectDoesNotExist``.
@@ -217,10 +332,20 @@ class ParamRole(models.Model):
           (based on domain constraints), raises  ``RoleParameterWrongSpecsProvided`` exception.                  
         """
         
+        # sanity checks on input arguments go through the constraint index, so they don't hit the DB 
+        if ROLE_CONSTRAINTS.check_params(role_name, params, exact=True):
+            signature = param_role_signature(role_name, _param_specs_from_dict(params))
+            return cls.objects.get(signature=signature)
+        
+        # this raises an exception if a parameter has a wrong type; note that, if the shared cache tier
+        # is enabled, IDs of matching roles are looked up here (see ``RoleManager.get_param_roles()``)
         qs = cls.objects.get_param_roles(role_name, **params)
-        if len(qs) > 1:
+        p_roles = list(qs[:2])
+        if len(p_roles) > 1:
             raise cls.MultipleObjectsReturned(_("Warning: duplicate parametric role instances in the DB: %(role)s with params %(params)s") % {'role': role_name, 'params': params}) 
-        return qs[0]
+        elif not p_roles:
+            raise cls.DoesNotExist(_("No parametric role %(role)s with params %(params)s") % {'role': role_name, 'params': params})
+        return p_roles[0]
 
     def add_principal(self, principal):
         """
@@ -269,22 +394,27 @@ class ParamRole(models.Model):
         
         In turn, to specify the relevant semantic for a model 
         (i.e. define when an instance of it is to be considered as 'active'),
-        you need to implement an ``.is_active()`` instance method on the model class.                
+        you need to implement an ``.is_active()`` instance method on the model class.
+        Models may also implement an ``.active_filter()`` classmethod, returning a ``Q`` 
+        object selecting their active instances, so that active/archived parametric roles 
+        can be retrieved via SQL (see ``RoleQuerySet.active()``); 
+        if a model only implements the latter, it's used for the instance check, too.  
+        
+        Parameters whose model doesn't implement the 'archive API' are considered 
+        to be active, by convention.                
         """
         
         # A role is active iff **all** its parameters are active
-        is_active = True
-        for p in self.params:
+        for p in resolve_param_values(self.params):
+            value = p.value
             # delegate the "activity" check to the parameter's model instance
-            try:
-                if not p.value.is_active():
-                    is_active = False
-                    break
-            except NameError: 
-                # Archive API is not implemented by that model, so assume that 
-                # every instance is active by convention
-                return True                
-        return is_active             
+            if callable(getattr(value, 'is_active', None)):
+                if not value.is_active():
+                    return False
+            elif hasattr(value, 'active_filter'):
+                if not value.__class__._default_manager.filter(value.active_filter(), pk=value.pk).exists():
+                    return False
+        return True             
     
     @property
     def is_archived(self):
@@ -304,7 +434,40 @@ class ParamRole(models.Model):
         # allowed states for a parametric role, so they are mutually esclusive; 
         # if this assumption is invalid, a more general implementation may be needed 
         # (such as that of the ``.is_active()`` method above).   
-        return not self.is_active()  
+        return not self.is_active  
+    
+    @classmethod
+    def update_archive_state(cls, queryset=None, chunk_size=None):
+        """
+        Recompute the stored archive state (the ``active`` field) of the parametric roles 
+        in ``queryset`` (by default, of all of them).
+        
+        Parametric roles are processed in chunks of ``chunk_size`` items (by default, 
+        ``flexi_auth.utils.CHUNK_SIZE``), ordered by primary key, loading their parameters via ``RoleQuerySet.with_params()``; only roles whose state 
+        actually changed are updated, with (at most) two ``UPDATE`` queries per chunk.
+        
+        Return the number of updated parametric roles.
+        """
+        
+        # local import, to avoid circular dependencies
+        from flexi_auth.utils import CHUNK_SIZE
+        
+        chunk_size = chunk_size or CHUNK_SIZE
+        if queryset is None:
+            queryset = cls.objects.all()
+        queryset = queryset.order_by('pk')
+        updated = 0
+        last_pk = 0
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk).with_params()[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            for state in (True, False):
+                pks = [p_role.pk for p_role in chunk if p_role.is_active == state and p_role.active != state]
+                if pks:
+                    updated += cls.objects.filter(pk__in=pks).update(active=state)
+        return updated
     
     ##---------------------------------------##
     
@@ -359,6 +522,37 @@ class PrincipalParamRoleRelation(models.Model):
 
     principal = property(get_principal, set_principal)    
     
+class EffectiveParamRole(models.Model):
+    """
+    A materialized view of the parametric roles *effectively* held by users, 
+    i.e. assigned to them either directly or via a group they belong to.
+
+    user
+        The user holding the parametric role.
+
+    role
+        The parametric role (a ``ParamRole`` instance) held by the user.
+
+    via_group
+        The group from which the user gets the parametric role, or ``None`` 
+        if the role was assigned directly to the user.
+        
+    Rows are maintained incrementally (on changes to role assignments and group memberships) 
+    only if ``settings.FLEXI_AUTH_EFFECTIVE_ROLES`` is enabled; 
+    the ``rebuild_effective_param_roles`` management command rebuilds them from scratch.
+    """
+    
+    user = models.ForeignKey(User, related_name="effective_param_role_set")
+    role = models.ForeignKey(ParamRole, related_name="effective_set")
+    via_group = models.ForeignKey(Group, blank=True, null=True, related_name="+")
+    
+    def __unicode__(self):
+        return _("%(user)s is %(role)s") % { 'user' : self.user, 'role' : self.role }
+    
+    class Meta:
+        # the underlying index allows retrieving the roles of a user via an index scan 
+        unique_together = ('user', 'role', 'via_group')
+    
 def setup_roles(sender, instance, created, **kwargs):
     """
     Setup any needed parametric role after a model instance is saved to the DB for the first time.
@@ -376,4 +570,226 @@ def setup_roles(sender, instance, created, **kwargs):
             pass
 
 # add the ``setup_roles()`` function as a listener for the ``post_save`` signal
-signals.post_save.connect(setup_roles)     
+signals.post_save.connect(setup_roles)
+
+def invalidate_roles_cache(sender, instance, **kwargs):
+    """
+    Invalidate cached parametric roles of a principal (see ``flexi_auth.utils.get_all_parametric_roles()``)
+    whenever a parametric role is assigned to/removed from it.
+    """
+    
+    from flexi_auth.utils import invalidate_parametric_roles_cache
+    
+    invalidate_parametric_roles_cache()
+    if instance.user_id:
+        bump_generations([('user', instance.user_id)])
+    if instance.group_id:
+        bump_generations([('group', instance.group_id)])
+
+def invalidate_group_membership_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidate cached parametric roles of users whose group memberships changed.
+    """
+    
+    from flexi_auth.utils import invalidate_parametric_roles_cache
+    
+    if action == 'pre_clear' and reverse and get_shared_cache() is not None:
+        # users leaving the group are needed after the relation has been cleared 
+        instance._cleared_user_ids = list(instance.user_set.values_list('pk', flat=True))
+    if not action.startswith('post_'):
+        return
+    
+    invalidate_parametric_roles_cache()
+    if not reverse:
+        user_ids = [instance.pk]
+    elif action == 'post_clear':
+        user_ids = instance.__dict__.pop('_cleared_user_ids', [])
+    else:
+        user_ids = pk_set
+    bump_generations([('user', pk) for pk in user_ids])
+
+def invalidate_param_roles_cache(sender, instance, **kwargs):
+    """
+    Invalidate cached results of ``RoleManager.get_param_roles()`` whenever parametric roles
+    (or their parameters) change.
+    """
+    
+    if get_shared_cache() is None:
+        return
+    action = kwargs.get('action', 'post_')
+    if not action.startswith('post_'):
+        return 
+    
+    if isinstance(instance, ParamRole):
+        try:
+            role_names = [instance.role.name]
+        except Role.DoesNotExist:
+            # the basic role is being deleted, too
+            role_names = ROLES_DICT.keys()
+    elif action in ('post_add', 'post_remove'):
+        # parametric roles were added to/removed from a parameter 
+        role_names = set(ParamRole.objects.filter(pk__in=kwargs['pk_set']).values_list('role__name', flat=True))
+    else:
+        # a parameter was deleted, or all its parametric roles were removed   
+        role_names = ROLES_DICT.keys()
+    bump_generations([('role', name) for name in role_names])
+
+def track_effective_roles(sender, instance, **kwargs):
+    """
+    Before an existing role assignment is saved, remember the principal and the role 
+    it used to refer to, so that ``update_effective_roles()`` can move the 
+    effective parametric roles of users along with it.
+    """
+    
+    if not effective_roles_stored() or instance.pk is None:
+        return
+    old = sender._default_manager.filter(pk=instance.pk).values_list('user', 'group', 'role')
+    if old:
+        instance.__dict__['_old_principal_role'] = tuple(old[0])
+
+def update_effective_roles(sender, instance, **kwargs):
+    """
+    Update the effective parametric roles of users (see ``EffectiveParamRole``) 
+    whenever a parametric role is assigned to/removed from a principal, 
+    or an existing assignment is changed to refer to another principal or role.
+    """
+    
+    from flexi_auth.utils import _add_effective_param_roles, _remove_effective_param_roles
+    
+    if not effective_roles_stored():
+        return
+    user_ids = instance.user_id and [instance.user_id] or []
+    group_ids = instance.group_id and [instance.group_id] or []
+    if 'created' not in kwargs:
+        _remove_effective_param_roles(user_ids, group_ids, [instance.role_id])
+    elif kwargs['created']:
+        _add_effective_param_roles(user_ids, group_ids, [instance.role_id])
+    else:
+        old = instance.__dict__.pop('_old_principal_role', None)
+        if old is None or old == (instance.user_id, instance.group_id, instance.role_id):
+            return
+        (old_user_id, old_group_id, old_role_id) = old
+        _remove_effective_param_roles(old_user_id and [old_user_id] or [], 
+                                      old_group_id and [old_group_id] or [], [old_role_id])
+        _add_effective_param_roles(user_ids, group_ids, [instance.role_id])
+
+def update_effective_roles_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Update the effective parametric roles of users (see ``EffectiveParamRole``) 
+    whenever their group memberships change; only the rows of the affected 
+    users and groups are touched.
+    """
+    
+    from flexi_auth.utils import _add_group_memberships
+    
+    if not effective_roles_stored() or action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_add':
+        if reverse:
+            _add_group_memberships([(user_id, instance.pk) for user_id in pk_set])
+        else:
+            _add_group_memberships([(instance.pk, group_id) for group_id in pk_set])
+        return
+    
+    if reverse:
+        rows = EffectiveParamRole.objects.filter(via_group=instance)
+        if action == 'post_remove':
+            rows = rows.filter(user__in=pk_set)
+    else:
+        rows = EffectiveParamRole.objects.filter(user=instance, via_group__isnull=False)
+        if action == 'post_remove':
+            rows = rows.filter(via_group__in=pk_set)
+    rows.delete()
+
+def update_archive_state_on_param_save(sender, instance, raw=False, **kwargs):
+    """
+    When an instance of a model implementing the 'archive API' is saved, recompute the stored 
+    archive state of the parametric roles it's a parameter of (if ``settings.FLEXI_AUTH_STORE_ARCHIVE_STATE`` is enabled).
+    
+    Those roles are found via the ``(content_type, object_id)`` fields of their parameters.
+    """
+    
+    if raw or not archive_state_stored():
+        return
+    if get_model_key(sender) not in ROLE_CONSTRAINTS.param_models():
+        return
+    if not (callable(getattr(sender, 'is_active', None)) or hasattr(sender, 'active_filter')):
+        return
+    ct = ContentType.objects.get_for_model(sender)
+    through = ParamRole.param_set.through
+    pks = through.objects.filter(param__content_type=ct, param__object_id=instance.pk).values('paramrole')
+    ParamRole.update_archive_state(ParamRole.objects.filter(pk__in=pks))
+
+def update_signatures(pks):
+    """
+    Recompute the stored signature of the parametric roles with the given primary keys, 
+    based on their current parameters.  
+    
+    If the new signature of a parametric role is already taken by another one, 
+    the former is a duplicate, and it's left without a signature 
+    (just as the ``backfill_param_role_signatures`` management command does).
+    """
+    
+    # local import, to avoid circular dependencies
+    from flexi_auth.utils import _chunks
+    
+    for chunk in _chunks(pks):
+        rows = ParamRole.objects.filter(pk__in=chunk).values_list('pk', 'role__name', 'signature', 
+            'param_set__name', 'param_set__content_type', 'param_set__object_id')
+        roles = {}
+        for (pk, role_name, signature, name, ct_id, obj_id) in rows:
+            specs = roles.setdefault(pk, (role_name, signature, []))[2]
+            if name is not None:
+                specs.append((name, ct_id, obj_id))
+        for (pk, (role_name, signature, specs)) in roles.items():
+            new_signature = param_role_signature(role_name, specs)
+            if new_signature == signature:
+                continue
+            if ParamRole.objects.filter(signature=new_signature).exclude(pk=pk).exists():
+                new_signature = None
+            ParamRole.objects.filter(pk=pk).update(signature=new_signature)
+
+def update_signature_on_params_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep the signature of parametric roles in sync with their parameters, whenever these change.
+    """
+    
+    if action == 'pre_clear' and reverse:
+        # parametric roles losing the parameter are needed after the relation has been cleared 
+        instance._cleared_param_role_ids = list(instance.paramrole_set.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        update_signatures([instance.pk])
+    elif action == 'post_clear':
+        update_signatures(instance.__dict__.pop('_cleared_param_role_ids', []))
+    elif pk_set:
+        update_signatures(pk_set)
+
+def update_archive_state_on_params_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    When the parameters bound to parametric roles change, recompute their stored archive state
+    (if ``settings.FLEXI_AUTH_STORE_ARCHIVE_STATE`` is enabled).
+    """
+    
+    if not archive_state_stored() or action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        ParamRole.update_archive_state(ParamRole.objects.filter(pk=instance.pk))
+    elif pk_set:
+        ParamRole.update_archive_state(ParamRole.objects.filter(pk__in=pk_set))
+
+signals.post_save.connect(invalidate_roles_cache, sender=PrincipalParamRoleRelation)
+signals.post_delete.connect(invalidate_roles_cache, sender=PrincipalParamRoleRelation)
+signals.m2m_changed.connect(invalidate_group_membership_cache, sender=User.groups.through)
+signals.post_save.connect(invalidate_param_roles_cache, sender=ParamRole)
+signals.post_delete.connect(invalidate_param_roles_cache, sender=ParamRole)
+signals.post_delete.connect(invalidate_param_roles_cache, sender=Param)
+signals.m2m_changed.connect(invalidate_param_roles_cache, sender=ParamRole.param_set.through)
+signals.post_save.connect(update_archive_state_on_param_save)
+signals.m2m_changed.connect(update_archive_state_on_params_change, sender=ParamRole.param_set.through)
+signals.m2m_changed.connect(update_signature_on_params_change, sender=ParamRole.param_set.through)
+signals.pre_save.connect(track_effective_roles, sender=PrincipalParamRoleRelation)
+signals.post_save.connect(update_effective_roles, sender=PrincipalParamRoleRelation)
+signals.post_delete.connect(update_effective_roles, sender=PrincipalParamRoleRelation)
+signals.m2m_changed.connect(update_effective_roles_on_membership_change, sender=User.groups.through)
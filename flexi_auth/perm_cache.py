@@ -0,0 +1,237 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An optional cache of permission-check decisions taken by ``ParamRoleBackend.has_perm()``.
+
+It's enabled by setting ``FLEXI_AUTH_PERM_CACHE`` to either ``'request'`` (decisions are cached 
+on the ``User`` instance the check is made for, e.g. ``request.user``, so they live as long as it does) 
+or ``'process'`` (decisions are shared by all requests served by the current process).  
+Caches are bounded LRU mappings holding at most ``FLEXI_AUTH_PERM_CACHE_SIZE`` entries, 
+each of them expiring after ``FLEXI_AUTH_PERM_CACHE_TIMEOUT`` seconds.
+
+Decisions are keyed by user ID, permission, model label, instance's primary key (if any) 
+and a canonical (hashable) form of the context; they're tagged with the generation number 
+of role assignments (see ``flexi_auth.utils.get_roles_generation()``), so that they go stale 
+as soon as roles are granted or revoked *by the current process*.  
+
+With the ``'process'`` scope, a decision may thus outlive a change made by another process: 
+if the shared cache tier is enabled (see ``flexi_auth.cache``), decisions are also tagged with 
+the shared generation counters of the user and his/her groups (see ``flexi_auth.cache.get_user_generation()``), 
+which every process bumps; otherwise, such changes are only seen once stale decisions expire, 
+i.e. within ``FLEXI_AUTH_PERM_CACHE_TIMEOUT`` seconds.
+
+Since a decision can be cached only if the ``can_<perm>`` method taking it is *pure* 
+(i.e. its result only depends on the user, the object and the context), models can opt out 
+by declaring a ``perm_cache`` attribute: either ``False`` (no decision is cached) 
+or a collection of the (lower-cased) permission codenames whose decisions may be cached.
+"""
+
+from django.conf import settings
+from django.db import models
+
+try:
+    from collections import OrderedDict
+except ImportError: # Python < 2.7
+    from django.utils.datastructures import SortedDict as OrderedDict
+import datetime
+import decimal
+import threading
+import time
+
+from flexi_auth.cache import get_user_generation
+from flexi_auth.instrumentation import record_cache_lookup
+
+DEFAULT_SIZE = 1000
+DEFAULT_TIMEOUT = 60
+
+# types of context values which compare (and hash) by value
+try:
+    SCALAR_TYPES = (type(None), bool, int, long, float, basestring, datetime.date, datetime.time, decimal.Decimal)
+except NameError: # Python 3
+    SCALAR_TYPES = (type(None), bool, int, float, str, bytes, datetime.date, datetime.time, decimal.Decimal)
+
+class DecisionCache(object):
+    """
+    A thread-safe LRU mapping, whose entries expire after a given timeout 
+    or as soon as the generation they were computed under is superseded.
+    """
+    
+    def __init__(self, max_size=DEFAULT_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key, generation):
+        """
+        Return a ``(hit, value)`` pair: if a valid entry exists for ``key``, 
+        ``hit`` is ``True`` and ``value`` is the cached value; otherwise, ``hit`` is ``False``.
+        """
+        self._lock.acquire()
+        try:
+            try:
+                (entry_generation, expires, value) = self._entries.pop(key)
+            except KeyError:
+                return (False, None)
+            if entry_generation != generation or expires < time.time():
+                return (False, None)
+            # re-insert the entry, marking it as the most recently used
+            self._entries[key] = (entry_generation, expires, value)
+            return (True, value)
+        finally:
+            self._lock.release()
+    
+    def set(self, key, generation, value):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = (generation, time.time() + self.timeout, value)
+            while len(self._entries) > self.max_size:
+                # evict the least recently used entry
+                del self._entries[next(iter(self._entries))]
+        finally:
+            self._lock.release()
+    
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+
+_process_cache = None
+
+def _scope():
+    return getattr(settings, 'FLEXI_AUTH_PERM_CACHE', None)
+
+def _new_cache():
+    return DecisionCache(max_size=getattr(settings, 'FLEXI_AUTH_PERM_CACHE_SIZE', DEFAULT_SIZE), 
+                         timeout=getattr(settings, 'FLEXI_AUTH_PERM_CACHE_TIMEOUT', DEFAULT_TIMEOUT))
+
+def get_decision_cache(user):
+    """
+    Return the decision cache to be used for permission checks made for ``user``, 
+    or ``None`` if decision caching is disabled.
+    """
+    
+    global _process_cache
+    scope = _scope()
+    if scope == 'request':
+        try:
+            return user.__dict__['_perm_decisions']
+        except KeyError:
+            cache = user.__dict__['_perm_decisions'] = _new_cache()
+            return cache
+    elif scope == 'process':
+        if _process_cache is None:
+            _process_cache = _new_cache()
+        return _process_cache
+    return None
+
+def clear_decision_cache(user=None):
+    """
+    Flush cached decisions: those of the process-wide cache and, if ``user`` is given, 
+    those cached on that ``User`` instance.
+    
+    This is seldom needed, since decisions go stale as soon as role assignments change. 
+    """
+    
+    if _process_cache is not None:
+        _process_cache.clear()
+    if user is not None:
+        user.__dict__.pop('_perm_decisions', None)
+
+def freeze(value):
+    """
+    Return a hashable, canonical representation of ``value`` (e.g. a context dictionary):
+    dictionaries and sets become frozensets, lists and tuples become tuples, 
+    model instances become ``(model label, primary key)`` pairs.
+    
+    Raise ``TypeError`` if ``value`` contains something else than those and scalars (see ``SCALAR_TYPES``):
+    other objects may hash by identity, and an ``id()`` can be reused once they're garbage collected.
+    """
+    
+    if isinstance(value, dict):
+        return frozenset([(freeze(k), freeze(v)) for (k, v) in value.items()])
+    if isinstance(value, (list, tuple)):
+        return tuple([freeze(v) for v in value])
+    if isinstance(value, (set, frozenset)):
+        return frozenset([freeze(v) for v in value])
+    if isinstance(value, models.Model):
+        return (value._meta.app_label, value._meta.object_name, value.pk)
+    if isinstance(value, SCALAR_TYPES):
+        return value
+    raise TypeError("Context values of type %s can't be cached" % type(value).__name__)
+
+def is_cacheable(model, perm):
+    """
+    Return ``True`` if decisions about permission ``perm`` (a lower-cased codename) 
+    on instances of ``model`` (or the model itself) may be cached, based on its ``perm_cache`` attribute. 
+    """
+    
+    policy = getattr(model, 'perm_cache', True)
+    if policy is True or policy is False:
+        return policy
+    return perm in policy
+
+def cached_decision(user, perm, obj, check):
+    """
+    Return the decision about permission ``perm`` for ``user`` on ``obj`` (an ``ObjectWithContext`` instance),
+    as computed by calling ``check()``; if decision caching is enabled and allowed for the model, 
+    a cached decision is returned when available.
+    
+    With the ``'process'`` scope and the shared cache tier enabled, validating a cached decision 
+    costs a few round-trips to the shared cache (to read the generation counters of the user and his/her groups).
+    """
+    
+    # local import, to avoid circular dependencies
+    from flexi_auth.utils import get_roles_generation
+    
+    cache = get_decision_cache(user)
+    if cache is None:
+        return check()
+    perm = perm.lower()
+    target = obj.model_or_instance
+    if isinstance(target, models.Model):
+        model, pk = target.__class__, target.pk
+    else:
+        model, pk = target, None
+    if not is_cacheable(model, perm):
+        return check()
+    try:
+        key = (user.pk, perm, model._meta.app_label, model._meta.object_name, pk, freeze(obj.context))
+    except TypeError:
+        # the context can't be reliably hashed, so the decision can't be cached
+        return check()
+    
+    generation = get_roles_generation()
+    if _scope() == 'process' and user.pk is not None:
+        # role assignments may have been changed by other processes
+        shared_generation = get_user_generation(user)
+        if shared_generation is not None:
+            generation = (generation, shared_generation)
+    (hit, value) = cache.get(key, generation)
+    record_cache_lookup(hit)
+    if hit:
+        return value
+    value = check()
+    cache.set(key, generation, value)
+    return value
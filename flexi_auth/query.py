@@ -14,7 +14,46 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
 
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q, get_model
 from django.db.models.query import QuerySet
+from django.contrib.contenttypes.models import ContentType
+
+from flexi_auth.constraints import ROLE_CONSTRAINTS
+from flexi_auth.exceptions import TooManyArchivedParams
+
+import functools
+import operator
+
+def archive_state_stored():
+    """
+    Return ``True`` if the archive state of parametric roles is stored in the DB 
+    (i.e. the ``FLEXI_AUTH_STORE_ARCHIVE_STATE`` setting is enabled), ``False`` otherwise.
+    """
+    return bool(getattr(settings, 'FLEXI_AUTH_STORE_ARCHIVE_STATE', False))
+
+def max_query_params(using):
+    """
+    Return the maximum number of variables the DB backend of connection ``using`` accepts 
+    in a single SQL statement, or ``None`` if it's not limited (in practice).
+    """
+    connection = connections[using]
+    limit = getattr(connection.features, 'max_query_params', None)
+    if limit is not None:
+        return limit
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        # the default (compile-time) limit was raised from 999 in SQLite 3.32 
+        return Database.sqlite_version_info >= (3, 32, 0) and 32766 or 999
+    return None
+
+def effective_roles_stored():
+    """
+    Return ``True`` if effective parametric roles of users are materialized in the DB 
+    (i.e. the ``FLEXI_AUTH_EFFECTIVE_ROLES`` setting is enabled), ``False`` otherwise.
+    """
+    return bool(getattr(settings, 'FLEXI_AUTH_EFFECTIVE_ROLES', False))
 
 class RoleQuerySet(QuerySet):
     """
@@ -22,23 +61,148 @@ class RoleQuerySet(QuerySet):
     of parametric roles' model instances.    
     """
 
+    def with_params(self):
+        """
+        Load parameters of parametric roles in the current ``QuerySet`` along with them, 
+        so that accessing them (via ``.params``, ``.param``, ``.<param_name>`` accessors, 
+        or when rendering a role as a string) doesn't hit the DB anymore.
+        
+        Basic roles are retrieved by the same query used for parametric roles; 
+        all their ``Param`` instances are loaded by one more query, and parameter values 
+        are resolved in batches, with one query for each kind of (model) parameter.
+        """
+        return self.select_related('role').prefetch_related('param_set__value')
+
+    def with_param_values(self, **params):
+        """
+        Filter the current ``QuerySet`` including only parametric roles bound to *all* 
+        the given parameters (specified as keyword arguments of the form ``<name>=<model instance>``);
+        other parameters may be bound to them, too.
+        
+        Parameters are matched on raw ``(content_type, object_id)`` pairs, so no generic relation 
+        has to be resolved; no validation is performed here (see ``RoleManager.get_param_roles()``).
+        """
+        qs = self
+        # Every ``.filter()`` call spanning the ``param_set`` relation adds its own join on 
+        # the ``Param`` table, so chaining one call per parameter requires *all* of them 
+        # to be bound to the role; since ``(name, content_type, object_id)`` is unique, 
+        # each join matches at most one row and no duplicates are produced.
+        for (k, v) in params.items():
+            ct = ContentType.objects.get_for_model(v)
+            qs = qs.filter(param_set__name=k, param_set__content_type=ct, param_set__object_id=v.pk)
+        return qs
+    
+    def for_object(self, obj):
+        """
+        Filter the current ``QuerySet`` including only parametric roles having the model instance 
+        ``obj`` among their parameters (whatever the parameter's name).
+        """
+        ct = ContentType.objects.get_for_model(obj)
+        return self.filter(param_set__content_type=ct, param_set__object_id=obj.pk).distinct()
+    
+    def _archived_params(self):
+        """
+        Return a list of ``Q`` objects which, OR-ed together, select the ``Param`` instances 
+        bound to archived model instances.
+        
+        Models can declare which of their instances are active by implementing an 
+        ``.active_filter()`` classmethod, returning a ``Q`` object that selects them; 
+        in this case, archived parameters are selected via a SQL subquery.
+        Models only implementing an ``.is_active()`` instance method are checked in Python: 
+        parameters of those types bound to parametric roles in the current ``QuerySet`` 
+        are streamed in chunks (ordered by primary key), and their values resolved in batches; 
+        so, this happens *eagerly* (costing a few queries for every ``CHUNK_SIZE`` parameters), 
+        and IDs of archived parameters are embedded in the resulting query, split among 
+        ``__in`` lookups of ``CHUNK_SIZE`` items.  If they don't fit in a single statement 
+        on the DB backend in use (see ``max_query_params()``), ``TooManyArchivedParams`` is raised: 
+        those models should implement ``.active_filter()``.
+        Models implementing neither of them have no archived instances, by convention.
+        """
+        # local imports, to avoid circular dependencies
+        from flexi_auth.models import Param, resolve_param_values
+        from flexi_auth.utils import CHUNK_SIZE, _chunks
+        
+        # leave room for the variables of the rest of the query
+        limit = max_query_params(self.db)
+        budget = None
+        if limit is not None:
+            budget = limit - CHUNK_SIZE
+        archived_count = 0
+        archived_params = []
+        for (app_label, model_name) in ROLE_CONSTRAINTS.param_models():
+            model = get_model(app_label, model_name)
+            ct = ContentType.objects.get_for_model(model)
+            if hasattr(model, 'active_filter'):
+                archived_ids = model._default_manager.exclude(model.active_filter()).values('pk')
+                archived_params.append(Q(content_type=ct, object_id__in=archived_ids))
+            elif callable(getattr(model, 'is_active', None)):
+                params = Param.objects.filter(content_type=ct, paramrole__in=self.order_by().values('pk'))
+                params = params.distinct().order_by('pk')
+                archived_ids = []
+                last_pk = 0
+                while True:
+                    chunk = list(params.filter(pk__gt=last_pk)[:CHUNK_SIZE])
+                    if not chunk:
+                        break
+                    last_pk = chunk[-1].pk
+                    archived_ids.extend([p.pk for p in resolve_param_values(chunk) if p.value is not None and not p.value.is_active()])
+                    if budget is not None and archived_count + len(archived_ids) > budget:
+                        raise TooManyArchivedParams(model, budget)
+                archived_count += len(archived_ids)
+                archived_params.extend([Q(pk__in=ids) for ids in _chunks(archived_ids)])
+        return archived_params
+    
+    def _archived_roles(self, archived_params):
+        """
+        Return a (lazy) ``ValuesQuerySet`` of IDs of the parametric roles bound to 
+        at least one of the given parameters, suitable for being used as a subquery.
+        """
+        # local import, to avoid circular dependencies
+        from flexi_auth.models import Param
+        
+        q = functools.reduce(operator.or_, archived_params)
+        return self.model._default_manager.filter(param_set__in=Param.objects.filter(q)).order_by().values('pk')
+    
     def active(self):
         """
         Filter the current ``QuerySet`` including only 'active' parametric roles.
         The semantic (what is meant by 'active') and implementation 
-        (how to retrieve active roles) is delegated to specific models.
+        (how to retrieve active roles) is delegated to specific models 
+        (see ``ParamRole.is_active``).
+        
+        A parametric role is active iff none of its parameters is archived; 
+        if parameter models declare their active instances via an ``.active_filter()`` 
+        classmethod, the resulting ``QuerySet`` compiles to a single SQL query; 
+        otherwise, parameters are checked in Python when this method is called
+        (see ``._archived_params()``), and ``TooManyArchivedParams`` may be raised.   
+        If the archive state of parametric roles is stored in the DB 
+        (see ``ParamRole.update_archive_state()``), this is just an (indexed) filter.
         """
-        active_roles_list = [role for role in self if role.is_active()]
-        qs = self.filter(pk__in=[obj.pk for obj in active_roles_list])
-        return qs
+        if archive_state_stored():
+            return self.filter(active=True)
+        archived_params = self._archived_params()
+        if not archived_params:
+            return self.all()
+        return self.exclude(pk__in=self._archived_roles(archived_params))
 
     def archived(self):
         """
         Filter the current ``QuerySet`` including only 'archived' parametric roles.
         The semantic (what is meant by 'archived') and implementation 
-        (how to retrieve archived roles) is delegated to specific models.
+        (how to retrieve archived roles) is delegated to specific models
+        (see ``ParamRole.is_archived``).
+        
+        A parametric role is archived iff at least one of its parameters is archived;
+        if parameter models declare their active instances via an ``.active_filter()`` 
+        classmethod, the resulting ``QuerySet`` compiles to a single SQL query; 
+        otherwise, parameters are checked in Python when this method is called
+        (see ``._archived_params()``), and ``TooManyArchivedParams`` may be raised.   
+        If the archive state of parametric roles is stored in the DB 
+        (see ``ParamRole.update_archive_state()``), this is just an (indexed) filter.
         """
-        archived_roles_list = [role for role in self if role.is_archived()]
-        qs = self.filter(pk__in=[obj.pk for obj in archived_roles_list])
-        return qs
-
+        if archive_state_stored():
+            return self.filter(active=False)
+        archived_params = self._archived_params()
+        if not archived_params:
+            return self.none()
+        return self.filter(pk__in=self._archived_roles(archived_params))
@@ -0,0 +1,163 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A registry of the permission checks supported by models, i.e. of their ``can_<perm>`` methods
+(see ``flexi_auth.backends.ParamRoleBackend``).
+
+The registry is built (once) by scanning installed models, the first time it's used; 
+afterwards, dispatching a permission check is just a dictionary lookup, and unsupported 
+``(model, permission)`` pairs are remembered too (so they can be rejected without inspecting the model again).  
+Models not found by the scan (e.g. non-installed ones) are scanned the first time they're looked up.
+"""
+
+from django.db import models
+from django.db.models import get_models
+
+import threading
+
+# suffixes of batched/queryset-level counterparts of ``can_<perm>`` methods
+# (see ``flexi_auth.backends.has_perm_many()`` and ``flexi_auth.backends.filter_by_perm()``)
+HOOK_SUFFIXES = ('_many', '_filter')
+
+TABLE_LEVEL = 'table'
+ROW_LEVEL = 'row'
+
+class PermissionRegistry(object):
+    """
+    Map every model class to the permissions it supports, each with its kind 
+    (``'table'`` for classmethods, ``'row'`` for instance methods), and dispatch 
+    permission checks via that table.
+    """
+    
+    def __init__(self):
+        self._supported = {}
+        self._dispatch = {}
+        self._scanned = False
+        self._lock = threading.Lock()
+    
+    def _scan_model(self, model):
+        supported = {}
+        for name in dir(model):
+            if not name.startswith('can_') or name.endswith(HOOK_SUFFIXES):
+                continue
+            attr = None
+            for klass in model.__mro__:
+                if name in klass.__dict__:
+                    attr = klass.__dict__[name]
+                    break
+            if isinstance(attr, classmethod):
+                supported[name[len('can_'):]] = TABLE_LEVEL
+            elif callable(attr):
+                supported[name[len('can_'):]] = ROW_LEVEL
+        return supported
+    
+    def autodiscover(self):
+        """
+        Scan every installed model for ``can_<perm>`` methods, unless already done.
+        """
+        if self._scanned:
+            return
+        self._lock.acquire()
+        try:
+            if not self._scanned:
+                for model in get_models():
+                    self._supported.setdefault(model, self._scan_model(model))
+                self._scanned = True
+        finally:
+            self._lock.release()
+    
+    def clear(self):
+        """
+        Forget everything, so that models are scanned again when the registry is next used.
+        """
+        self._lock.acquire()
+        try:
+            self._supported = {}
+            self._dispatch = {}
+            self._scanned = False
+        finally:
+            self._lock.release()
+    
+    def get_supported_permissions(self, model_or_instance):
+        """
+        Return a dictionary mapping the (lower-cased) codenames of permissions supported by 
+        the given model (class or instance) to their kind (``'table'`` or ``'row'``).
+        """
+        self.autodiscover()
+        if isinstance(model_or_instance, models.Model):
+            model = model_or_instance.__class__
+        else:
+            model = model_or_instance
+        try:
+            return self._supported[model]
+        except KeyError:
+            supported = self._supported[model] = self._scan_model(model)
+            return supported
+    
+    def supports(self, model_or_instance, perm):
+        """
+        Return ``True`` if the given model (class or instance) supports permission ``perm``, ``False`` otherwise.
+        """
+        return perm.lower() in self.get_supported_permissions(model_or_instance)
+    
+    def get_check(self, model_or_instance, perm):
+        """
+        Return the method implementing the check of permission ``perm`` on the given model class/instance 
+        (bound to it), or ``None`` if the model doesn't support that permission.
+        """
+        if isinstance(model_or_instance, models.Model):
+            model = model_or_instance.__class__
+        else:
+            model = model_or_instance
+        key = (model, perm)
+        try:
+            name = self._dispatch[key]
+        except KeyError:
+            if perm.lower() in self.get_supported_permissions(model):
+                name = 'can_' + perm.lower()
+            else:
+                # remember unsupported permissions, too
+                name = None
+            self._dispatch[key] = name
+        if name is None:
+            return None
+        return getattr(model_or_instance, name)
+    
+    def items(self):
+        """
+        Return a list of ``(model, supported permissions)`` pairs, for every scanned model 
+        supporting at least one permission.
+        """
+        self.autodiscover()
+        return [(model, perms) for (model, perms) in self._supported.items() if perms]
+    
+    def orphaned_hooks(self, model):
+        """
+        Return the names of batched/queryset-level hooks (``can_<perm>_many``, ``can_<perm>_filter``) 
+        defined by ``model`` without the corresponding ``can_<perm>`` method (e.g. because of a typo).
+        """
+        supported = self.get_supported_permissions(model)
+        orphans = []
+        for name in dir(model):
+            for suffix in HOOK_SUFFIXES:
+                if name.startswith('can_') and name.endswith(suffix):
+                    if name[len('can_'):-len(suffix)] not in supported:
+                        orphans.append(name)
+        return orphans
+
+
+PERMISSION_REGISTRY = PermissionRegistry()
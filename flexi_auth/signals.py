@@ -0,0 +1,27 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Signals sent by ``django-flexi-auth``.
+"""
+
+from django.dispatch import Signal
+
+# Sent when a recording of permission-checking statistics ends (see ``flexi_auth.instrumentation``);
+# ``stats`` is the ``PermissionStats`` instance holding the totals, while ``request`` is the ``HttpRequest`` 
+# they refer to, if the recording was driven by ``flexi_auth.middleware.PermissionStatsMiddleware`` 
+# (``None`` otherwise).  Connect to it to feed those numbers into your own metrics.
+permission_stats_recorded = Signal(providing_args=["stats", "request"])
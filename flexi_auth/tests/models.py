@@ -25,6 +25,29 @@ class Author(models.Model):
 class Magazine(models.Model):
     name = models.CharField(max_length=50)
     printing = models.IntegerField()
+    archived = models.BooleanField(default=False)
+    
+    ##-------------- archive API----------------##
+    def is_active(self):
+        return not self.archived
+    
+    @classmethod
+    def active_filter(cls):
+        return models.Q(archived=False)
+    ##------------------------------------------##
+    
+    ##-------------- authorization API----------------##
+    # row-level VIEW permission: only sponsors can view a magazine
+    def can_view(self, user, context):
+        from flexi_auth.utils import has_param_role
+        return has_param_role(user, 'SPONSOR', magazine=self)
+    # batched counterpart of the VIEW permission: roles are retrieved for every magazine at once 
+    @classmethod
+    def can_view_many(cls, instances, user, context):
+        from flexi_auth.utils import get_roles_for_objects
+        roles = get_roles_for_objects(user, instances)
+        return set([obj for obj in instances if 'SPONSOR' in roles[obj]])
+    ##-------------------------------------------------##
 
 class Article(models.Model):
     title = models.CharField(max_length=50)
@@ -66,10 +89,17 @@ class Book(models.Model, PermissionBase):
     title = models.CharField(max_length=50)
     content = models.TextField()
     authors = models.ManyToManyField(Author)
+    out_of_print = models.BooleanField(default=False)
     
     def __unicode__(self):
         return "A book with title '%s'" % self.title
     
+    ##-------------- archive API----------------##
+    # no queryset-level filter is declared, so archived books are looked up in Python
+    def is_active(self):
+        return not self.out_of_print
+    ##------------------------------------------##
+    
     
     ##-------------- authorization API----------------##
     # table-level CREATE permission
@@ -95,5 +125,14 @@ class Book(models.Model, PermissionBase):
             if (language=="Italian" or (language=="Dutch" and cover=="Paperback")):
                 return True               
         return False 
+    # queryset-level counterpart of the VIEW permission
+    @classmethod
+    def can_view_filter(cls, user, context):
+        if context:
+            language = context.get('language', None)
+            cover = context.get('cover', None)
+            if (language=="Italian" or (language=="Dutch" and cover=="Paperback")):
+                return models.Q()
+        return models.Q(pk__in=[])
     ##-------------------------------------------------##
         
@@ -0,0 +1,201 @@
+# Copyright (C) 2011 REES Marche <http://www.reesmarche.org>
+#
+# This file is part of ``django-flexi-auth``.
+
+# ``django-flexi-auth`` is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# ``django-flexi-auth`` is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ``django-flexi-auth``. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Query-budget regression tests: every public entry point of the API must perform at most 
+a fixed number of SQL queries, whatever the size of the dataset it works on.
+
+Each budget is checked at two dataset sizes (``QueryBudgetTestCase.sizes``): the number of queries 
+must not exceed the budget, and it must be the same for both sizes (i.e. it's O(1)).
+"""
+
+from django.test import TestCase
+from django.db import connection
+from django.contrib.auth.models import User, Group
+
+from flexi_auth.utils import register_parametric_role, register_parametric_roles, add_parametric_role,\
+    get_all_parametric_roles, grant_parametric_roles
+from flexi_auth.backends import has_perm_many
+from flexi_auth.models import ObjectWithContext, ParamRole
+
+from flexi_auth.tests.models import Article, Author, Magazine
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Base class for query-budget tests.
+    """
+    
+    sizes = (5, 50)
+    
+    def setUp(self):
+        self.author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self._counter = 0
+    
+    def count_queries(self, func, *args, **kwargs):
+        """
+        Call ``func`` with the given arguments and return the number of SQL queries it performed.
+        """
+        
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            func(*args, **kwargs)
+            return len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+    
+    def assertQueryBudget(self, budget, setup, func):
+        """
+        For each dataset size, call ``setup(size)``, which must return the list of arguments 
+        for ``func``, and count the queries performed by calling ``func`` with them: 
+        check that they don't exceed ``budget`` and that they don't depend on the dataset size.
+        """
+        
+        counts = []
+        for size in self.sizes:
+            args = setup(size)
+            counts.append(self.count_queries(func, *args))
+        for (size, count) in zip(self.sizes, counts):
+            self.assertTrue(count <= budget, "%d queries performed at size %d, budget is %d" % (count, size, budget))
+        self.assertEqual(len(set(counts)), 1, "Query count depends on dataset size: %s" % 
+                         ", ".join(["%d at size %d" % (count, size) for (size, count) in zip(self.sizes, counts)]))
+    
+    ##------------------------------- Helper methods --------------------------------##
+    def articles(self, n):
+        self._counter += n
+        return [Article.objects.create(title="Article %d" % (self._counter - i), body="...", author=self.author) for i in range(n)]
+    
+    def magazines(self, n):
+        self._counter += n
+        return [Magazine.objects.create(name="Magazine %d" % (self._counter - i), printing=1000) for i in range(n)]
+    
+    def editor_roles(self, n):
+        return register_parametric_roles([('EDITOR', {'article': article}) for article in self.articles(n)])
+    
+    def sponsor_roles(self, n):
+        return register_parametric_roles([('SPONSOR', {'article': article, 'magazine': magazine}) 
+                                          for (article, magazine) in zip(self.articles(n), self.magazines(n))])
+    
+    def principals(self, n, prefix='user'):
+        self._counter += n
+        users = [User.objects.create_user(username="%s%d" % (prefix, self._counter - i), email="", password="secret") for i in range(n)]
+        groups = [Group.objects.create(name="%s%d" % (prefix, self._counter - i)) for i in range(n)]
+        return (users, groups)
+    
+    def subject(self, size):
+        """
+        Return a (fresh instance of a) user holding ``size`` parametric roles directly 
+        and ``size`` more via a group (s)he belongs to.
+        """
+        
+        (users, groups) = self.principals(1)
+        grant_parametric_roles(users, self.sponsor_roles(size))
+        grant_parametric_roles(groups, self.editor_roles(size))
+        users[0].groups.add(groups[0])
+        return User.objects.get(pk=users[0].pk)
+    
+
+class RoleRegistrationQueryBudgetTest(QueryBudgetTestCase):
+    """Query budgets for registering and assigning parametric roles"""
+    
+    def testRegisterNewParametricRole(self):
+        def setup(size):
+            self.editor_roles(size)
+            return [self.articles(1)[0]]
+        # savepoints are counted too, on backends supporting them, 
+        # as well as checking the signature once parameters are bound
+        self.assertQueryBudget(12, setup, lambda article: register_parametric_role('EDITOR', article=article))
+    
+    def testRegisterExistingParametricRole(self):
+        self.assertQueryBudget(2, lambda size: [self.editor_roles(size)[-1].article], 
+                               lambda article: register_parametric_role('EDITOR', article=article))
+    
+    def testAddParametricRole(self):
+        def setup(size):
+            user = self.subject(size)
+            return [user, self.editor_roles(1)[0]]
+        self.assertQueryBudget(2, setup, add_parametric_role)
+    
+    def testAddParametricRoleToGroup(self):
+        def setup(size):
+            (users, groups) = self.principals(1)
+            grant_parametric_roles(groups, self.editor_roles(size))
+            return [groups[0], self.editor_roles(1)[0]]
+        self.assertQueryBudget(2, setup, add_parametric_role)
+
+
+class RoleLookupQueryBudgetTest(QueryBudgetTestCase):
+    """Query budgets for looking up parametric roles and their principals"""
+    
+    def testGetAllParametricRoles(self):
+        self.assertQueryBudget(1, lambda size: [self.subject(size)], get_all_parametric_roles)
+    
+    def testGetAllParametricRolesPrefetch(self):
+        self.assertQueryBudget(2, lambda size: [self.subject(size)], 
+                               lambda user: get_all_parametric_roles(user, prefetch=True))
+    
+    def testGetRoleExact(self):
+        self.assertQueryBudget(1, lambda size: [self.editor_roles(size)[-1].article], 
+                               lambda article: ParamRole.get_role('EDITOR', article=article))
+    
+    def testGetRolePartial(self):
+        self.assertQueryBudget(1, lambda size: [self.sponsor_roles(size)[-1].magazine], 
+                               lambda magazine: ParamRole.get_role('SPONSOR', magazine=magazine))
+    
+    def testParamByName(self):
+        # parameters of all retrieved roles are loaded by one query, plus one per parameter type  
+        def lookup(pks):
+            for p_role in ParamRole.objects.filter(pk__in=pks).with_params():
+                (p_role.article, p_role.magazine)
+        self.assertQueryBudget(4, lambda size: [[p_role.pk for p_role in self.sponsor_roles(size)]], lookup)
+    
+    def testGetUsers(self):
+        def setup(size):
+            p_role = self.editor_roles(1)[0]
+            grant_parametric_roles(self.principals(size)[0], [p_role])
+            return [p_role]
+        self.assertQueryBudget(1, setup, lambda p_role: list(p_role.get_users()))
+    
+    def testGetGroups(self):
+        def setup(size):
+            p_role = self.editor_roles(1)[0]
+            grant_parametric_roles(self.principals(size)[1], [p_role])
+            return [p_role]
+        self.assertQueryBudget(1, setup, lambda p_role: list(p_role.get_groups()))
+
+
+class PermissionCheckQueryBudgetTest(QueryBudgetTestCase):
+    """Query budgets for permission checks"""
+    
+    def testHasPermContextual(self):
+        # ``Article.can_view()`` only depends on the context
+        self.assertQueryBudget(0, lambda size: [self.subject(size), self.articles(1)[0]], 
+                               lambda user, article: user.has_perm('VIEW', ObjectWithContext(article, {'website': "BarSite"})))
+    
+    def testHasPermRoleBased(self):
+        # ``Magazine.can_view()`` checks whether the user is a sponsor of the magazine
+        def setup(size):
+            user = self.subject(size)
+            return [user, ParamRole.objects.filter(principal_param_role_set__user=user)[0].magazine]
+        self.assertQueryBudget(1, setup, lambda user, magazine: user.has_perm('VIEW', ObjectWithContext(magazine)))
+    
+    def testHasPermMany(self):
+        def setup(size):
+            user = self.subject(size)
+            magazines = [p_role.magazine for p_role in ParamRole.objects.filter(principal_param_role_set__user=user).with_params()]
+            return [user, magazines + self.magazines(size)]
+        self.assertQueryBudget(1, setup, lambda user, magazines: has_perm_many(user, 'VIEW', magazines))
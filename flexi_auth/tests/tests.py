@@ -19,20 +19,42 @@ from django.db import IntegrityError
 from django.contrib.auth.models import User, Group, AnonymousUser 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth import SESSION_KEY
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import get_cache
+from django.test.utils import override_settings
 
 from permissions.models import Role
 
 from flexi_auth.utils import get_ctype_from_model_label, register_parametric_role, _parametric_role_as_dict,\
-_is_valid_parametric_role_dict_repr, _compare_parametric_roles
+_is_valid_parametric_role_dict_repr, _compare_parametric_roles, add_parametric_role, remove_parametric_role,\
+clear_parametric_roles, get_parametric_roles, get_all_parametric_roles, register_parametric_roles,\
+grant_parametric_roles, revoke_parametric_roles, resolve_param_values, has_param_role,\
+get_objects_for_role, get_principals_for_object, get_roles_for_objects, CHUNK_SIZE
 
 from flexi_auth.exceptions import WrongPermissionCheck 
-from flexi_auth.models import ObjectWithContext, Param, ParamRole
+from flexi_auth.backends import filter_by_perm, has_perm_many
+from flexi_auth.models import ObjectWithContext, Param, ParamRole, EffectiveParamRole, PrincipalParamRoleRelation
+from flexi_auth.perm_cache import DecisionCache, clear_decision_cache
+from flexi_auth.cache import bump_generations
+from flexi_auth.registry import PermissionRegistry
+from flexi_auth.management.commands.list_permissions import Command as ListPermissionsCommand
+from flexi_auth.instrumentation import start_recording, stop_recording, get_current_stats
+from flexi_auth.signals import permission_stats_recorded
+from flexi_auth.benchmarks.dataset import generate_dataset
+from flexi_auth.benchmarks.runner import BENCHMARKS, run_benchmarks, compare_results
+from flexi_auth.constraints import RoleConstraints
 from flexi_auth.decorators import object_permission_required
-from flexi_auth.exceptions import RoleParameterNotAllowed
+from flexi_auth.exceptions import RoleNotAllowed, RoleParameterNotAllowed, RoleParameterWrongSpecsProvided, TooManyArchivedParams,\
+TooManyAllowedInstances
 
+from flexi_auth import backends, managers, query
 from flexi_auth.tests import settings
 from flexi_auth.tests.models import Article, Book, Author, Magazine
 from flexi_auth.tests.views import CallableView, normal_view
+# query-budget tests live in their own module; import them here, so that the test runner finds them
+from flexi_auth.tests.query_budgets import RoleRegistrationQueryBudgetTest, RoleLookupQueryBudgetTest, PermissionCheckQueryBudgetTest
 
 
 
@@ -108,6 +130,45 @@ class ParamModelTest(TestCase):
         Param.objects.create(name='article', value=self.article)
         self.assertRaises(IntegrityError, Param.objects.create, name='article', value=self.article)
 
+class ResolveParamValuesTest(TestCase):
+    """Tests for the ``resolve_param_values()`` helper function"""
+
+    def setUp(self):
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.articles = [Article.objects.create(title="Article #%s" % i, body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author) for i in range(5)]
+        self.magazines = [Magazine.objects.create(name="Magazine #%s" % i, printing=i) for i in range(5)]
+        for obj in self.articles:
+            Param.objects.create(name='article', value=obj)
+        for obj in self.magazines:
+            Param.objects.create(name='magazine', value=obj)
+        # warm up the ``ContentType`` cache
+        ContentType.objects.get_for_model(Article)
+        ContentType.objects.get_for_model(Magazine)
+    
+    def testResolveOK(self):
+        """Every parameter should be bound to the right value"""
+        params = resolve_param_values(Param.objects.all())
+        self.assertEqual(len(params), 10)
+        self.assertEqual(set(p.value for p in params if p.name == 'article'), set(self.articles))
+        self.assertEqual(set(p.value for p in params if p.name == 'magazine'), set(self.magazines))
+    
+    def testQueriesPerContentType(self):
+        """Values should be retrieved with one query for each distinct type of parameter"""
+        params = list(Param.objects.all())
+        with self.assertNumQueries(2):
+            resolve_param_values(params)
+        with self.assertNumQueries(0):
+            [p.value for p in params]
+            # values already resolved are skipped
+            resolve_param_values(params)
+            
+    def testMissingValue(self):
+        """If the object bound to a parameter doesn't exist anymore, its value should be ``None``"""
+        Magazine.objects.filter(pk=self.magazines[0].pk).delete()
+        params = resolve_param_values(Param.objects.filter(name='magazine'))
+        self.assertEqual(len([p for p in params if p.value is None]), 1)
+
+
 class ParamRoleAsDictTest(TestCase):
     """Tests for the ``parametric_role_as_dict()`` helper function"""
     
@@ -296,10 +357,45 @@ class ParamRoleValidationTest(TestCase):
         pass
 
     
+class RoleConstraintsTest(TestCase):
+    """Tests for the ``RoleConstraints`` index"""
+    
+    def setUp(self):
+        self.author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.magazine = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        self.article = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=self.author)
+        self.constraints = RoleConstraints(settings.VALID_PARAMS_FOR_ROLES, settings.PARAM_CHOICES)
+    
+    def testCheckParamsOK(self):
+        """Check that valid parameters pass validation without hitting the DB"""
+        with self.assertNumQueries(0):
+            self.assertTrue(self.constraints.check_params('SPONSOR', {'article': self.article, 'magazine': self.magazine}))
+            self.assertTrue(self.constraints.check_params('SPONSOR', {'magazine': self.magazine}, exact=False))
+    
+    def testCheckParamsFail(self):
+        """Check that wrong parameters fail validation"""
+        self.assertFalse(self.constraints.check_params('SPONSOR', {'article': self.magazine, 'magazine': self.magazine}))
+        self.assertFalse(self.constraints.check_params('SPONSOR', {'magazine': self.magazine}))
+        self.assertRaises(RoleNotAllowed, self.constraints.check_params, 'FOO', {'article': self.article})
+        self.assertRaises(RoleParameterNotAllowed, self.constraints.check_params, 'EDITOR', {'magazine': self.magazine})
+    
+    def testMisconfiguration(self):
+        """Malformed constraints should raise ``ImproperlyConfigured``"""
+        # parameter not listed in ``PARAM_CHOICES``
+        self.assertRaises(ImproperlyConfigured, RoleConstraints, {'EDITOR': {'foo': 'tests.Article'}}, settings.PARAM_CHOICES)
+        # malformed model label
+        self.assertRaises(ImproperlyConfigured, RoleConstraints, {'EDITOR': {'article': 'tests:Article'}}, settings.PARAM_CHOICES)
+        # non-existent model
+        constraints = RoleConstraints({'EDITOR': {'article': 'tests.Foo'}}, settings.PARAM_CHOICES)
+        self.assertRaises(ImproperlyConfigured, constraints.check_params, 'EDITOR', {'article': self.article})
+    
+    
 class ParamRoleRegistrationTest(TestCase):
     """Tests for the ``register_parametric_role`` function"""
     def setUp(self):
-        pass
+        self.author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.magazine = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        self.article = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=self.author)
     
     def testRegistrationOK(self):
         """Verify that registration of a parametric role succeeds if arguments are fine"""
@@ -319,7 +415,189 @@ class ParamRoleRegistrationTest(TestCase):
     
     def testAvoidDuplicateParamRoles(self):
         """If a given parametric role already exists in the DB, don't duplicate it"""
-        pass
+        pr1 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine)
+        pr2 = register_parametric_role('SPONSOR', magazine=self.magazine, article=self.article)
+        self.assertEqual(pr1, pr2)
+        self.assertEqual(ParamRole.objects.filter(role__name='SPONSOR').count(), 1)
+        
+    def testSignatureIsCanonical(self):
+        """The signature of a registered parametric role depends only on its kind and parameters"""
+        pr = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine)
+        self.assertEqual(pr.signature, pr.compute_signature())
+        # roles of a different kind bound to the same parameters have a different signature 
+        pr_editor = register_parametric_role('EDITOR', article=self.article)
+        self.assertNotEqual(pr_editor.signature, pr.signature)
+    
+    def testDuplicateDetectionSingleQuery(self):
+        """Looking up an already registered parametric role shouldn't depend on the number of roles in the DB"""
+        for i in range(10):
+            magazine = Magazine.objects.create(name="Magazine #%s" % i, printing=i)
+            register_parametric_role('SPONSOR', article=self.article, magazine=magazine)
+        register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine)
+        # warm up the ``ContentType`` cache
+        ContentType.objects.get_for_model(Article)
+        ContentType.objects.get_for_model(Magazine)
+        # one query for retrieving the ``Role``, one for the signature lookup
+        with self.assertNumQueries(2):
+            register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine)
+    
+    def testSignatureFollowsParams(self):
+        """The signature of a parametric role should be updated whenever its parameters change"""
+        pr = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine)
+        magazine2 = Magazine.objects.create(name="Ipsum Magazine", printing=2)
+        param = pr.params.get(name='magazine')
+        pr.param_set.remove(param)
+        pr.param_set.add(Param.objects.create(name='magazine', content_type=param.content_type, object_id=magazine2.pk))
+        self.assertEqual(ParamRole.objects.get(pk=pr.pk).signature, pr.compute_signature())
+        self.assertEqual(ParamRole.get_role('SPONSOR', article=self.article, magazine=magazine2), pr)
+        self.assertRaises(ParamRole.DoesNotExist, ParamRole.get_role, 'SPONSOR', article=self.article, magazine=self.magazine)
+        
+        # changes made from the parameter's side are tracked, too
+        param.paramrole_set.add(pr)
+        self.assertEqual(ParamRole.objects.get(pk=pr.pk).signature, pr.compute_signature())
+        param.paramrole_set.clear()
+        self.assertEqual(ParamRole.get_role('SPONSOR', article=self.article, magazine=magazine2), pr)
+    
+    def testSignatureOfDuplicates(self):
+        """If parameter changes make a parametric role a duplicate of another one, it should lose its signature"""
+        pr_editor = register_parametric_role('EDITOR', article=self.article)
+        duplicate = ParamRole.objects.create(role=pr_editor.role)
+        duplicate.param_set.add(*pr_editor.params)
+        self.assertEqual(ParamRole.objects.get(pk=duplicate.pk).signature, None)
+        self.assertEqual(ParamRole.get_role('EDITOR', article=self.article), pr_editor)
+    
+    def testBackfillSignatures(self):
+        """The ``backfill_param_role_signatures`` command sets missing signatures, skipping duplicates"""
+        pr = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine)
+        expected_signature = pr.signature
+        ParamRole.objects.filter(pk=pr.pk).update(signature=None)
+        # a duplicate of ``pr``, whose parameters are bound bypassing signals
+        duplicate = ParamRole.objects.create(role=pr.role)
+        through = ParamRole.param_set.through
+        through.objects.bulk_create([through(paramrole=duplicate, param=p) for p in pr.params])
+        
+        call_command('backfill_param_role_signatures', verbosity=0)
+        self.assertEqual(ParamRole.objects.get(pk=pr.pk).signature, expected_signature)
+        self.assertEqual(ParamRole.objects.get(pk=duplicate.pk).signature, None)
+
+
+class BulkParamRoleRegistrationTest(TestCase):
+    """Tests for the ``register_parametric_roles`` function"""
+    
+    def setUp(self):
+        self.author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.magazine = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        self.articles = [Article.objects.create(title="Article #%s" % i, body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=self.author) for i in range(20)]
+        self.pr = register_parametric_role('EDITOR', article=self.articles[0])
+    
+    def testRegistrationOK(self):
+        """Parametric roles should be returned in input order, reusing existing ones and without duplicates"""
+        specs = [
+            ('EDITOR', {'article': self.articles[1]}),
+            ('EDITOR', {'article': self.articles[0]}),
+            ('SPONSOR', {'article': self.articles[1], 'magazine': self.magazine}),
+            ('EDITOR', {'article': self.articles[1]}),
+        ]
+        p_roles = register_parametric_roles(specs)
+        self.assertEqual(len(p_roles), 4)
+        self.assertEqual(p_roles[1], self.pr)
+        self.assertEqual(p_roles[0], p_roles[3])
+        self.assertEqual(ParamRole.objects.count(), 3)
+        
+        self.assertEqual(p_roles[0].article, self.articles[1])
+        self.assertEqual(p_roles[2].magazine, self.magazine)
+        for (p_role, (name, params)) in zip(p_roles, specs):
+            self.assertEqual(p_role.role.name, name)
+            self.assertEqual(p_role, register_parametric_role(name, **params))
+            self.assertEqual(p_role.signature, p_role.compute_signature())
+        self.assertEqual(ParamRole.objects.count(), 3)
+    
+    def testConstantQueries(self):
+        """The number of queries shouldn't depend on the number of parametric roles to be registered"""
+        specs = [('EDITOR', {'article': article}) for article in self.articles[1:5]]
+        with self.assertNumQueries(8):
+            register_parametric_roles(specs)
+        specs = [('EDITOR', {'article': article}) for article in self.articles[5:]]
+        with self.assertNumQueries(8):
+            register_parametric_roles(specs)
+        # all parametric roles already exist 
+        specs = [('EDITOR', {'article': article}) for article in self.articles]
+        with self.assertNumQueries(1):
+            register_parametric_roles(specs)
+    
+    def testValidation(self):
+        """If a specification is invalid, raise an exception and don't register anything"""
+        specs = [
+            ('EDITOR', {'article': self.articles[1]}),
+            ('EDITOR', {'article': self.magazine}),
+        ]
+        self.assertRaises(RoleParameterWrongSpecsProvided, register_parametric_roles, specs)
+        self.assertEqual(ParamRole.objects.count(), 1)
+        
+
+class BulkRoleAssignmentTest(TestCase):
+    """Tests for the ``grant_parametric_roles()`` and ``revoke_parametric_roles()`` functions"""
+    
+    def setUp(self):
+        self.users = [User.objects.create_user(username="user%s" % i, email="user%s@example.com" % i, password="secret") for i in range(10)]
+        self.groups = [Group.objects.create(name="Group #%s" % i) for i in range(3)]
+        
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        articles = [Article.objects.create(title="Article #%s" % i, body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author) for i in range(3)]
+        self.p_roles = register_parametric_roles([('EDITOR', {'article': article}) for article in articles])
+        
+        add_parametric_role(self.users[0], self.p_roles[0])
+    
+    def testGrantOK(self):
+        """Every role should be assigned to every principal, skipping assignments already in place"""
+        principals = self.users + self.groups
+        with self.assertNumQueries(2):
+            created = grant_parametric_roles(principals, self.p_roles)
+        self.assertEqual(created, len(principals) * len(self.p_roles) - 1)
+        for user in self.users:
+            self.assertEqual(set(get_parametric_roles(user)), set(self.p_roles))
+        for group in self.groups:
+            self.assertEqual(set(get_parametric_roles(group)), set(self.p_roles))
+        
+        self.assertEqual(grant_parametric_roles(principals, self.p_roles), 0)
+    
+    def testRevokeOK(self):
+        """Roles should be removed from principals with a single query"""
+        grant_parametric_roles(self.users + self.groups, self.p_roles)
+        
+        with self.assertNumQueries(1):
+            deleted = revoke_parametric_roles(self.users[:5] + self.groups[:1], self.p_roles[:2])
+        self.assertEqual(deleted, 6 * 2)
+        self.assertEqual(get_parametric_roles(self.users[0]), [self.p_roles[2]])
+        self.assertEqual(get_parametric_roles(self.groups[0]), [self.p_roles[2]])
+        self.assertEqual(set(get_parametric_roles(self.users[5])), set(self.p_roles))
+    
+    def testInvalidation(self):
+        """Memoized roles should go stale after bulk operations"""
+        user = self.users[1]
+        self.assertEqual(get_all_parametric_roles(user), [])
+        grant_parametric_roles([self.groups[0]], self.p_roles[:1])
+        user.groups.add(self.groups[0])
+        grant_parametric_roles([user], self.p_roles[1:2])
+        self.assertEqual(set(get_all_parametric_roles(user)), set(self.p_roles[:2]))
+        revoke_parametric_roles([user, self.groups[0]], self.p_roles)
+        self.assertEqual(get_all_parametric_roles(user), [])
+    
+    def testManyRoles(self):
+        """Roles should be processed in chunks, too, so that no statement exceeds limits on SQL variables"""
+        author = Author.objects.create(name="Luke", surname="Skywalker")
+        articles = [Article.objects.create(title="Article #%s" % i, body="...", author=author) for i in range(250)]
+        p_roles = register_parametric_roles([('EDITOR', {'article': article}) for article in articles])
+        principals = self.users + self.groups
+        self.assertEqual(grant_parametric_roles(principals, p_roles), len(principals) * len(p_roles))
+        self.assertEqual(grant_parametric_roles(principals, p_roles), 0)
+        self.assertEqual(revoke_parametric_roles(principals, p_roles), len(principals) * len(p_roles))
+        self.assertEqual(get_parametric_roles(self.users[0]), [self.p_roles[0]])
+    
+    def testWrongPrincipalType(self):
+        """If a principal is neither a ``User`` nor a ``Group`` instance, raise ``TypeError``"""
+        self.assertRaises(TypeError, grant_parametric_roles, [self.users[0], self.p_roles[0]], self.p_roles)
+        self.assertRaises(TypeError, revoke_parametric_roles, [self.users[0], self.p_roles[0]], self.p_roles)
 
 
 class AddParametricRoleTest(TestCase):
@@ -403,38 +681,511 @@ class GetParametricRolesTest(TestCase):
     """Tests for the ``get_parametric_roles()`` function"""
 
     def setUp(self):
-        pass
+        self.user = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        self.group = Group.objects.create(name="Rebels")
+        self.user.groups.add(self.group)
+        
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.article1 = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.article2 = Article.objects.create(title="Dolor Sit", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        
+        self.pr1 = register_parametric_role('EDITOR', article=self.article1)
+        self.pr2 = register_parametric_role('EDITOR', article=self.article2)
+        add_parametric_role(self.user, self.pr1)
+        add_parametric_role(self.group, self.pr2)
 
     def testGetForUserOK(self):
         """If a ``User`` instance is given, retrieve all the parametric roles assigned to it"""
-        pass
+        self.assertEqual(get_parametric_roles(self.user), [self.pr1])
     
     def testGetForGroupOK(self):
         """If a ``Group`` instance is given, retrieve all the parametric roles assigned to it"""
-        pass
+        self.assertEqual(get_parametric_roles(self.group), [self.pr2])
         
     def testWrongPrincipalType(self):
         """If the principal is neither a ``User`` nor a ``Group`` instance, raise ``TypeError``"""
+        self.assertRaises(TypeError, get_parametric_roles, self.article1)
 
 
 class GetAllParametricRolesTest(TestCase):
     """Tests for the ``get_all_parametric_roles()`` function"""
 
     def setUp(self):
-        pass
+        self.user = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        self.groups = [Group.objects.create(name="Group #%s" % i) for i in range(5)]
+        self.user.groups.add(*self.groups)
+        
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.articles = [Article.objects.create(title="Article #%s" % i, body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author) for i in range(3)]
+        
+        self.pr1 = register_parametric_role('EDITOR', article=self.articles[0])
+        self.pr2 = register_parametric_role('EDITOR', article=self.articles[1])
+        self.pr3 = register_parametric_role('EDITOR', article=self.articles[2])
+        
+        add_parametric_role(self.user, self.pr1)
+        # the same role assigned both directly and via a group
+        add_parametric_role(self.groups[0], self.pr1)
+        # the same role assigned via more groups
+        add_parametric_role(self.groups[1], self.pr2)
+        add_parametric_role(self.groups[2], self.pr2)
+        # a role assigned to a group the user doesn't belong to
+        other_group = Group.objects.create(name="Others")
+        add_parametric_role(other_group, self.pr3)
 
     def testGetForUserOK(self):
         """If a ``User`` instance is given, retrieve all the parametric roles assigned to it, directly or via its groups"""
-        pass
+        roles = get_all_parametric_roles(self.user)
+        self.assertEqual(len(roles), 2)
+        self.assertEqual(set(roles), set([self.pr1, self.pr2]))
     
     def testGetForGroupOK(self):
         """If a ``Group`` instance is given, retrieve all the parametric roles assigned to it"""
-        pass
+        self.assertEqual(get_all_parametric_roles(self.groups[1]), [self.pr2])
         
     def testWrongPrincipalType(self):
         """If the principal is neither a ``User`` nor a ``Group`` instance, raise ``TypeError``"""
+        self.assertRaises(TypeError, get_all_parametric_roles, self.articles[0])
+        
+    def testSingleQuery(self):
+        """Roles of a user should be retrieved by a single query, whatever the number of groups (s)he belongs to"""
+        with self.assertNumQueries(1):
+            get_all_parametric_roles(self.user)
+            
+    def testMemoization(self):
+        """Roles should be memoized on the user instance, until role assignments or group memberships change"""
+        get_all_parametric_roles(self.user)
+        with self.assertNumQueries(0):
+            get_all_parametric_roles(self.user)
+        
+        ParamRole.get_role('EDITOR', article=self.articles[2]).add_principal(self.user)
+        self.assertEqual(set(get_all_parametric_roles(self.user)), set([self.pr1, self.pr2, self.pr3]))
+        
+        remove_parametric_role(self.user, self.pr3)
+        self.assertEqual(set(get_all_parametric_roles(self.user)), set([self.pr1, self.pr2]))
+        
+        self.user.groups.remove(self.groups[1], self.groups[2])
+        self.assertEqual(set(get_all_parametric_roles(self.user)), set([self.pr1]))
+        
+        clear_parametric_roles(self.user)
+        clear_parametric_roles(self.groups[0])
+        self.assertEqual(get_all_parametric_roles(self.user), [])
+    
+    def testPrefetch(self):
+        """If ``prefetch`` is ``True``, accessing basic roles and parameters shouldn't hit the DB"""
+        with self.assertNumQueries(2):
+            roles = get_all_parametric_roles(self.user, prefetch=True)
+            for p_role in roles:
+                p_role.role.name
+                list(p_role.param_set.all())
 
     
+class HasParamRoleTest(TestCase):
+    """Tests for the ``has_param_role()`` predicate"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        self.group = Group.objects.create(name="Rebels")
+        self.user.groups.add(self.group)
+        
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.article1 = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.article2 = Article.objects.create(title="Dolor Sit", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.article3 = Article.objects.create(title="Amet Consectetur", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.magazine = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        self.book = Book.objects.create(title="Lorem Ipsum - The book", content="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...")
+        
+        add_parametric_role(self.user, register_parametric_role('EDITOR', article=self.article1))
+        add_parametric_role(self.group, register_parametric_role('EDITOR', article=self.article2))
+        add_parametric_role(self.group, register_parametric_role('SPONSOR', article=self.article3, magazine=self.magazine))
+    
+    def testDirectAndInherited(self):
+        """Both direct and group-inherited assignments should be taken into account"""
+        self.assertTrue(has_param_role(self.user, 'EDITOR', article=self.article1))
+        self.assertTrue(has_param_role(self.user, 'EDITOR', article=self.article2))
+        self.assertFalse(has_param_role(self.user, 'EDITOR', article=self.article3))
+        self.assertTrue(has_param_role(self.user, 'EDITOR'))
+        self.assertFalse(has_param_role(self.user, 'PUBLISHER'))
+        self.assertTrue(has_param_role(self.user, 'SPONSOR', article=self.article3))
+        self.assertTrue(has_param_role(self.user, 'SPONSOR', article=self.article3, magazine=self.magazine))
+        self.assertFalse(has_param_role(self.user, 'SPONSOR', article=self.article1, magazine=self.magazine))
+        self.assertFalse(has_param_role(AnonymousUser(), 'EDITOR', article=self.article1))
+    
+    def testManyRoleNames(self):
+        """If many role names are given, holding any of them should be enough"""
+        self.assertTrue(has_param_role(self.user, ['EDITOR', 'SPONSOR'], article=self.article3))
+        self.assertFalse(has_param_role(self.user, ('PUBLISHER',)))
+        # only kinds accepting the given parameters should be considered  
+        self.assertTrue(has_param_role(self.user, ['EDITOR', 'SPONSOR'], article=self.article3, magazine=self.magazine))
+        self.assertFalse(has_param_role(self.user, ['EDITOR', 'PUBLISHER'], book=self.book))
+        self.assertRaises(RoleParameterNotAllowed, has_param_role, self.user, ['EDITOR', 'PUBLISHER'], magazine=self.magazine)
+        self.assertRaises(RoleParameterWrongSpecsProvided, has_param_role, self.user, ['EDITOR', 'SPONSOR'], article=self.book)
+    
+    @override_settings(FLEXI_AUTH_EFFECTIVE_ROLES=True)
+    def testEffectiveRoles(self):
+        """If effective roles are materialized, the check should be performed against them"""
+        call_command('rebuild_effective_param_roles', verbosity=0)
+        self.assertTrue(has_param_role(self.user, 'EDITOR', article=self.article2))
+        self.user.groups.remove(self.group)
+        self.assertFalse(has_param_role(self.user, 'EDITOR', article=self.article2))
+        self.assertTrue(has_param_role(self.user, 'EDITOR', article=self.article1))
+    
+    def testSingleQuery(self):
+        """Checking for a parametric role should take exactly one query, whatever the number of roles, groups and parameters"""
+        for i in range(5):
+            group = Group.objects.create(name="Group #%s" % i)
+            self.user.groups.add(group)
+            add_parametric_role(group, register_parametric_role('EDITOR', article=Article.objects.create(title="Article #%s" % i, body="...", author=self.article1.author)))
+        # warm up the ``ContentType`` cache
+        ContentType.objects.get_for_model(Article)
+        ContentType.objects.get_for_model(Magazine)
+        
+        with self.assertNumQueries(1):
+            has_param_role(self.user, 'EDITOR', article=self.article2)
+        with self.assertNumQueries(1):
+            has_param_role(self.user, ['EDITOR', 'SPONSOR'], article=self.article3, magazine=self.magazine)
+    
+    def testFailIfInvalidInput(self):
+        """Invalid role names and parameters should be rejected"""
+        self.assertRaises(RoleNotAllowed, has_param_role, self.user, 'FOO')
+        self.assertRaises(RoleParameterNotAllowed, has_param_role, self.user, 'EDITOR', book=self.book)
+        self.assertRaises(RoleParameterWrongSpecsProvided, has_param_role, self.user, 'EDITOR', article=self.book)
+        
+
+class GetObjectsForRoleTest(TestCase):
+    """Tests for the ``get_objects_for_role()`` helper function"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        self.group = Group.objects.create(name="Rebels")
+        self.user.groups.add(self.group)
+        
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.articles = [Article.objects.create(title="Article #%s" % i, body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author) for i in range(6)]
+        self.magazine = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        
+        add_parametric_role(self.user, register_parametric_role('EDITOR', article=self.articles[0]))
+        add_parametric_role(self.group, register_parametric_role('EDITOR', article=self.articles[1]))
+        add_parametric_role(self.group, register_parametric_role('SPONSOR', article=self.articles[2], magazine=self.magazine))
+        # a role not held by the user
+        register_parametric_role('EDITOR', article=self.articles[3])
+    
+    def testObjectsOK(self):
+        """Instances bound to roles held by the user (directly or via groups) should be returned"""
+        self.assertEqual(set(get_objects_for_role(self.user, Article, 'EDITOR')), set(self.articles[:2]))
+        self.assertEqual(set(get_objects_for_role(self.user, Article, 'SPONSOR')), set(self.articles[2:3]))
+        self.assertEqual(set(get_objects_for_role(self.user, Article, ['EDITOR', 'SPONSOR'])), set(self.articles[:3]))
+        self.assertEqual(set(get_objects_for_role(self.user, Magazine, 'SPONSOR', param_name='magazine')), set([self.magazine]))
+        # only kinds having parameters suitable for the model should be considered  
+        self.assertEqual(set(get_objects_for_role(self.user, Magazine, ['EDITOR', 'SPONSOR'])), set([self.magazine]))
+        self.assertEqual(list(get_objects_for_role(AnonymousUser(), Article, 'EDITOR')), [])
+    
+    def testComposable(self):
+        """The result should be a lazy ``QuerySet``, which can be further filtered and sliced"""
+        qs = Article.objects.filter(title__in=["Article #1", "Article #2"])
+        with self.assertNumQueries(1):
+            self.assertEqual(list(get_objects_for_role(self.user, qs, 'EDITOR')), [self.articles[1]])
+        
+        ContentType.objects.get_for_model(Article)
+        with self.assertNumQueries(0):
+            qs = get_objects_for_role(self.user, Article, 'EDITOR').order_by('-title')
+        with self.assertNumQueries(1):
+            self.assertEqual(list(qs[:1]), [self.articles[1]])
+    
+    def testFailIfInvalidInput(self):
+        """Invalid role names, parameter names and models should be rejected"""
+        self.assertRaises(RoleNotAllowed, get_objects_for_role, self.user, Article, 'FOO')
+        self.assertRaises(RoleParameterNotAllowed, get_objects_for_role, self.user, Article, 'EDITOR', param_name='book')
+        self.assertRaises(RoleParameterWrongSpecsProvided, get_objects_for_role, self.user, Book, 'EDITOR')
+        self.assertRaises(RoleParameterWrongSpecsProvided, get_objects_for_role, self.user, Magazine, 'SPONSOR', param_name='article')
+        self.assertRaises(RoleParameterWrongSpecsProvided, get_objects_for_role, self.user, Book, ['EDITOR', 'SPONSOR'])
+
+
+class PrincipalsForObjectTest(TestCase):
+    """Tests for ``ParamRole.objects.for_object()`` and ``get_principals_for_object()``"""
+    
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        self.user2 = User.objects.create_user(username="Luke Skywalker", email="luke@rebels.org", password="secret")
+        self.user3 = User.objects.create_user(username="Leia Organa", email="leia@rebels.org", password="secret")
+        self.group = Group.objects.create(name="Rebels")
+        self.user2.groups.add(self.group)
+        self.user3.groups.add(self.group)
+        
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.article1 = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.article2 = Article.objects.create(title="Dolor Sit", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.magazine = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        
+        self.pr1 = register_parametric_role('EDITOR', article=self.article1)
+        self.pr2 = register_parametric_role('SPONSOR', article=self.article1, magazine=self.magazine)
+        self.pr3 = register_parametric_role('EDITOR', article=self.article2)
+        add_parametric_role(self.user1, self.pr1)
+        add_parametric_role(self.group, self.pr1)
+        add_parametric_role(self.user2, self.pr2)
+        add_parametric_role(self.user3, self.pr3)
+    
+    def testForObject(self):
+        """``.for_object()`` should return every parametric role bound to an object, only once"""
+        self.assertEqual(list(ParamRole.objects.for_object(self.article1).order_by('pk')), [self.pr1, self.pr2])
+        self.assertEqual(list(ParamRole.objects.for_object(self.magazine)), [self.pr2])
+        self.assertEqual(list(ParamRole.objects.filter(role__name='EDITOR').for_object(self.article2)), [self.pr3])
+    
+    def testPrincipalsOK(self):
+        """A mapping from parametric roles to principals should be returned"""
+        self.assertEqual(get_principals_for_object(self.article1), {self.pr1: set([self.user1, self.group]), self.pr2: set([self.user2])})
+        self.assertEqual(get_principals_for_object(self.article1, expand_groups=True), 
+                         {self.pr1: set([self.user1, self.user2, self.user3]), self.pr2: set([self.user2])})
+        article = Article.objects.create(title="Amet Consectetur", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=self.article1.author)
+        self.assertEqual(get_principals_for_object(article), {})
+    
+    def testBoundedQueries(self):
+        """The number of queries shouldn't depend on the number of roles and principals"""
+        for i in range(5):
+            magazine = Magazine.objects.create(name="Magazine #%s" % i, printing=i)
+            group = Group.objects.create(name="Group #%s" % i)
+            group.user_set.add(self.user1, self.user3)
+            add_parametric_role(group, register_parametric_role('SPONSOR', article=self.article1, magazine=magazine))
+        ContentType.objects.get_for_model(Article)
+        
+        with self.assertNumQueries(2):
+            principals = get_principals_for_object(self.article1)
+            [(p_role.role.name, [u"%s" % p for p in ps]) for (p_role, ps) in principals.items()]
+        with self.assertNumQueries(3):
+            principals = get_principals_for_object(self.article1, expand_groups=True)
+            [(p_role.role.name, [u"%s" % p for p in ps]) for (p_role, ps) in principals.items()]
+    
+    @override_settings(FLEXI_AUTH_EFFECTIVE_ROLES=True)
+    def testEffectiveRoles(self):
+        """If effective roles are materialized, groups should be expanded via a single query"""
+        call_command('rebuild_effective_param_roles', verbosity=0)
+        ContentType.objects.get_for_model(Article)
+        with self.assertNumQueries(2):
+            principals = get_principals_for_object(self.article1, expand_groups=True)
+        self.assertEqual(principals, {self.pr1: set([self.user1, self.user2, self.user3]), self.pr2: set([self.user2])})
+
+
+class GetRolesForObjectsTest(TestCase):
+    """Tests for the ``get_roles_for_objects()`` helper function"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        self.group = Group.objects.create(name="Rebels")
+        self.user.groups.add(self.group)
+        
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.articles = [Article.objects.create(title="Article #%s" % i, body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author) for i in range(4)]
+        self.magazine = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        self.book = Book.objects.create(title="Lorem Ipsum - The book", content="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...")
+        
+        add_parametric_role(self.user, register_parametric_role('EDITOR', article=self.articles[0]))
+        add_parametric_role(self.group, register_parametric_role('SPONSOR', article=self.articles[0], magazine=self.magazine))
+        add_parametric_role(self.group, register_parametric_role('EDITOR', article=self.articles[1]))
+        add_parametric_role(self.user, register_parametric_role('PUBLISHER', book=self.book))
+        # a role not held by the user
+        register_parametric_role('EDITOR', article=self.articles[2])
+    
+    def testRolesOK(self):
+        """Every object should be mapped to the kinds of roles the user holds on it"""
+        objects = self.articles + [self.magazine, self.book]
+        self.assertEqual(get_roles_for_objects(self.user, objects), {
+            self.articles[0]: set(['EDITOR', 'SPONSOR']),
+            self.articles[1]: set(['EDITOR']),
+            self.articles[2]: set(),
+            self.articles[3]: set(),
+            self.magazine: set(['SPONSOR']),
+            self.book: set(['PUBLISHER']),
+        })
+        self.assertEqual(get_roles_for_objects(AnonymousUser(), objects)[self.book], set())
+    
+    def testSingleQuery(self):
+        """The whole map should be computed by a single query"""
+        objects = self.articles + [self.magazine, self.book]
+        for model in (Article, Magazine, Book):
+            ContentType.objects.get_for_model(model)
+        with self.assertNumQueries(1):
+            get_roles_for_objects(self.user, objects)
+        with self.assertNumQueries(0):
+            get_roles_for_objects(self.user, [])
+
+
+class SharedCacheTest(TestCase):
+    """Tests for the shared cache tier (``flexi_auth.cache``)"""
+    
+    def setUp(self):
+        get_cache('default').clear()
+        
+        self.user = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        self.group = Group.objects.create(name="Rebels")
+        self.user.groups.add(self.group)
+        
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.article1 = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.article2 = Article.objects.create(title="Dolor Sit", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        
+        self.pr1 = register_parametric_role('EDITOR', article=self.article1)
+        self.pr2 = register_parametric_role('EDITOR', article=self.article2)
+        add_parametric_role(self.user, self.pr1)
+    
+    def _fresh_user(self):
+        # a new ``User`` instance, with no memoized roles 
+        return User.objects.get(pk=self.user.pk)
+    
+    @override_settings(FLEXI_AUTH_CACHE='default')
+    def testPrincipalRolesCached(self):
+        """Parametric roles of a principal should be cached across ``User`` instances"""
+        self.assertEqual(get_all_parametric_roles(self._fresh_user()), [self.pr1])
+        user = self._fresh_user()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_all_parametric_roles(user), [self.pr1])
+    
+    @override_settings(FLEXI_AUTH_CACHE='default')
+    def testPrincipalRolesInvalidation(self):
+        """Cached parametric roles of a user should go stale when role assignments or group memberships change"""
+        get_all_parametric_roles(self._fresh_user())
+        
+        add_parametric_role(self.group, self.pr2)
+        self.assertEqual(set(get_all_parametric_roles(self._fresh_user())), set([self.pr1, self.pr2]))
+        
+        self.group.user_set.remove(self.user)
+        self.assertEqual(get_all_parametric_roles(self._fresh_user()), [self.pr1])
+        
+        remove_parametric_role(self.user, self.pr1)
+        self.assertEqual(get_all_parametric_roles(self._fresh_user()), [])
+    
+    @override_settings(FLEXI_AUTH_CACHE='default')
+    def testParamRolesCached(self):
+        """Results of ``.get_param_roles()`` should be cached, and go stale when parametric roles change"""
+        self.assertEqual(set(ParamRole.objects.get_param_roles('EDITOR')), set([self.pr1, self.pr2]))
+        with self.assertNumQueries(1):
+            self.assertEqual(set(ParamRole.objects.get_param_roles('EDITOR')), set([self.pr1, self.pr2]))
+        
+        article3 = Article.objects.create(title="Consectetur", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=self.article1.author)
+        pr3 = register_parametric_role('EDITOR', article=article3)
+        self.assertEqual(set(ParamRole.objects.get_param_roles('EDITOR')), set([self.pr1, self.pr2, pr3]))
+    
+    @override_settings(FLEXI_AUTH_CACHE='default')
+    def testTooManyParamRoles(self):
+        """If too many parametric roles match, ``.get_param_roles()`` should return the lazy lookup"""
+        max_cached_ids = managers.MAX_CACHED_IDS
+        managers.MAX_CACHED_IDS = 1
+        try:
+            ParamRole.objects.get_param_roles('EDITOR')
+            with self.assertNumQueries(0):
+                qs = ParamRole.objects.get_param_roles('EDITOR')
+            self.assertEqual(set(qs), set([self.pr1, self.pr2]))
+        finally:
+            managers.MAX_CACHED_IDS = max_cached_ids
+
+
+class EffectiveParamRoleTest(TestCase):
+    """Tests for the materialized table of effective parametric roles (``settings.FLEXI_AUTH_EFFECTIVE_ROLES``)"""
+    
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        self.user2 = User.objects.create_user(username="Luke Skywalker", email="luke@rebels.org", password="secret")
+        self.group1 = Group.objects.create(name="Rebels")
+        self.group2 = Group.objects.create(name="Pilots")
+        
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.article1 = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.article2 = Article.objects.create(title="Dolor Sit", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.pr1 = register_parametric_role('EDITOR', article=self.article1)
+        self.pr2 = register_parametric_role('EDITOR', article=self.article2)
+    
+    def _rows(self):
+        return set(EffectiveParamRole.objects.values_list('user', 'role', 'via_group'))
+    
+    @override_settings(FLEXI_AUTH_EFFECTIVE_ROLES=True)
+    def testRoleAssignment(self):
+        """The table should follow roles being assigned to/removed from principals"""
+        self.user1.groups.add(self.group1)
+        add_parametric_role(self.user1, self.pr1)
+        add_parametric_role(self.group1, self.pr2)
+        self.assertEqual(self._rows(), set([(self.user1.pk, self.pr1.pk, None), (self.user1.pk, self.pr2.pk, self.group1.pk)]))
+        
+        remove_parametric_role(self.group1, self.pr2)
+        self.assertEqual(self._rows(), set([(self.user1.pk, self.pr1.pk, None)]))
+        clear_parametric_roles(self.user1)
+        self.assertEqual(self._rows(), set())
+    
+    @override_settings(FLEXI_AUTH_EFFECTIVE_ROLES=True)
+    def testGroupMembership(self):
+        """The table should follow changes to group memberships, on both sides of the relation"""
+        add_parametric_role(self.group1, self.pr1)
+        add_parametric_role(self.group2, self.pr2)
+        
+        self.user1.groups.add(self.group1, self.group2)
+        self.group1.user_set.add(self.user2)
+        self.assertEqual(self._rows(), set([(self.user1.pk, self.pr1.pk, self.group1.pk), 
+                                            (self.user1.pk, self.pr2.pk, self.group2.pk), 
+                                            (self.user2.pk, self.pr1.pk, self.group1.pk)]))
+        
+        self.user1.groups.remove(self.group2)
+        self.assertEqual(self._rows(), set([(self.user1.pk, self.pr1.pk, self.group1.pk), (self.user2.pk, self.pr1.pk, self.group1.pk)]))
+        self.group1.user_set.remove(self.user2)
+        self.assertEqual(self._rows(), set([(self.user1.pk, self.pr1.pk, self.group1.pk)]))
+        self.group1.user_set.clear()
+        self.assertEqual(self._rows(), set())
+        
+        self.user1.groups.add(self.group1, self.group2)
+        self.user1.groups.clear()
+        self.assertEqual(self._rows(), set())
+    
+    @override_settings(FLEXI_AUTH_EFFECTIVE_ROLES=True)
+    def testAssignmentUpdate(self):
+        """The table should follow changes to the principal or role of an existing assignment"""
+        self.user2.groups.add(self.group1)
+        add_parametric_role(self.user1, self.pr1)
+        relation = PrincipalParamRoleRelation.objects.get(user=self.user1, role=self.pr1)
+        
+        relation.role = self.pr2
+        relation.save()
+        self.assertEqual(self._rows(), set([(self.user1.pk, self.pr2.pk, None)]))
+        
+        relation.user = None
+        relation.group = self.group1
+        relation.save()
+        self.assertEqual(self._rows(), set([(self.user2.pk, self.pr2.pk, self.group1.pk)]))
+    
+    @override_settings(FLEXI_AUTH_EFFECTIVE_ROLES=True)
+    def testBulkOperations(self):
+        """The table should follow bulk role assignments"""
+        self.user2.groups.add(self.group1)
+        grant_parametric_roles([self.user1, self.group1], [self.pr1, self.pr2])
+        self.assertEqual(self._rows(), set([(self.user1.pk, self.pr1.pk, None), (self.user1.pk, self.pr2.pk, None), 
+                                            (self.user2.pk, self.pr1.pk, self.group1.pk), (self.user2.pk, self.pr2.pk, self.group1.pk)]))
+        revoke_parametric_roles([self.user1, self.group1], [self.pr1])
+        self.assertEqual(self._rows(), set([(self.user1.pk, self.pr2.pk, None), (self.user2.pk, self.pr2.pk, self.group1.pk)]))
+    
+    @override_settings(FLEXI_AUTH_EFFECTIVE_ROLES=True)
+    def testGetAllParametricRoles(self):
+        """``get_all_parametric_roles()`` should read from the table, via a single query"""
+        self.user1.groups.add(self.group1, self.group2)
+        add_parametric_role(self.user1, self.pr1)
+        add_parametric_role(self.group1, self.pr1)
+        add_parametric_role(self.group2, self.pr2)
+        
+        with self.assertNumQueries(1):
+            roles = get_all_parametric_roles(self.user1)
+        self.assertEqual(set(roles), set([self.pr1, self.pr2]))
+        self.assertEqual(len(roles), 2)
+    
+    def testRebuildCommand(self):
+        """The ``rebuild_effective_param_roles`` command should rebuild the table from scratch"""
+        self.user1.groups.add(self.group1)
+        self.user2.groups.add(self.group1)
+        add_parametric_role(self.user1, self.pr1)
+        add_parametric_role(self.group1, self.pr2)
+        # the table isn't maintained, since the option is disabled 
+        self.assertEqual(self._rows(), set())
+        
+        expected = set([(self.user1.pk, self.pr1.pk, None), (self.user1.pk, self.pr2.pk, self.group1.pk), (self.user2.pk, self.pr2.pk, self.group1.pk)])
+        call_command('rebuild_effective_param_roles', verbosity=0)
+        self.assertEqual(self._rows(), expected)
+        call_command('rebuild_effective_param_roles', chunk_size=1, verbosity=0)
+        self.assertEqual(self._rows(), expected)
+
+
 class RoleAutoSetupTest(TestCase):
     """Test automatic role-setup operations happening at instance-creation time"""
 
@@ -456,19 +1207,30 @@ class ParamRoleGetRoleTest(TestCase):
     """Tests for``ParamRole.get_role()`` class method"""
 
     def setUp(self):
-        pass
+        self.author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.magazine1 = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        self.magazine2 = Magazine.objects.create(name="Ipsum Magazine", printing=100)
+        self.article1 = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=self.author)
+        self.article2 = Article.objects.create(title="Dolor Sit", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=self.author)
+        
+        self.pr1 = register_parametric_role('EDITOR', article=self.article1)
+        self.pr2 = register_parametric_role('SPONSOR', article=self.article1, magazine=self.magazine1)
+        self.pr3 = register_parametric_role('SPONSOR', article=self.article1, magazine=self.magazine2)
     
     def testGetRoleOK(self):
         """Check that ``ParamRole.get_role()`` behave as expected if passed arguments are fine"""
-        pass
+        self.assertEqual(ParamRole.get_role('EDITOR', article=self.article1), self.pr1)
+        self.assertEqual(ParamRole.get_role('SPONSOR', article=self.article1, magazine=self.magazine2), self.pr3)
+        self.assertEqual(ParamRole.get_role('SPONSOR', magazine=self.magazine1), self.pr2)
     
     def testNoMatchingRole(self):
         """If no parametric role matches input criteria, raise ``ObjectDoesNotExist``"""
-        pass
+        self.assertRaises(ObjectDoesNotExist, ParamRole.get_role, 'EDITOR', article=self.article2)
+        self.assertRaises(ObjectDoesNotExist, ParamRole.get_role, 'SPONSOR', article=self.article2)
 
     def testMultipleMatchingRole(self):
         """If more than one parametric role match input criteria, raise ``MultipleObjectsReturned``"""
-        pass
+        self.assertRaises(MultipleObjectsReturned, ParamRole.get_role, 'SPONSOR', article=self.article1)
 
     def testWrongRole(self):
         """If ``role_name`` is not a valid identifier for a role, raise ``RoleNotAllowed``"""
@@ -527,19 +1289,84 @@ class ParamRoleArchiveAPITest(TestCase):
     """Test the 'archive API' for ``ParamRole``s"""
     
     def setUp(self):
-        pass
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.article = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.magazine1 = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        self.magazine2 = Magazine.objects.create(name="Ipsum Magazine", printing=100, archived=True)
+        self.book1 = Book.objects.create(title="Lorem Ipsum - The book", content="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...")
+        self.book2 = Book.objects.create(title="Dolor Sit - The book", content="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", out_of_print=True)
+        
+        self.pr1 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine1)
+        self.pr2 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine2)
+        self.pr3 = register_parametric_role('PUBLISHER', book=self.book1)
+        self.pr4 = register_parametric_role('PUBLISHER', book=self.book2)
+        self.pr5 = register_parametric_role('EDITOR', article=self.article)
     
     def testIsActiveOK(self):
         """Check that ``ParamRole.is_active`` behaves as expected under normal conditions"""
-        pass
+        self.assertTrue(self.pr1.is_active)
+        self.assertFalse(self.pr2.is_active)
+        self.assertTrue(self.pr3.is_active)
+        self.assertFalse(self.pr4.is_active)
     
     def testIsArchived(self):
         """Check that ``ParamRole.is_archived`` behaves as expected under normal conditions"""
-        pass
+        self.assertFalse(self.pr1.is_archived)
+        self.assertTrue(self.pr2.is_archived)
+        self.assertFalse(self.pr3.is_archived)
+        self.assertTrue(self.pr4.is_archived)
     
     def testArchiveAPINotImplemented(self):
         """Check that ``ParamRole.is_(active|archived)`` behaves as expected if some parameter doesn't implement the 'archive API'"""
-        pass
+        self.assertTrue(self.pr5.is_active)
+        self.assertFalse(self.pr5.is_archived)
+    
+    def testQuerySetOK(self):
+        """``RoleQuerySet.active()`` and ``.archived()`` should agree with the instance-level checks"""
+        self.assertEqual(set(ParamRole.objects.all().active()), set([self.pr1, self.pr3, self.pr5]))
+        self.assertEqual(set(ParamRole.objects.all().archived()), set([self.pr2, self.pr4]))
+        self.assertEqual(set(ParamRole.objects.filter(role__name='SPONSOR').archived()), set([self.pr2]))
+    
+    def testQuerySetSingleQuery(self):
+        """If parameter models declare an ``.active_filter()``, active roles should be retrieved by a single query"""
+        for i in range(10):
+            magazine = Magazine.objects.create(name="Magazine #%s" % i, printing=i, archived=bool(i % 2))
+            register_parametric_role('SPONSOR', article=self.article, magazine=magazine)
+        # warm up the ``ContentType`` cache
+        for model in (Article, Magazine, Book):
+            ContentType.objects.get_for_model(model)
+        
+        qs = ParamRole.objects.filter(role__name='SPONSOR')
+        # ``Book`` doesn't declare an ``.active_filter()``, so its instances are checked in Python
+        # (costing one query per call, here); the other models are dealt with by a subquery
+        with self.assertNumQueries(2):
+            active = qs.active()
+            archived = qs.archived()
+        with self.assertNumQueries(1):
+            self.assertEqual(len(active), 6)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(archived), 6)
+    
+    def testManyArchivedParams(self):
+        """Archived parameters checked in Python should be excluded by many ``__in`` lookups of bounded size"""
+        books = [Book.objects.create(title="Book #%s" % i, content="...", out_of_print=True) for i in range(CHUNK_SIZE + 1)]
+        p_roles = register_parametric_roles([('PUBLISHER', {'book': book}) for book in books])
+        qs = ParamRole.objects.filter(role__name='PUBLISHER')
+        self.assertEqual(set(qs.active()), set([self.pr3]))
+        self.assertEqual(set(qs.archived()), set(p_roles + [self.pr4]))
+    
+    def testTooManyArchivedParams(self):
+        """If archived parameters checked in Python exceed the limits of the DB backend, raise ``TooManyArchivedParams``"""
+        max_query_params = query.max_query_params
+        # no room is left for archived parameters 
+        query.max_query_params = lambda using: CHUNK_SIZE
+        try:
+            self.assertRaises(TooManyArchivedParams, ParamRole.objects.all().active)
+            self.assertRaises(TooManyArchivedParams, ParamRole.objects.all().archived)
+            # parametric roles bound to books aren't involved 
+            self.assertEqual(set(ParamRole.objects.filter(role__name='SPONSOR').archived()), set([self.pr2]))
+        finally:
+            query.max_query_params = max_query_params
 
     
 class PrincipalRoleRelationTest(TestCase):
@@ -565,7 +1392,21 @@ class RoleManagerTest(TestCase):
     """Tests for the ``RoleManager`` custom manager class"""
 
     def setUp(self):
-        pass
+        self.author = Author.objects.create(name="Bilbo", surname="Baggins")
+        
+        self.magazine1 = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        self.magazine2 = Magazine.objects.create(name="Ipsum Magazine", printing=100)
+        
+        self.article1 = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=self.author)
+        self.article2 = Article.objects.create(title="Dolor Sit", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=self.author)
+        
+        self.book = Book.objects.create(title="Lorem Ipsum - The book", content="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...")
+        
+        self.pr1 = register_parametric_role('EDITOR', article=self.article1)
+        self.pr2 = register_parametric_role('EDITOR', article=self.article2)
+        self.pr3 = register_parametric_role('SPONSOR', article=self.article1, magazine=self.magazine1)
+        self.pr4 = register_parametric_role('SPONSOR', article=self.article1, magazine=self.magazine2)
+        self.pr5 = register_parametric_role('SPONSOR', article=self.article2, magazine=self.magazine1)
     
     def testShallowCopyOk(self):
         """It should be possible to make a shallow copy of a manager instance"""
@@ -574,39 +1415,174 @@ class RoleManagerTest(TestCase):
     
     def testGetParamRolesOK(self):
         """Check that ``.get_param_roles()`` returns the right set of parametric roles if input is valid"""
-        pass
+        qs = ParamRole.objects.get_param_roles('EDITOR', article=self.article1)
+        self.assertEqual(set(qs), set([self.pr1]))
+        
+        qs = ParamRole.objects.get_param_roles('EDITOR')
+        self.assertEqual(set(qs), set([self.pr1, self.pr2]))
+        
+        qs = ParamRole.objects.get_param_roles('SPONSOR', article=self.article1)
+        self.assertEqual(set(qs), set([self.pr3, self.pr4]))
+        
+        qs = ParamRole.objects.get_param_roles('SPONSOR', magazine=self.magazine1)
+        self.assertEqual(set(qs), set([self.pr3, self.pr5]))
+        
+        qs = ParamRole.objects.get_param_roles('SPONSOR', article=self.article2, magazine=self.magazine1)
+        self.assertEqual(set(qs), set([self.pr5]))
+        
+        qs = ParamRole.objects.get_param_roles('SPONSOR', article=self.article2, magazine=self.magazine2)
+        self.assertEqual(set(qs), set())
+    
+    def testGetParamRolesSingleQuery(self):
+        """``.get_param_roles()`` should be lazy and hit the DB only once, whatever the number of candidate roles"""
+        for i in range(10):
+            magazine = Magazine.objects.create(name="Magazine #%s" % i, printing=i)
+            register_parametric_role('SPONSOR', article=self.article1, magazine=magazine)
+        # warm up the ``ContentType`` cache
+        ContentType.objects.get_for_model(Article)
+        ContentType.objects.get_for_model(Magazine)
+        
+        # validation goes through the constraint index, and the lookup itself is lazy
+        with self.assertNumQueries(0):
+            qs = ParamRole.objects.get_param_roles('SPONSOR', article=self.article1, magazine=self.magazine1)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(qs), [self.pr3])
     
     def testGetParamRolesFailIfInvalidRole(self):
         """If given an invalid role name, ``.get_param_roles()`` should raise ``RoleNotAllowed``"""
-        pass
+        self.assertRaises(RoleNotAllowed, ParamRole.objects.get_param_roles, 'FOO', article=self.article1)
     
     def testGetParamRolesFailIfInvalidParamName(self):
         """If the name of parameter is invalid ``.get_param_roles()`` should raise ``RoleParameterNotAllowed``"""
-        pass
+        self.assertRaises(RoleParameterNotAllowed, ParamRole.objects.get_param_roles, 'EDITOR', book=self.book)
     
     def testGetParamRolesFailIfInvalidParamType(self):
         """If the value of a parameter is of the wrong type, ``.get_param_roles()`` should raise RoleParameterWrongSpecsProvided"""
-        pass
+        self.assertRaises(RoleParameterWrongSpecsProvided, ParamRole.objects.get_param_roles, 'EDITOR', article=self.book)
+    
+    def testWithParamsOK(self):
+        """Parametric roles returned by ``.with_params()`` should expose the right parameters"""
+        p_roles = dict([(p_role.pk, p_role) for p_role in ParamRole.objects.with_params()])
+        self.assertEqual(p_roles[self.pr1.pk].article, self.article1)
+        self.assertEqual(p_roles[self.pr1.pk].param.value, self.article1)
+        self.assertEqual(p_roles[self.pr3.pk].magazine, self.magazine1)
+        self.assertEqual(set(p.value for p in p_roles[self.pr5.pk].params), set([self.article2, self.magazine1]))
+        self.assertRaises(AttributeError, lambda x: p_roles[self.pr1.pk].magazine, 1)
+    
+    def testWithParamsQueries(self):
+        """Accessing parameters of roles returned by ``.with_params()`` shouldn't hit the DB"""
+        for i in range(10):
+            magazine = Magazine.objects.create(name="Magazine #%s" % i, printing=i)
+            register_parametric_role('SPONSOR', article=self.article2, magazine=magazine)
+        # warm up the ``ContentType`` cache
+        ContentType.objects.get_for_model(Article)
+        ContentType.objects.get_for_model(Magazine)
+        
+        # parametric roles (and basic roles), parameters, articles, magazines
+        with self.assertNumQueries(4):
+            p_roles = list(ParamRole.objects.filter(role__name='SPONSOR').with_params())
+        with self.assertNumQueries(0):
+            for p_role in p_roles:
+                p_role.article
+                p_role.magazine
+                [p.value for p in p_role.params]
+                u"%s" % p_role
     
     def testArchiveAPIOK(self):
         """Check that ``.is_(active|archived)`` behaves as expected under normal conditions""" 
-        pass
+        self.magazine2.archived = True
+        self.magazine2.save()
+        self.assertEqual(set(ParamRole.objects.active('SPONSOR', article=self.article1)), set([self.pr3]))
+        self.assertEqual(set(ParamRole.objects.archived('SPONSOR', article=self.article1)), set([self.pr4]))
+        self.assertEqual(set(ParamRole.objects.archived('SPONSOR', magazine=self.magazine1)), set())
     
     def testArchiveAPINotImplemented(self):
         """Check that ``.is_(active|archived)`` behaves as expected if some parameter doesn't implement the 'archive API'"""
-        pass
+        self.assertEqual(set(ParamRole.objects.active('EDITOR')), set([self.pr1, self.pr2]))
+        self.assertEqual(set(ParamRole.objects.archived('EDITOR')), set())
       
     def testArchiveAPIFailIfInvalidRole(self):
         """If given an invalid role name, ``.is_(active|archived)`` should raise ``RoleNotAllowed``"""
-        pass
+        self.assertRaises(RoleNotAllowed, ParamRole.objects.active, 'FOO', article=self.article1)
+        self.assertRaises(RoleNotAllowed, ParamRole.objects.archived, 'FOO', article=self.article1)
     
     def testArchiveAPIFailIfInvalidParamName(self):
         """If the name of parameter is invalid ``.is_(active|archived)`` should raise RoleParameterNotAllowed"""
-        pass
+        self.assertRaises(RoleParameterNotAllowed, ParamRole.objects.active, 'EDITOR', book=self.book)
+        self.assertRaises(RoleParameterNotAllowed, ParamRole.objects.archived, 'EDITOR', book=self.book)
     
     def testArchiveAPIFailIfInvalidParamType(self):
         """If the value of a parameter is of the wrong type, ``.is_(active|archived)`` should raise RoleParameterWrongSpecsProvided"""
-        pass 
+        self.assertRaises(RoleParameterWrongSpecsProvided, ParamRole.objects.active, 'EDITOR', article=self.book)
+        self.assertRaises(RoleParameterWrongSpecsProvided, ParamRole.objects.archived, 'EDITOR', article=self.book)
+
+
+class StoredArchiveStateTest(TestCase):
+    """Tests for the stored archive state of parametric roles (``settings.FLEXI_AUTH_STORE_ARCHIVE_STATE``)"""
+    
+    def setUp(self):
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.article = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.magazine1 = Magazine.objects.create(name="Lorem Magazine", printing=1)
+        self.magazine2 = Magazine.objects.create(name="Ipsum Magazine", printing=100, archived=True)
+        self.book = Book.objects.create(title="Lorem Ipsum - The book", content="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...")
+    
+    def _flags(self):
+        return dict(ParamRole.objects.values_list('pk', 'active'))
+    
+    @override_settings(FLEXI_AUTH_STORE_ARCHIVE_STATE=True)
+    def testStateOnRegistration(self):
+        """Newly registered parametric roles should get the right archive state"""
+        pr1 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine1)
+        pr2 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine2)
+        [pr3] = register_parametric_roles([('SPONSOR', {'article': self.article, 'magazine': Magazine.objects.create(name="Foo", printing=1, archived=True)})])
+        self.assertEqual(self._flags(), {pr1.pk: True, pr2.pk: False, pr3.pk: False})
+    
+    @override_settings(FLEXI_AUTH_STORE_ARCHIVE_STATE=True)
+    def testStateOnParamSave(self):
+        """When a parameter object is saved, only the parametric roles it's bound to should be updated"""
+        pr1 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine1)
+        pr2 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine2)
+        pr3 = register_parametric_role('PUBLISHER', book=self.book)
+        
+        self.magazine1.archived = True
+        self.magazine1.save()
+        self.assertEqual(self._flags(), {pr1.pk: False, pr2.pk: False, pr3.pk: True})
+        
+        self.book.out_of_print = True
+        self.book.save()
+        self.magazine2.archived = False
+        self.magazine2.save()
+        self.assertEqual(self._flags(), {pr1.pk: False, pr2.pk: True, pr3.pk: False})
+    
+    @override_settings(FLEXI_AUTH_STORE_ARCHIVE_STATE=True)
+    def testManagerFilters(self):
+        """``.active()`` and ``.archived()`` should be plain filters on the stored state"""
+        pr1 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine1)
+        pr2 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine2)
+        ContentType.objects.get_for_model(Article)
+        
+        with self.assertNumQueries(1):
+            self.assertEqual(list(ParamRole.objects.active('SPONSOR', article=self.article)), [pr1])
+        with self.assertNumQueries(1):
+            self.assertEqual(list(ParamRole.objects.archived('SPONSOR', article=self.article)), [pr2])
+    
+    def testRebuildCommand(self):
+        """The ``rebuild_param_role_archive_state`` command should fix stale states"""
+        pr1 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine1)
+        pr2 = register_parametric_role('SPONSOR', article=self.article, magazine=self.magazine2)
+        # the state isn't maintained, since the option is disabled 
+        self.assertEqual(self._flags(), {pr1.pk: True, pr2.pk: True})
+        
+        call_command('rebuild_param_role_archive_state', verbosity=0)
+        self.assertEqual(self._flags(), {pr1.pk: True, pr2.pk: False})
+        
+        # updates bypassing ``.save()`` don't send signals 
+        with override_settings(FLEXI_AUTH_STORE_ARCHIVE_STATE=True):
+            Magazine.objects.update(archived=False)
+            self.assertEqual(self._flags(), {pr1.pk: True, pr2.pk: False})
+            call_command('rebuild_param_role_archive_state', chunk_size=1, verbosity=0)
+            self.assertEqual(self._flags(), {pr1.pk: True, pr2.pk: True})
        
 
 class ParamRoleBackendTest(TestCase):
@@ -985,6 +1961,377 @@ class ParamRoleBackendTest(TestCase):
         self.assertFalse(user.has_perm('VIEW', obj)) 
         
     
+class FilterByPermTest(TestCase):
+    """Tests for the ``filter_by_perm()`` bulk permission filter"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        self.super_user = User.objects.create_user(username="Harry Potter", email="harry@hogwarts.uk", password="secret")
+        self.super_user.is_superuser = True
+        self.super_user.save()
+        
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.articles = [Article.objects.create(title="Article #%s" % i, body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author) for i in range(5)]
+        self.books = [Book.objects.create(title="Book #%s" % i, content="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...") for i in range(5)]
+    
+    def testFilterHook(self):
+        """If the model declares a ``can_<perm>_filter`` hook, no instance should be loaded"""
+        with self.assertNumQueries(1):
+            self.assertEqual(set(filter_by_perm(self.user, 'VIEW', Book.objects.all(), {'language': 'Italian'})), set(self.books))
+        with self.assertNumQueries(1):
+            qs = filter_by_perm(self.user, 'VIEW', Book.objects.filter(title="Book #1"), {'language': 'Dutch', 'cover': 'Paperback'})
+            self.assertEqual(list(qs), [self.books[1]])
+        self.assertEqual(list(filter_by_perm(self.user, 'VIEW', Book.objects.all(), {'language': 'Dutch'})), [])
+    
+    def testFallback(self):
+        """If no hook is declared, instances should be checked one by one"""
+        self.assertEqual(set(filter_by_perm(self.user, 'VIEW', Article.objects.all(), {'website': 'BarSite'})), set(self.articles))
+        self.assertEqual(list(filter_by_perm(self.user, 'VIEW', Article.objects.all(), {'website': 'FooSite'})), [])
+        qs = filter_by_perm(self.user, 'VIEW', Article.objects.exclude(pk=self.articles[0].pk), {'website': 'BarSite'})
+        self.assertEqual(set(qs), set(self.articles[1:]))
+    
+    def testManyAllowedInstances(self):
+        """Primary keys of allowed instances should be split among ``__in`` lookups of bounded size"""
+        author = self.articles[0].author
+        articles = self.articles + [Article.objects.create(title="Article #%s" % i, body="...", author=author) for i in range(5, CHUNK_SIZE + 5)]
+        self.assertEqual(set(filter_by_perm(self.user, 'VIEW', Article.objects.all(), {'website': 'BarSite'})), set(articles))
+    
+    def testTooManyAllowedInstances(self):
+        """If allowed instances exceed the limits of the DB backend, raise ``TooManyAllowedInstances``"""
+        max_query_params = backends.max_query_params
+        # room is left for a couple of allowed instances only 
+        backends.max_query_params = lambda using: CHUNK_SIZE + 2
+        try:
+            self.assertRaises(TooManyAllowedInstances, filter_by_perm, self.user, 'VIEW', Article.objects.all(), {'website': 'BarSite'})
+            qs = filter_by_perm(self.user, 'VIEW', Article.objects.filter(pk__in=[self.articles[0].pk, self.articles[1].pk]), {'website': 'BarSite'})
+            self.assertEqual(set(qs), set(self.articles[:2]))
+        finally:
+            backends.max_query_params = max_query_params
+    
+    def testPermissionBaseDefaults(self):
+        """Permissions inherited from ``PermissionBase`` should grant everything, without filtering"""
+        qs = Book.objects.filter(title="Book #2")
+        with self.assertNumQueries(0):
+            filtered = filter_by_perm(self.user, 'EDIT', qs)
+        self.assertEqual(list(filtered), [self.books[2]])
+    
+    def testTableLevelPermission(self):
+        """Table-level permissions should filter the queryset without evaluating it"""
+        qs = Article.objects.filter(title="Article #5")
+        with self.assertNumQueries(0):
+            granted = filter_by_perm(self.user, 'CREATE', qs, {'website': 'BarSite'})
+            denied = filter_by_perm(self.user, 'CREATE', qs, {'website': 'FooSite'})
+        # the queryset was empty when checked, yet access to its rows was granted 
+        article = Article.objects.create(title="Article #5", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=self.articles[0].author)
+        self.assertEqual(list(granted), [article])
+        self.assertEqual(list(denied), [])
+    
+    def testSpecialUsers(self):
+        """Superusers should be granted everything, anonymous users nothing"""
+        self.assertEqual(set(filter_by_perm(self.super_user, 'VIEW', Article.objects.all())), set(self.articles))
+        self.assertEqual(list(filter_by_perm(AnonymousUser(), 'VIEW', Article.objects.all(), {'website': 'BarSite'})), [])
+    
+    def testWrongPermissionCheck(self):
+        """If the model doesn't define a ``can_<perm>`` method, raise ``WrongPermissionCheck``"""
+        self.assertRaises(WrongPermissionCheck, filter_by_perm, self.user, 'FOO', Article.objects.all())
+
+
+class HasPermManyTest(TestCase):
+    """Tests for the ``has_perm_many()`` batched permission check"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.article = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.magazines = [Magazine.objects.create(name="Magazine #%s" % i, printing=i) for i in range(20)]
+        for magazine in self.magazines[:10]:
+            add_parametric_role(self.user, register_parametric_role('SPONSOR', article=self.article, magazine=magazine))
+        self.books = [Book.objects.create(title="Book #%s" % i, content="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...") for i in range(3)]
+        for model in (Article, Magazine, Book):
+            ContentType.objects.get_for_model(model)
+    
+    def testDecisionsOK(self):
+        """Decisions should agree with those taken one object at a time"""
+        objs = self.magazines + self.books + [self.article]
+        context = {'website': 'BarSite', 'language': 'Dutch'}
+        decisions = has_perm_many(self.user, 'VIEW', objs, context)
+        for obj in objs:
+            self.assertEqual(decisions[obj], self.user.has_perm('VIEW', ObjectWithContext(obj, context)))
+        self.assertEqual(len([obj for obj in self.magazines if decisions[obj]]), 10)
+    
+    def testBatchHook(self):
+        """If a model declares a ``can_<perm>_many`` hook, checks should share work"""
+        with self.assertNumQueries(1):
+            has_perm_many(self.user, 'VIEW', self.magazines)
+        # checking one magazine at a time takes a query for each of them
+        with self.assertNumQueries(len(self.magazines)):
+            [self.user.has_perm('VIEW', ObjectWithContext(obj, {})) for obj in self.magazines]
+    
+    def testPermissionBaseDefaults(self):
+        """Batched checks inherited from ``PermissionBase`` grant everything"""
+        decisions = has_perm_many(self.user, 'EDIT', self.books)
+        self.assertTrue(all(decisions.values()))
+        self.assertFalse(any(has_perm_many(self.user, 'VIEW', self.books).values()))
+        self.assertTrue(all(has_perm_many(self.user, 'VIEW', self.books, {'language': 'Italian'}).values()))
+    
+    def testSpecialUsers(self):
+        """Superusers should be granted everything, anonymous users nothing"""
+        self.user.is_superuser = True
+        self.assertTrue(all(has_perm_many(self.user, 'VIEW', self.magazines).values()))
+        self.assertFalse(any(has_perm_many(AnonymousUser(), 'VIEW', self.magazines).values()))
+    
+    def testWrongPermissionCheck(self):
+        """If a model doesn't define a ``can_<perm>`` method, raise ``WrongPermissionCheck``"""
+        self.assertRaises(WrongPermissionCheck, has_perm_many, self.user, 'FOO', self.books)
+
+
+class PermissionRegistryTest(TestCase):
+    """Tests for the registry of permissions supported by models (``flexi_auth.registry``)"""
+    
+    def setUp(self):
+        self.registry = PermissionRegistry()
+    
+    def testSupportedPermissions(self):
+        """Permissions supported by a model should be listed along with their kind"""
+        self.assertEqual(self.registry.get_supported_permissions(Article), {'create': 'table', 'view': 'row'})
+        self.assertEqual(self.registry.get_supported_permissions(Book), 
+                         {'create': 'table', 'list': 'row', 'view': 'row', 'edit': 'row', 'delete': 'row'})
+        self.assertEqual(self.registry.get_supported_permissions(Magazine), {'view': 'row'})
+        self.assertEqual(self.registry.get_supported_permissions(Author), {})
+        self.assertTrue(self.registry.supports(Book(), 'EDIT'))
+        self.assertFalse(self.registry.supports(Article, 'EDIT'))
+        self.assertTrue(Article in dict(self.registry.items()))
+        self.assertFalse(Author in dict(self.registry.items()))
+    
+    def testDispatch(self):
+        """Permission checks should be dispatched to the right (bound) method, or rejected"""
+        article = Article(title="Lorem Ipsum")
+        self.assertEqual(self.registry.get_check(Article, 'CREATE'), Article.can_create)
+        self.assertEqual(self.registry.get_check(article, 'VIEW'), article.can_view)
+        self.assertEqual(self.registry.get_check(article, 'MEW'), None)
+        # negative results are cached, too
+        self.assertTrue((Article, 'MEW') in self.registry._dispatch)
+        self.assertEqual(self.registry.get_check(article, 'MEW'), None)
+    
+    def testOrphanedHooks(self):
+        """Hooks lacking the corresponding ``can_<perm>`` method should be reported"""
+        self.assertEqual(self.registry.orphaned_hooks(Book), [])
+        Article.can_veiw_many = classmethod(lambda cls, instances, user, context: set())
+        try:
+            self.assertEqual(PermissionRegistry().orphaned_hooks(Article), ['can_veiw_many'])
+            # ``call_command()`` turns ``CommandError`` into ``SystemExit``, so the command is run directly 
+            self.assertRaises(CommandError, ListPermissionsCommand().handle_noargs, check=True, verbosity=0)
+        finally:
+            del Article.can_veiw_many
+        call_command('list_permissions', check=True, verbosity=0)
+
+
+class PermissionDecisionCacheTest(TestCase):
+    """Tests for the cache of permission-check decisions (``flexi_auth.perm_cache``)"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.article = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.calls = []
+        # count calls to the permission-checking method
+        self.can_view = Article.__dict__['can_view']
+        def can_view(article, user, context):
+            self.calls.append((article, user, context))
+            return self.can_view(article, user, context)
+        Article.can_view = can_view
+        clear_decision_cache()
+    
+    def tearDown(self):
+        Article.can_view = self.can_view
+        clear_decision_cache()
+    
+    def _check(self, user, **context):
+        return user.has_perm('VIEW', ObjectWithContext(self.article, context))
+    
+    def testDisabledByDefault(self):
+        """If decision caching is disabled, every check should call the ``can_<perm>`` method"""
+        self._check(self.user, website="BarSite")
+        self._check(self.user, website="BarSite")
+        self.assertEqual(len(self.calls), 2)
+    
+    @override_settings(FLEXI_AUTH_PERM_CACHE='request')
+    def testRequestScope(self):
+        """Decisions should be cached per user instance, keyed by permission, object and context"""
+        self.assertTrue(self._check(self.user, website="BarSite"))
+        self.assertTrue(self._check(self.user, website="BarSite"))
+        self.assertEqual(len(self.calls), 1)
+        self.assertFalse(self._check(self.user, website="FooSite", edition="evening"))
+        self.assertTrue(self._check(self.user, edition="morning", website="FooSite"))
+        self.assertTrue(self._check(self.user, website="FooSite", edition="morning"))
+        self.assertEqual(len(self.calls), 3)
+        # another instance of the same user doesn't share the cache
+        self._check(User.objects.get(pk=self.user.pk), website="BarSite")
+        self.assertEqual(len(self.calls), 4)
+    
+    @override_settings(FLEXI_AUTH_PERM_CACHE='process')
+    def testProcessScope(self):
+        """Decisions should be shared among instances of the same user"""
+        self._check(self.user, website="BarSite")
+        self._check(User.objects.get(pk=self.user.pk), website="BarSite")
+        self.assertEqual(len(self.calls), 1)
+    
+    @override_settings(FLEXI_AUTH_PERM_CACHE='request')
+    def testInvalidation(self):
+        """Granting or revoking roles should invalidate cached decisions"""
+        self._check(self.user, website="BarSite")
+        add_parametric_role(self.user, register_parametric_role('EDITOR', article=self.article))
+        self._check(self.user, website="BarSite")
+        self.assertEqual(len(self.calls), 2)
+    
+    @override_settings(FLEXI_AUTH_PERM_CACHE='process', FLEXI_AUTH_CACHE='default')
+    def testSharedInvalidation(self):
+        """With the shared cache tier, changes made by other processes should invalidate process-wide decisions"""
+        get_cache('default').clear()
+        self._check(self.user, website="BarSite")
+        self._check(self.user, website="BarSite")
+        self.assertEqual(len(self.calls), 1)
+        # another process grants a role to a group of the user, bumping its shared generation counter 
+        group = Group.objects.create(name="Rebels")
+        self.user.groups.add(group)
+        self._check(self.user, website="BarSite")
+        bump_generations([('group', group.pk)])
+        self._check(self.user, website="BarSite")
+        self.assertEqual(len(self.calls), 3)
+    
+    @override_settings(FLEXI_AUTH_PERM_CACHE='request')
+    def testUnhashableContext(self):
+        """If the context can't be made hashable, or it hashes by identity, the decision shouldn't be cached"""
+        self._check(self.user, website="BarSite", extra=bytearray("foo"))
+        self._check(self.user, website="BarSite", extra=object())
+        self._check(self.user, website="BarSite", extra=[self.article, {'a': set([1])}])
+        self._check(self.user, website="BarSite", extra=[self.article, {'a': set([1])}])
+        self.assertEqual(len(self.calls), 3)
+    
+    @override_settings(FLEXI_AUTH_PERM_CACHE='request')
+    def testModelOptOut(self):
+        """Models should be able to opt out of decision caching"""
+        for policy in (False, ('edit',)):
+            Article.perm_cache = policy
+            try:
+                self._check(self.user, website="BarSite")
+                self._check(self.user, website="BarSite")
+            finally:
+                del Article.perm_cache
+        self.assertEqual(len(self.calls), 4)
+    
+    def testLRUEviction(self):
+        """Least recently used entries should be evicted first, and entries should expire"""
+        cache = DecisionCache(max_size=2, timeout=60)
+        cache.set('a', 0, 1)
+        cache.set('b', 0, 2)
+        cache.get('a', 0)
+        cache.set('c', 0, 3)
+        self.assertEqual(cache.get('a', 0), (True, 1))
+        self.assertEqual(cache.get('b', 0), (False, None))
+        self.assertEqual(cache.get('c', 1), (False, None))
+        
+        cache = DecisionCache(max_size=2, timeout=-1)
+        cache.set('a', 0, 1)
+        self.assertEqual(cache.get('a', 0), (False, None))
+
+
+class InstrumentationTest(TestCase):
+    """Tests for the instrumentation of the permission-checking API (``flexi_auth.instrumentation``)"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username="Ian Solo", email="ian@rebels.org", password="secret")
+        author = Author.objects.create(name="Bilbo", surname="Baggins")
+        self.article = Article.objects.create(title="Lorem Ipsum", body="Neque porro quisquam est qui dolorem ipsum quia dolor sit amet...", author=author)
+        self.p_role = register_parametric_role('EDITOR', article=self.article)
+        add_parametric_role(self.user, self.p_role)
+        self.received = []
+        permission_stats_recorded.connect(self._receive)
+    
+    def tearDown(self):
+        permission_stats_recorded.disconnect(self._receive)
+        stop_recording()
+    
+    def _receive(self, sender, stats, request, **kwargs):
+        self.received.append((stats, request))
+    
+    def testNotRecording(self):
+        """Instrumented functions should work as usual if no recording is active"""
+        self.assertEqual(get_current_stats(), None)
+        self.assertTrue(self.user.has_perm('VIEW', ObjectWithContext(self.article, {'website': "BarSite"})))
+        self.assertEqual(stop_recording(), None)
+        self.assertEqual(self.received, [])
+    
+    @override_settings(FLEXI_AUTH_PERM_CACHE='request')
+    def testChecks(self):
+        """Permission checks, calls and cache lookups should be counted"""
+        stats = start_recording()
+        self.assertTrue(get_current_stats() is stats)
+        obj = ObjectWithContext(self.article, {'website': "BarSite"})
+        self.user.has_perm('VIEW', obj)
+        self.user.has_perm('VIEW', obj)
+        self.assertTrue(stop_recording() is stats)
+        self.assertEqual(stats.checks, 2)
+        self.assertEqual(stats.calls['has_perm'], 2)
+        self.assertEqual(stats.cache_misses, 1)
+        self.assertEqual(stats.cache_hits, 1)
+        self.assertTrue(stats.time > 0)
+        self.assertEqual(self.received, [(stats, None)])
+    
+    def testQueries(self):
+        """Queries should be counted once, even if triggered by nested calls"""
+        user = User.objects.get(pk=self.user.pk)
+        stats = start_recording(count_queries=True)
+        self.assertEqual(get_all_parametric_roles(user), [self.p_role])
+        self.assertEqual(has_param_role(user, 'EDITOR', article=self.article), True)
+        get_all_parametric_roles(user)
+        stop_recording()
+        self.assertEqual(stats.queries, 2)
+        self.assertEqual(stats.calls, {'get_all_parametric_roles': 2, 'has_param_role': 1})
+        self.assertEqual((stats.cache_hits, stats.cache_misses), (1, 1))
+    
+    @override_settings(MIDDLEWARE_CLASSES=settings.MIDDLEWARE_CLASSES + ('flexi_auth.middleware.PermissionStatsMiddleware',),
+                       FLEXI_AUTH_STATS_HEADER='X-Flexi-Auth-Stats')
+    def testMiddleware(self):
+        """The middleware should record statistics of every request"""
+        response = self.client.get('/restricted/no-inheritance/row/no-context/')
+        self.assertTrue(response['X-Flexi-Auth-Stats'].startswith('checks=1 '))
+        self.assertEqual(len(self.received), 1)
+        (stats, request) = self.received[0]
+        self.assertEqual(stats.checks, 1)
+        self.assertTrue(request.flexi_auth_stats is stats)
+        self.assertEqual(get_current_stats(), None)
+
+
+class BenchmarkTest(TestCase):
+    """Tests for the benchmark suite (``flexi_auth.benchmarks``)"""
+    
+    def testGenerateDataset(self):
+        """A dataset of the requested sizes should be generated"""
+        dataset = generate_dataset(param_roles=40, users=10, groups=3, memberships=12, roles_per_user=2, roles_per_group=4, seed=1)
+        self.assertEqual(ParamRole.objects.count(), 40)
+        self.assertEqual(ParamRole.objects.filter(role__name='SPONSOR').count(), 20)
+        self.assertEqual(len(dataset.ids['user']), 10)
+        self.assertEqual(len(dataset.ids['group']), 3)
+        self.assertEqual(User.groups.through.objects.count(), 12)
+        self.assertEqual(PrincipalParamRoleRelation.objects.filter(user__isnull=False).count(), 20)
+        self.assertEqual(PrincipalParamRoleRelation.objects.filter(group__isnull=False).count(), 12)
+    
+    def testRunBenchmarks(self):
+        """Every benchmark should run, and its results should be reported"""
+        dataset = generate_dataset(param_roles=40, users=10, seed=1)
+        results = run_benchmarks(dataset, repeat=1, number=2)
+        self.assertEqual(set(results['results']), set([name for (name, bench) in BENCHMARKS]))
+        self.assertEqual(results['meta']['sizes']['param_roles'], 40)
+        self.assertEqual(compare_results(results, results), [])
+    
+    def testCompareResults(self):
+        """Slowdowns beyond the tolerance and additional queries should be flagged as regressions"""
+        baseline = {'results': {'a': {'best': 1.0, 'queries': 1}, 'b': {'best': 1.0, 'queries': 1}}}
+        results = {'results': {'a': {'best': 1.2, 'queries': 2}, 'b': {'best': 1.3, 'queries': 1}, 'c': {'best': 5.0, 'queries': 9}}}
+        self.assertEqual(compare_results(results, baseline, tolerance=0.25), [('a', 'queries', 1, 2), ('b', 'best', 1.0, 1.3)])
+
+        
 class ObjectPermissionDecoratorTest(TestCase):
     """Tests for the ``object_permission_required()`` decorator"""
     
@@ -16,13 +16,24 @@
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User, Group
-from django.conf import settings
+from django.db import connections, router, transaction, IntegrityError
+from django.db.models import Q
+from django.db.models.query import QuerySet
 from django.utils.translation import ugettext_lazy as _
 
 from permissions.models import Role
 
-from flexi_auth.models import Param, ParamRole, PrincipalParamRoleRelation
-from flexi_auth.exceptions import RoleParameterNotAllowed, RoleNotAllowed, RoleParameterWrongSpecsProvided
+import functools
+import itertools
+import operator
+
+from flexi_auth.models import Param, ParamRole, PrincipalParamRoleRelation, EffectiveParamRole, param_role_signature, _param_specs_from_dict,\
+    resolve_param_values
+from flexi_auth.exceptions import RoleParameterNotAllowed, RoleParameterWrongSpecsProvided
+from flexi_auth.cache import get_principal_roles, bump_generations
+from flexi_auth.constraints import RoleConstraints, ROLE_CONSTRAINTS
+from flexi_auth.query import archive_state_stored, effective_roles_stored
+from flexi_auth.instrumentation import instrumented, record_cache_lookup
 
 # Roles ######################################################################
 # CREDITS: inspired by `django-permissions`
@@ -42,7 +53,7 @@ def get_ctype_from_model_label(label):
         model_name = model_name.lower()               
         ctype = ContentType.objects.get(app_label=app_label, model=model_name)
         return ctype        
-    except:
+    except (ValueError, AttributeError, ContentType.DoesNotExist):
         return None 
 
 
@@ -70,37 +81,24 @@ def _validate_parametric_role(name, params, constraints=None):
     constraints
         a data structure specifying which combinations of basic roles and parameters
         are valid in the context of the current application domain.
-        This data structure must be a dictionary having as keys the string identifiers 
+        This data structure must be either a ``RoleConstraints`` index (such as 
+        ``flexi_auth.constraints.ROLE_CONSTRAINTS``) or a dictionary having as keys the string identifiers 
         of allowed (non-parametric) roles; values must be dictionaries where each key-value pair
         consists of the name (as as string) and content type (as a 'model label') of an
-        allowed parameter (here, the 'model label' is  a string of the type ``app_name.model_name``).          
+        allowed parameter (here, the 'model label' is  a string of the type ``app_name.model_name``).
+        Dictionaries are compiled to an index on the fly, so passing an index is faster.          
     """
     
     if constraints: # if no constraints are specified, any parametric role is valid
-
-        # First of all, check if a valid role_name is provided
-        role_name = name
-        if role_name not in constraints.keys():
-            raise RoleNotAllowed(role_name)
-
-        # construct a dictionary holding ContentTypes of passed parameters
-        param_specs = {}
-        for (k,v) in params.items():
-            if k not in constraints[role_name].keys():
-                raise RoleParameterNotAllowed(role_name, constraints[role_name].keys(), k)
-            param_specs[k] = ContentType.objects.get_for_model(v)
-
-        # construct a dictionary holding expected ContentTypes of expected parameters
-        expected_param_specs = {}
-        for (k,v) in constraints[role_name].items():
-            expected_param_specs[k] = get_ctype_from_model_label(v)
-
-        # compare computed and expected signatures for parameters
-        if expected_param_specs != param_specs:
-
+        if not isinstance(constraints, RoleConstraints):
+            constraints = RoleConstraints(constraints)
+        
+        # check names, types and number of passed parameters against expected ones
+        if not constraints.check_params(name, params, exact=True):
             # this kind of parametric role isn't allowed in the current application domain
             # COMMENT fero: in this way we cannot easily guess which parameter is wrong
-            raise RoleParameterWrongSpecsProvided(role_name, param_specs=param_specs)
+            param_specs = dict([(k, ContentType.objects.get_for_model(v)) for (k, v) in params.items()])
+            raise RoleParameterWrongSpecsProvided(name, param_specs=param_specs)
 
     return True
 
@@ -115,6 +113,10 @@ def register_parametric_role(name, **kwargs):
     
     Returns the new parametric role if the registration was successfully. 
     
+    Transaction control is left to the caller: the parametric role is created within a savepoint, 
+    so that a concurrent registration of the same role (detected via its unique signature) 
+    is rolled back without affecting the caller's transaction.  
+    
     If ``name`` is not a valid role name, raises  ``RoleNotAllowed``.
     
     If the name of a passed parameter is invalid (given the domain-specific constraints), 
@@ -134,40 +136,183 @@ def register_parametric_role(name, **kwargs):
     This function is just a simple extension of the ``register_role()`` function found in ``django-permissions``,
     taking into account the additional parameters needed by the constructor of our custom ``ParamRole`` model class.
     """
-    # TODO: adapt implementation to the new version of `ParamRole`
     params = kwargs
 
     # raise an exception if params are invalid
-    _validate_parametric_role(name, params, constraints=settings.VALID_PARAMS_FOR_ROLES)   
+    _validate_parametric_role(name, params, constraints=ROLE_CONSTRAINTS)   
 
     # check if a ``Role`` instance with the passed name already exists in the DB; if not, create it
-
     role, created = Role.objects.get_or_create(name=name)      
-    ## TODO: enclose in a transaction
-    # construct the dictionary representation of the parametric role to be registered,
-    # as specified by the passed arguments
-    p_role_dict = {}
-    p_role_dict['role'] = role
-    p_role_dict['params'] = params           
-            
-    # avoid storing duplicated parametric roles in the DB
+    
+    # avoid storing duplicated parametric roles in the DB:
     # if a parametric role of the same kind and with the same parameters 
     # of the one to be registered already exists in the DB, creation isn't actually needed
-    candidates =  ParamRole.objects.filter(role=role)
-    for c in candidates:
-        if _compare_parametric_roles(p_role_dict, c):
-            return c
+    signature = param_role_signature(name, _param_specs_from_dict(params))
+    try:
+        return ParamRole.objects.get(signature=signature)
+    except ParamRole.DoesNotExist:
+        pass
+    
     # the parametric role doesn't already exist in the DB, so create it
-    # create a new blank ``ParamRole`` instance 
-    p_role = ParamRole.objects.create(role=role)
-    for (k,v) in params.items():
-        ct = ContentType.objects.get_for_model(v)
-        obj_pk = v.pk
-        p, created = Param.objects.get_or_create(name=k, content_type=ct, object_id=obj_pk)
-        p_role.param_set.add(p)
-        p.save()
+    sid = transaction.savepoint()
+    try:
+        p_role = ParamRole.objects.create(role=role, signature=signature)
+        param_list = []
+        for (k,v) in params.items():
+            ct = ContentType.objects.get_for_model(v)
+            p, created = Param.objects.get_or_create(name=k, content_type=ct, object_id=v.pk)
+            param_list.append(p)
+        # bind all parameters at once, so that the signature is checked only against the complete set
+        p_role.param_set.add(*param_list)
+    except IntegrityError:
+        # the same parametric role has been registered concurrently 
+        transaction.savepoint_rollback(sid)
+        return ParamRole.objects.get(signature=signature)
+    transaction.savepoint_commit(sid)
     return p_role           
 
+# maximum number of values passed to a single ``__in`` lookup or ``bulk_create()`` call,
+# safely below the limits on SQL variables and compound statements imposed by some DB backends 
+CHUNK_SIZE = 100
+
+def _chunks(seq, size=CHUNK_SIZE):
+    """
+    Split the sequence ``seq`` in chunks of (at most) ``size`` elements.
+    """
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+def _bulk_create(model, objs):
+    """
+    Insert the given (unsaved) instances of ``model`` into the DB, a chunk at a time.
+    """
+    for chunk in _chunks(objs):
+        model.objects.bulk_create(chunk)
+
+
+def _within_savepoint(func):
+    """
+    Decorator running a function within a savepoint, which is rolled back if the function raises an exception.
+    
+    Unlike ``transaction.commit_on_success``, it doesn't commit (or roll back) the caller's transaction, 
+    so transaction control is left to the caller.
+    """
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        sid = transaction.savepoint()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            transaction.savepoint_rollback(sid)
+            raise
+        transaction.savepoint_commit(sid)
+        return result
+    return wrapper
+
+
+@_within_savepoint
+def register_parametric_roles(specs):
+    """
+    Registers many parametric roles at once.
+    
+    ``specs`` is an iterable of ``(name, params)`` pairs, where ``name`` is the name of a basic role
+    and ``params`` is a dictionary of parameters, just as the arguments of ``register_parametric_role()``.  
+    
+    Return the list of parametric roles described by ``specs``, in the same order; 
+    parametric roles already existing in the DB are reused, while missing ones are created.
+    
+    Unlike ``register_parametric_role()``, the number of DB queries performed doesn't depend on 
+    the number of parametric roles to be registered (as long as they fit in a chunk of ``CHUNK_SIZE`` items), 
+    but only on the number of distinct ``(parameter name, parameter type)`` pairs: 
+    existing roles and parameters are looked up in a set-based fashion, and missing ones 
+    are inserted via ``bulk_create()``. The whole registration is performed within a savepoint, 
+    so it's either completed or rolled back, while transaction control is left to the caller.
+    
+    Note that, since bulk inserts don't send ``post_save`` signals, no ``.setup_roles()`` 
+    hook is triggered for the created objects.
+    
+    Validation is the same as for ``register_parametric_role()``: if a specification is invalid, 
+    ``RoleNotAllowed``, ``RoleParameterNotAllowed`` or ``RoleParameterWrongSpecsProvided`` is raised
+    (and nothing is registered).  
+    """
+    
+    # validate every specification, and compute the signature of described parametric roles  
+    specs = [(name, params, _param_specs_from_dict(params)) for (name, params) in specs]
+    signatures = []
+    for (name, params, param_specs) in specs:
+        _validate_parametric_role(name, params, constraints=ROLE_CONSTRAINTS)
+        signatures.append(param_role_signature(name, param_specs))
+    
+    # retrieve existing parametric roles    
+    p_roles = {}
+    for chunk in _chunks(set(signatures)):
+        for p_role in ParamRole.objects.filter(signature__in=chunk):
+            p_roles[p_role.signature] = p_role
+    
+    # parametric roles to be created (each only once, even if described more than once)   
+    missing = {}
+    for (signature, spec) in zip(signatures, specs):
+        if signature not in p_roles:
+            missing.setdefault(signature, spec)
+    if not missing:
+        return [p_roles[signature] for signature in signatures]
+    
+    # retrieve basic roles, creating missing ones 
+    role_names = set([name for (name, params, param_specs) in missing.values()])
+    roles = dict([(role.name, role) for role in Role.objects.filter(name__in=role_names)])
+    if role_names.difference(roles):
+        Role.objects.bulk_create([Role(name=name) for name in role_names.difference(roles)])
+        roles = dict([(role.name, role) for role in Role.objects.filter(name__in=role_names)])
+    
+    # retrieve parameters, creating missing ones; 
+    # ``Param`` rows are looked up by name and type, one query for every such pair 
+    needed_params = {}
+    for (name, params, param_specs) in missing.values():
+        for (k, ct_id, obj_id) in param_specs:
+            needed_params.setdefault((k, ct_id), set()).add(obj_id)
+    
+    def fetch_params():
+        param_ids = {}
+        for ((k, ct_id), obj_ids) in needed_params.items():
+            for chunk in _chunks(obj_ids):
+                for (pk, obj_id) in Param.objects.filter(name=k, content_type=ct_id, object_id__in=chunk).values_list('pk', 'object_id'):
+                    param_ids[(k, ct_id, obj_id)] = pk
+        return param_ids
+    
+    param_ids = fetch_params()
+    new_params = [Param(name=k, content_type_id=ct_id, object_id=obj_id) 
+                  for ((k, ct_id), obj_ids) in needed_params.items() 
+                  for obj_id in obj_ids if (k, ct_id, obj_id) not in param_ids]
+    if new_params:
+        _bulk_create(Param, new_params)
+        param_ids = fetch_params()
+    
+    # create missing parametric roles; since bulk inserts don't set primary keys, 
+    # retrieve them back via signatures   
+    _bulk_create(ParamRole, [ParamRole(role=roles[name], signature=signature) 
+                             for (signature, (name, params, param_specs)) in missing.items()])
+    for chunk in _chunks(missing.keys()):
+        for p_role in ParamRole.objects.filter(signature__in=chunk):
+            p_roles[p_role.signature] = p_role
+    
+    # bind parameters to the newly created parametric roles
+    through = ParamRole.param_set.through
+    _bulk_create(through, [through(paramrole_id=p_roles[signature].pk, param_id=param_ids[param_spec])
+                           for (signature, (name, params, param_specs)) in missing.items() 
+                           for param_spec in param_specs])
+    
+    # bulk inserts don't send signals, so invalidate cached results of ``RoleManager.get_param_roles()`` 
+    # and compute the archive state of newly created roles here
+    bump_generations([('role', name) for name in role_names])
+    if archive_state_stored():
+        for chunk in _chunks([p_roles[signature].pk for signature in missing]):
+            ParamRole.update_archive_state(ParamRole.objects.filter(pk__in=chunk))
+    
+    return [p_roles[signature] for signature in signatures]
+
+
 def _parametric_role_as_dict(p_role):
     """
     Convert a parametric role (a ``ParamRole`` model instance) 
@@ -190,7 +335,7 @@ def _parametric_role_as_dict(p_role):
         role = p_role.role
         dict_repr['role'] = role
         dict_repr['params'] = {}
-        params = p_role.params
+        params = resolve_param_values(p_role.params)
         for p in params:
             name = p.name
             value = p.value
@@ -340,43 +485,542 @@ def clear_parametric_roles(principal):
         pprs = PrincipalParamRoleRelation.objects.filter(group=principal)
     else:
         raise TypeError(_("The principal must be either a User instance or a Group instance."))   
-    if len(pprs) == 0:
+    if not pprs.exists():
         return False
     else:
-        pprs.delete.all()
+        pprs.delete()
         return True
         
 
+def _split_principals(principals):
+    """
+    Split an iterable of principals into a list of ``('user', <pk>)`` and ``('group', <pk>)`` pairs
+    (without duplicates).
+    
+    Raise ``TypeError`` if a principal is neither a ``User`` nor a ``Group`` instance.
+    """
+    
+    idents = []
+    for principal in principals:
+        if isinstance(principal, User):
+            idents.append(('user', principal.pk))
+        elif isinstance(principal, Group):
+            idents.append(('group', principal.pk))
+        else:
+            raise TypeError(_("The principal must be either a User instance or a Group instance."))
+    return list(set(idents))
+
+def _principals_changed(idents):
+    """
+    Invalidate cached parametric roles for the given principals, 
+    specified as ``('user', <pk>)`` and ``('group', <pk>)`` pairs.
+    
+    Needed after bulk operations, since they don't send signals.
+    """
+    invalidate_parametric_roles_cache()
+    bump_generations(idents)
+
+@_within_savepoint
+def grant_parametric_roles(principals, roles):
+    """
+    Assign every parametric role in ``roles`` to every principal (``User`` or ``Group`` instance) in ``principals``.
+    
+    Assignments already in place are left untouched; missing ones are computed by a single query 
+    (for each chunk of ``CHUNK_SIZE`` principals and ``CHUNK_SIZE`` roles) and created via bulk inserts.
+    The whole operation is performed within a savepoint, while transaction control is left to the caller.
+    
+    Return the number of assignments actually created; 
+    raise ``TypeError`` if a principal is neither a ``User`` nor a ``Group`` instance.
+    """
+    
+    idents = _split_principals(principals)
+    role_ids = set([role.pk for role in roles])
+    if not idents or not role_ids:
+        return 0
+    
+    new_relations = []
+    for chunk in _chunks(idents):
+        user_ids = [pk for (kind, pk) in chunk if kind == 'user']
+        group_ids = [pk for (kind, pk) in chunk if kind == 'group']
+        existing = set()
+        for role_chunk in _chunks(role_ids):
+            for (user_id, group_id, role_id) in PrincipalParamRoleRelation.objects.filter(
+                    Q(user__in=user_ids) | Q(group__in=group_ids), role__in=role_chunk
+                ).values_list('user', 'group', 'role'):
+                existing.add(user_id and ('user', user_id, role_id) or ('group', group_id, role_id))
+        for (kind, pk) in chunk:
+            for role_id in role_ids:
+                if (kind, pk, role_id) not in existing:
+                    relation = PrincipalParamRoleRelation(role_id=role_id)
+                    setattr(relation, '%s_id' % kind, pk)
+                    new_relations.append(relation)
+    
+    _bulk_create(PrincipalParamRoleRelation, new_relations)
+    if effective_roles_stored():
+        _add_effective_param_roles([pk for (kind, pk) in idents if kind == 'user'], 
+                                   [pk for (kind, pk) in idents if kind == 'group'], role_ids)
+    _principals_changed(idents)
+    return len(new_relations)
+
+@_within_savepoint
+def revoke_parametric_roles(principals, roles):
+    """
+    Remove every parametric role in ``roles`` from every principal (``User`` or ``Group`` instance) in ``principals``.
+    
+    Assignments are removed by a single ``DELETE`` statement (for each chunk of ``CHUNK_SIZE`` principals 
+    and ``CHUNK_SIZE`` roles), without retrieving them first; so, unlike ``remove_parametric_role()``, 
+    no ``post_delete`` signal is sent.  The whole operation is performed within a savepoint, 
+    while transaction control is left to the caller.
+    
+    Return the number of assignments actually removed; 
+    raise ``TypeError`` if a principal is neither a ``User`` nor a ``Group`` instance.
+    """
+    
+    idents = _split_principals(principals)
+    role_ids = list(set([role.pk for role in roles]))
+    if not idents or not role_ids:
+        return 0
+    
+    opts = PrincipalParamRoleRelation._meta
+    using = router.db_for_write(PrincipalParamRoleRelation)
+    qn = connections[using].ops.quote_name
+    cursor = connections[using].cursor()
+    
+    deleted = 0
+    for chunk in _chunks(idents):
+        conditions = []
+        principal_ids = []
+        for kind in ('user', 'group'):
+            ids = [pk for (k, pk) in chunk if k == kind]
+            if ids:
+                conditions.append("%s IN (%s)" % (qn(opts.get_field(kind).column), ", ".join(["%s"] * len(ids))))
+                principal_ids.extend(ids)
+        for role_chunk in _chunks(role_ids):
+            sql = "DELETE FROM %s WHERE %s IN (%s) AND (%s)" % (qn(opts.db_table), qn(opts.get_field('role').column), 
+                                                               ", ".join(["%s"] * len(role_chunk)), " OR ".join(conditions))
+            cursor.execute(sql, role_chunk + principal_ids)
+            deleted += cursor.rowcount
+    # as for any raw SQL modifying data
+    transaction.commit_unless_managed(using=using)
+    
+    if effective_roles_stored():
+        _remove_effective_param_roles([pk for (kind, pk) in idents if kind == 'user'], 
+                                      [pk for (kind, pk) in idents if kind == 'group'], role_ids)
+    _principals_changed(idents)
+    return deleted
+    
+
+# Effective roles ############################################################
+# When ``settings.FLEXI_AUTH_EFFECTIVE_ROLES`` is enabled, parametric roles held by users 
+# (directly or via groups) are materialized in the ``EffectiveParamRole`` table; 
+# the following helpers keep it up-to-date, touching only the affected rows.
+# They are called by signal handlers (see ``flexi_auth.models``) and bulk operations.
+
+def _create_effective_rows(rows):
+    """
+    Insert the given ``(user_id, role_id, via_group_id)`` triples into the ``EffectiveParamRole`` table,
+    skipping those already there.
+    """
+    
+    if not rows:
+        return
+    user_ids = set([user_id for (user_id, role_id, group_id) in rows])
+    role_ids = set([role_id for (user_id, role_id, group_id) in rows])
+    existing = set()
+    for user_chunk in _chunks(user_ids):
+        for role_chunk in _chunks(role_ids):
+            existing.update(EffectiveParamRole.objects.filter(user__in=user_chunk, role__in=role_chunk)
+                            .values_list('user', 'role', 'via_group'))
+    _bulk_create(EffectiveParamRole, [EffectiveParamRole(user_id=user_id, role_id=role_id, via_group_id=group_id)
+                                      for (user_id, role_id, group_id) in rows.difference(existing)])
+
+def _add_effective_param_roles(user_ids, group_ids, role_ids):
+    """
+    Update the ``EffectiveParamRole`` table after every parametric role in ``role_ids`` 
+    was assigned to every user in ``user_ids`` and every group in ``group_ids`` (all given by ID).
+    """
+    
+    rows = set([(user_id, role_id, None) for user_id in user_ids for role_id in role_ids])
+    for chunk in _chunks(group_ids):
+        for (user_id, group_id) in User.groups.through.objects.filter(group__in=chunk).values_list('user', 'group'):
+            rows.update([(user_id, role_id, group_id) for role_id in role_ids])
+    _create_effective_rows(rows)
+
+def _remove_effective_param_roles(user_ids, group_ids, role_ids):
+    """
+    Update the ``EffectiveParamRole`` table after every parametric role in ``role_ids`` 
+    was removed from every user in ``user_ids`` and every group in ``group_ids`` (all given by ID).
+    """
+    
+    for role_chunk in _chunks(role_ids):
+        rows = EffectiveParamRole.objects.filter(role__in=role_chunk)
+        for chunk in _chunks(user_ids):
+            rows.filter(user__in=chunk, via_group=None).delete()
+        for chunk in _chunks(group_ids):
+            rows.filter(via_group__in=chunk).delete()
+
+def _add_group_memberships(memberships):
+    """
+    Update the ``EffectiveParamRole`` table after users joined groups, 
+    as described by the given ``(user_id, group_id)`` pairs.
+    """
+    
+    group_ids = set([group_id for (user_id, group_id) in memberships])
+    roles_by_group = {}
+    for chunk in _chunks(group_ids):
+        for (group_id, role_id) in PrincipalParamRoleRelation.objects.filter(group__in=chunk).values_list('group', 'role'):
+            roles_by_group.setdefault(group_id, set()).add(role_id)
+    _create_effective_rows(set([(user_id, role_id, group_id) for (user_id, group_id) in memberships 
+                                for role_id in roles_by_group.get(group_id, ())]))
+
+@_within_savepoint
+def rebuild_effective_param_roles(chunk_size=CHUNK_SIZE):
+    """
+    Rebuild the ``EffectiveParamRole`` table from scratch, based on current role assignments 
+    and group memberships.
+    
+    Role assignments are processed in chunks of ``chunk_size`` items (ordered by primary key); 
+    effective roles stemming from each chunk are retrieved by a single query and inserted via bulk inserts.    
+    The whole rebuild is performed within a savepoint, while transaction control is left to the caller.
+    
+    Return the number of rows inserted into the table.
+    """
+    
+    using = router.db_for_write(EffectiveParamRole)
+    qn = connections[using].ops.quote_name
+    connections[using].cursor().execute("DELETE FROM %s" % qn(EffectiveParamRole._meta.db_table))
+    transaction.commit_unless_managed(using=using)
+    
+    inserted = 0
+    last_pk = 0
+    while True:
+        pks = list(PrincipalParamRoleRelation.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        relations = PrincipalParamRoleRelation.objects.filter(pk__in=pks)
+        rows = set(relations.filter(user__isnull=False).values_list('user', 'role'))
+        rows = set([(user_id, role_id, None) for (user_id, role_id) in rows])
+        rows.update(relations.filter(group__user__isnull=False).values_list('group__user', 'role', 'group'))
+        _bulk_create(EffectiveParamRole, [EffectiveParamRole(user_id=user_id, role_id=role_id, via_group_id=group_id)
+                                          for (user_id, role_id, group_id) in rows])
+        inserted += len(rows)
+    return inserted
+
+
+# Memoization ################################################################
+# Parametric roles of a principal are memoized on the principal instance itself 
+# (e.g. ``request.user``), so they are computed at most once per request. 
+# Memoized values are tagged with a (process-wide) generation number, which is bumped 
+# whenever role assignments or group memberships change: values computed under 
+# an older generation are considered stale.
+# On a miss, the shared cache tier (if enabled) is looked up before hitting the DB;
+# see ``flexi_auth.cache``.
+
+_generation_counter = itertools.count(1)
+_current_generation = 0
+
+def invalidate_parametric_roles_cache(principal=None):
+    """
+    Invalidate memoized parametric roles.
+    
+    Every memoized value becomes stale; if a principal (``User`` or ``Group`` instance) is given, 
+    values memoized on that instance are dropped, too.
+    
+    There is usually no need to call this function directly, since it's automatically
+    invoked whenever a ``PrincipalParamRoleRelation`` is saved or deleted, and whenever 
+    group memberships of a user change.   
+    """
+    
+    global _current_generation
+    _current_generation = next(_generation_counter)
+    if principal is not None:
+        principal.__dict__.pop('_param_roles_cache', None)
+        
+
+def get_roles_generation():
+    """
+    Return the current (process-wide) generation number of role assignments; 
+    it changes whenever role assignments or group memberships change.
+    """
+    return _current_generation
+
+def _memoize_roles(principal, key, func):
+    """
+    Return the list of parametric roles memoized on ``principal`` under ``key``;
+    if no such value exists (or it's stale), compute it by calling ``func`` and memoize it.
+    """
+    
+    cache = principal.__dict__.setdefault('_param_roles_cache', {})
+    try:
+        (generation, roles) = cache[key]
+        if generation == _current_generation:
+            record_cache_lookup(True)
+            return list(roles)
+    except KeyError:
+        pass
+    record_cache_lookup(False)
+    # read the generation *before* computing the value, so that changes happening 
+    # in the meanwhile make it stale   
+    generation = _current_generation
+    roles = func()
+    cache[key] = (generation, roles)
+    return list(roles)
+
+
+@instrumented('get_parametric_roles')
 def get_parametric_roles(principal):
     """
     Return parametric roles assigned to a principal (``User`` or ``Group``).
+    
+    The result is memoized on the principal instance (see ``invalidate_parametric_roles_cache()``).
         
     Raise ``TypeError`` if the principal is neither a ``User`` nor a ``Group` instance.
     """
     
+    if not isinstance(principal, (User, Group)):
+        raise TypeError(_("The principal must be either a User instance or a Group instance."))
+    compute = lambda: _get_parametric_roles(principal)
+    return _memoize_roles(principal, 'direct', lambda: get_principal_roles(principal, 'direct', compute))
+
+
+def _get_parametric_roles(principal):
     if isinstance(principal, User):
-        return [prr.role for prr in PrincipalParamRoleRelation.objects.filter(
-            user=principal)]
-    elif isinstance(principal, Group):
-        return [prr.role for prr in PrincipalParamRoleRelation.objects.filter(
-            group=principal)]
+        qs = ParamRole.objects.filter(principal_param_role_set__user=principal)
     else:
-        raise TypeError(_("The principal must be either a User instance or a Group instance."))
+        qs = ParamRole.objects.filter(principal_param_role_set__group=principal)
+    return list(qs.select_related('role'))
     
     
-def get_all_parametric_roles(principal):
+@instrumented('get_all_parametric_roles')
+def get_all_parametric_roles(principal, prefetch=False):
     """
     Returns all parametric roles of a given principal (``User`` or ``Group`). 
     
     This takes into account roles assigned directly to the principal and, 
     if the principal is a ``User``, also roles obtained via a ``Group`` the user belongs to.
+    Every parametric role is returned only once, and retrieving them takes a single query, 
+    whatever the number of groups the user belongs to; if ``settings.FLEXI_AUTH_EFFECTIVE_ROLES``
+    is enabled, roles of a user are read from the materialized ``EffectiveParamRole`` table, 
+    so no join with group memberships is needed.   
+    
+    If ``prefetch`` is ``True``, basic roles are retrieved by the same query, 
+    and parameters of all returned parametric roles are loaded by one more query, 
+    so that accessing them doesn't hit the DB again.  
+    
+    The result is memoized on the principal instance (see ``invalidate_parametric_roles_cache()``).
     
     Raise ``TypeError`` if the principal is neither a ``User`` nor a ``Group` instance.
     """
     
-    roles = get_parametric_roles(principal)
+    if not isinstance(principal, (User, Group)):
+        raise TypeError(_("The principal must be either a User instance or a Group instance."))
+    scope = prefetch and 'all-prefetch' or 'all'
+    compute = lambda: _get_all_parametric_roles(principal, prefetch)
+    return _memoize_roles(principal, scope, lambda: get_principal_roles(principal, scope, compute))
+
 
+def _get_all_parametric_roles(principal, prefetch=False):
     if isinstance(principal, User):
-        for group in principal.groups.all():
-            roles.extend(get_parametric_roles(group))
+        qs = _held_by(ParamRole.objects.all(), principal).distinct()
+    else:
+        qs = ParamRole.objects.filter(principal_param_role_set__group=principal)
+    
+    if prefetch:
+        qs = qs.select_related('role').prefetch_related('param_set')
+    return list(qs)
+
+
+@instrumented('has_param_role')
+def has_param_role(user, role_name, **params):
+    """
+    Return ``True`` if ``user`` holds a parametric role of kind ``role_name`` bound to (at least) 
+    the given parameters, either directly or via a group (s)he belongs to; ``False`` otherwise.
+    
+    ``role_name`` may be either the name of a basic role or an iterable of them: in the latter case, 
+    holding a parametric role of any of those kinds is enough, and only kinds accepting ``params`` are considered.  
+    ``params`` is a dictionary of parameters, just as for ``ParamRole.objects.get_param_roles()``.
+    
+    The check is performed by a single (existence) query, both for direct and group-inherited assignments
+    (or against the ``EffectiveParamRole`` table, if ``settings.FLEXI_AUTH_EFFECTIVE_ROLES`` is enabled).
+    
+    If a role name isn't allowed, raise ``RoleNotAllowed``.  If no role kind accepts ``params``, raise 
+    ``RoleParameterNotAllowed`` if they contain an invalid parameter name, or ``RoleParameterWrongSpecsProvided`` 
+    if a parameter is assigned to a wrong type (as reported for the first of those kinds).
+    """
+    
+    role_names = []
+    error = None
+    for name in _role_names(role_name):
+        try:
+            if ROLE_CONSTRAINTS.check_params(name, params, exact=False):
+                role_names.append(name)
+            elif error is None:
+                error = RoleParameterWrongSpecsProvided(name, params)
+        except RoleParameterNotAllowed as e:
+            if error is None:
+                error = e
+    if not role_names and error is not None:
+        raise error
+    
+    if user.is_anonymous() or not role_names:
+        return False
+    
+    qs = ParamRole.objects.filter(role__name__in=role_names).with_param_values(**params)
+    return _held_by(qs, user).exists()
+
+
+def _role_names(role_name):
+    """
+    Return a list of role names, given either a single role name or an iterable of them.
+    """
+    
+    if isinstance(role_name, basestring):
+        return [role_name]
+    return list(role_name)
+
+
+def _held_by(qs, user):
+    """
+    Filter the ``QuerySet`` of parametric roles ``qs`` including only those held by ``user`` 
+    (either directly or via a group).
+    """
+    
+    if effective_roles_stored():
+        return qs.filter(effective_set__user=user)
+    return qs.filter(Q(principal_param_role_set__user=user) | Q(principal_param_role_set__group__user=user))
+
+
+@instrumented('get_principals_for_object')
+def get_principals_for_object(obj, expand_groups=False):
+    """
+    Return the principals holding any parametric role on the model instance ``obj`` 
+    (i.e. having ``obj`` among its parameters), as a dictionary mapping each of those 
+    ``ParamRole`` instances to the set of principals (``User`` and ``Group`` instances) it's assigned to.
+    
+    If ``expand_groups`` is ``True``, groups are replaced by their members, so only users are returned.
+    
+    The number of queries is bounded (three at most), whatever the number of roles and principals:
+    one for parametric roles (via the index on ``Param(content_type, object_id)``), 
+    one for their assignments and, if ``expand_groups`` is ``True``, one for group memberships  
+    (if ``settings.FLEXI_AUTH_EFFECTIVE_ROLES`` is enabled, the last two are replaced by a single query
+    on the ``EffectiveParamRole`` table).   
+    """
+    
+    p_roles = dict([(p_role.pk, p_role) for p_role in ParamRole.objects.for_object(obj).select_related('role')])
+    principals = dict([(p_role, set()) for p_role in p_roles.values()])
+    if not p_roles:
+        return principals
+    
+    if expand_groups and effective_roles_stored():
+        for row in EffectiveParamRole.objects.filter(role__in=p_roles.keys()).select_related('user'):
+            principals[p_roles[row.role_id]].add(row.user)
+        return principals
+    
+    members = {}
+    relations = list(PrincipalParamRoleRelation.objects.filter(role__in=p_roles.keys()).select_related('user', 'group'))
+    if expand_groups:
+        group_ids = set([r.group_id for r in relations if r.group_id])
+        for m in User.groups.through.objects.filter(group__in=group_ids).select_related('user'):
+            members.setdefault(m.group_id, []).append(m.user)
+    for r in relations:
+        if r.user_id:
+            principals[p_roles[r.role_id]].add(r.user)
+        elif expand_groups:
+            principals[p_roles[r.role_id]].update(members.get(r.group_id, []))
+        else:
+            principals[p_roles[r.role_id]].add(r.group)
+    return principals
+
+
+@instrumented('get_roles_for_objects')
+def get_roles_for_objects(user, objects):
+    """
+    Return the kinds of parametric roles ``user`` holds (either directly or via a group) 
+    on each of the given model instances (possibly of different models), as a dictionary 
+    mapping every instance in ``objects`` to the set of names of basic roles 
+    whose parametric roles have it as a parameter (an empty set if there are none).
+    
+    The whole map is computed by a single query, whatever the number of objects and their types; 
+    it's meant to be computed once (e.g. when rendering a list of objects) and passed on 
+    to permission checks, instead of retrieving roles for each object in turn.   
+    """
+    
+    objects = list(objects)
+    roles = dict([(obj, set()) for obj in objects])
+    if not objects or user.is_anonymous():
+        return roles
+    
+    ids_by_ctype = {}
+    for obj in objects:
+        ids_by_ctype.setdefault(ContentType.objects.get_for_model(obj).pk, set()).add(obj.pk)
+    q = functools.reduce(operator.or_, [Q(param__content_type=ct_id, param__object_id__in=ids) 
+                                        for (ct_id, ids) in ids_by_ctype.items()])
+    
+    through = ParamRole.param_set.through
+    p_roles = _held_by(ParamRole.objects.all(), user).order_by().values('pk')
+    rows = through.objects.filter(q, paramrole__in=p_roles).values_list(
+        'param__content_type', 'param__object_id', 'paramrole__role__name').distinct()
+    
+    names = {}
+    for (ct_id, obj_id, role_name) in rows:
+        names.setdefault((ct_id, obj_id), set()).add(role_name)
+    for obj in objects:
+        roles[obj] = names.get((ContentType.objects.get_for_model(obj).pk, obj.pk), set())
     return roles
+
+
+@instrumented('get_objects_for_role')
+def get_objects_for_role(user, model_or_queryset, role_name, param_name=None):
+    """
+    Return the instances of a model on which ``user`` holds a parametric role of kind ``role_name``
+    (either directly or via a group), i.e. those bound to such a role as parameters. 
+    
+    ``model_or_queryset`` is either a model class or a ``QuerySet`` of its instances to be restricted; 
+    ``role_name`` may be either the name of a basic role or an iterable of them.  
+    If ``param_name`` is given, only instances bound to parameters with that name are considered; 
+    otherwise, any parameter of the right type will do.  
+    
+    The result is a lazy ``QuerySet``, compiling to a single SQL query (matching instances are selected 
+    via a subquery on ``Param(content_type, object_id)``), so it can be further filtered, ordered or paginated.  
+    
+    If many role names are given, only kinds having parameters suitable for the model (and ``param_name``) 
+    are considered.  If a role name isn't allowed, raise ``RoleNotAllowed``.  If no role kind is suitable, 
+    raise ``RoleParameterNotAllowed`` if ``param_name`` isn't allowed for it, or ``RoleParameterWrongSpecsProvided`` 
+    if no parameter of it (with that name) may be an instance of the model (as reported for the first of those kinds).
+    """
+    
+    if isinstance(model_or_queryset, QuerySet):
+        qs = model_or_queryset
+    else:
+        qs = model_or_queryset._default_manager.all()
+    model = qs.model
+    
+    role_names = []
+    param_names = set()
+    error = None
+    for name in _role_names(role_name):
+        allowed = ROLE_CONSTRAINTS.allowed_params(name)
+        if param_name is not None and param_name not in allowed:
+            if error is None:
+                error = RoleParameterNotAllowed(name, allowed, param_name)
+            continue
+        names = ROLE_CONSTRAINTS.params_for_model(name, model)
+        if param_name is not None:
+            names = [n for n in names if n == param_name]
+        if not names:
+            if error is None:
+                error = RoleParameterWrongSpecsProvided(name, {param_name: model})
+            continue
+        role_names.append(name)
+        param_names.update(names)
+    if not role_names and error is not None:
+        raise error
+    
+    if user.is_anonymous() or not role_names:
+        return qs.none()
+    
+    p_roles = _held_by(ParamRole.objects.filter(role__name__in=role_names), user).order_by().values('pk')
+    object_ids = Param.objects.filter(name__in=param_names, content_type=ContentType.objects.get_for_model(model), 
+                                      paramrole__in=p_roles).values('object_id')
+    return qs.filter(pk__in=object_ids)
@@ -18,7 +18,7 @@ setup(
     author="Lorenzo Franceschini",
     author_email="lorenzo.franceschini@informaetica.it",
     url = "https://github.com/seldon/django-flexi-auth",
-    packages = ["flexi_auth"],
+    packages = ["flexi_auth", "flexi_auth.management", "flexi_auth.management.commands"],
     classifiers = ["Development Status :: 3 - Alpha",
                    "Environment :: Web Environment",
                    "Framework :: Django",